@@ -5,17 +5,258 @@ from PIL import Image
 from io import BytesIO
 import pandas as pd
 import os
+import pickle
+import abc
 import base64
+import cProfile
 import io
+import marshal
+import mmap
+import operator
+import pstats
+import queue
+import sys
 import concurrent.futures
+import collections
+import contextlib
+import csv
+import dataclasses
+import decimal
+import enum
+import functools
+import hashlib
 import requests
 import json
 from mimetypes import guess_type
 import re
 import cv2
 import numpy as np
-from datetime import datetime
+from datetime import date, datetime
 import tempfile
+import shutil
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import threading
+import time
+import traceback
+import urllib.parse
+import weakref
+import psutil
+import sqlite3
+
+# --------------------- Certificate Records ---------------------
+
+class FieldMarker(enum.Enum):
+    """Placeholders the extraction writes instead of a value."""
+    MISSING = "missing"
+    UNCLEAR = "[unclear]"
+
+class Currency(enum.Enum):
+    CAD = "CAD"
+    USD = "USD"
+
+# Every certificate field once: (record attribute, kind, nested schema location, form widget key, export column).
+# The form value key is the attribute + "_value"; fields without an export column are kept in the index only.
+CERTIFICATE_FIELDS = [
+    ("cert_number", "text", ("certificateInfo", "certificateNumber"), "cert_number", "Certificate Number"),
+    ("template_form", "text", ("certificateInfo", "templateForm"), "template_form", "Template Form"),
+    ("effective_date", "date", ("certificateInfo", "effectiveDate"), "effective_date", None),
+    ("expiration_date", "date", ("certificateInfo", "expirationDate"), "expiration_date", None),
+    ("insured_name", "text", ("certificateInfo", "insuredName"), "insured_name", "Insured Name"),
+    ("address", "text", ("certificateInfo", "address"), "address", None),
+    ("description", "text", ("certificateInfo", "description"), "description", None),
+    ("auto_liability_insurance_company", "text", ("automobileLiability", "insuranceCompany"),
+     "auto_liability_company", "Automobile Liability Insurance Company"),
+    ("auto_liability_currency", "currency", ("automobileLiability", "currency"),
+     "auto_liability_currency", "Automobile Liability Currency"),
+    ("auto_liability_amount", "amount", ("automobileLiability", "amount"),
+     "auto_liability_amount", "Automobile Liability Amount"),
+    ("auto_liability_ded_currency", "currency", ("automobileLiability", "deductibleCurrency"),
+     "auto_liability_ded_currency", "Automobile Liability DED. Currency"),
+    ("auto_liability_ded_amount", "amount", ("automobileLiability", "deductibleAmount"),
+     "auto_liability_ded_amount", "Automobile Liability DED. Amount"),
+    ("auto_liability_expiry_date", "date", ("automobileLiability", "expiryDate"),
+     "auto_liability_expiry", "Automobile Liability Expiry Date (yyyy/mm/dd)"),
+    ("cgl_company", "text", ("commercialGeneralLiability", "insuranceCompany"),
+     "cgl_company", "Each occ Commercial General Liability Insurance Company"),
+    ("cgl_currency", "currency", ("commercialGeneralLiability", "currency"),
+     "cgl_currency", "Each occ Commercial General Liability Currency"),
+    ("cgl_amount", "amount", ("commercialGeneralLiability", "amount"),
+     "cgl_amount", "Each occ Commercial General Liability Amount"),
+    ("cgl_ded_currency", "currency", ("commercialGeneralLiability", "deductibleCurrency"),
+     "cgl_ded_currency", "Each occ Commercial General Liability DED. Currency"),
+    ("cgl_ded_amount", "amount", ("commercialGeneralLiability", "deductibleAmount"),
+     "cgl_ded_amount", "Each occ Commercial General Liability DED. Amount"),
+    ("cgl_expiry", "date", ("commercialGeneralLiability", "expiryDate"),
+     "cgl_expiry", "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)"),
+    ("trailer_company", "text", ("nonOwnedTrailer", "insuranceCompany"),
+     "trailer_company", "Non-owned Trailer Insurance Company"),
+    ("trailer_currency", "currency", ("nonOwnedTrailer", "currency"),
+     "trailer_currency", "Non-owned Trailer Currency"),
+    ("trailer_amount", "amount", ("nonOwnedTrailer", "amount"),
+     "trailer_amount", "Non-owned Trailer Amount"),
+    ("trailer_ded_currency", "currency", ("nonOwnedTrailer", "deductibleCurrency"),
+     "trailer_ded_currency", "Non-owned Trailer DED. Currency"),
+    ("trailer_ded_amount", "amount", ("nonOwnedTrailer", "deductibleAmount"),
+     "trailer_ded_amount", "Non-owned Trailer DED. Amount"),
+    ("trailer_expiry", "date", ("nonOwnedTrailer", "expiryDate"),
+     "trailer_expiry", "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)"),
+    ("additional_insured", "text", ("other", "additionalInsured"), "additional_insured", "Additional insured"),
+    ("certificate_holder", "text", ("other", "certificateHolder"), "certificate_holder", "Certificate Holder"),
+    ("cancellation_period", "days", ("other", "cancellationNoticePeriod"),
+     "cancellation_period", "Cancellation Notice Period (days)"),
+]
+
+# Generated mappings between the nested schema, the form and the certificates table
+FORM_WIDGET_KEYS = {f"{attribute}_value": widget for attribute, _, _, widget, _ in CERTIFICATE_FIELDS}
+FORM_VALUE_TO_EXPORT_COLUMN = {f"{attribute}_value": column for attribute, _, _, _, column in CERTIFICATE_FIELDS if column}
+CERTIFICATE_COLUMNS = ["Template Form", "Page Count", "Name of file"] + [
+    column for column in FORM_VALUE_TO_EXPORT_COLUMN.values() if column != "Template Form"
+]
+
+FIELD_KIND_TYPES = {
+    "text": str,
+    "date": date | FieldMarker | None,
+    "amount": decimal.Decimal | FieldMarker | None,
+    "currency": Currency | FieldMarker | None,
+    "days": int | FieldMarker | None,
+}
+
+# Slotted, so a record costs one fixed-size object instead of a 30-key dict of strings.
+# ``unparsed`` keeps the text of typed fields that don't survive a parse/format round trip.
+CertificateRecord = dataclasses.make_dataclass(
+    "CertificateRecord",
+    [("file_name", str, dataclasses.field(default="")), ("page_count", int, dataclasses.field(default=1))]
+    + [(attribute, FIELD_KIND_TYPES[kind], dataclasses.field(default="" if kind == "text" else None))
+       for attribute, kind, _, _, _ in CERTIFICATE_FIELDS]
+    + [("unparsed", dict | None, dataclasses.field(default=None))],
+    slots=True,
+)
+
+def parse_field_value(kind, text):
+    """Typed value of a form string; raises ValueError for text the kind can't represent."""
+    if text == "":
+        return None
+    if text in ("missing", "[unclear]"):
+        return FieldMarker(text)
+    if kind == "date":
+        return datetime.strptime(text, "%Y/%m/%d").date()
+    if kind == "amount":
+        try:
+            amount = decimal.Decimal(text)
+        except decimal.InvalidOperation:
+            raise ValueError(text) from None
+        # Must fit the decimal128(18, 2) column of records_arrow
+        if not amount.is_finite() or amount.as_tuple().exponent < -2 or abs(amount) >= 10 ** 16:
+            raise ValueError(text)
+        return amount
+    if kind == "currency":
+        return Currency(text)
+    days = int(text)
+    if not 0 <= days <= 9999:
+        raise ValueError(text)
+    return days
+
+def format_field_value(kind, value):
+    if value is None:
+        return ""
+    if isinstance(value, FieldMarker | Currency):
+        return value.value
+    if kind == "date":
+        return value.strftime("%Y/%m/%d")
+    return str(value)
+
+def record_from_form(form_values, file_name="", page_count=1):
+    """A record from form values (strings); every value comes back unchanged from record_form_values."""
+    values, unparsed = {}, {}
+    for attribute, kind, _, _, _ in CERTIFICATE_FIELDS:
+        text = form_values.get(f"{attribute}_value", "")
+        text = str(text) if isinstance(text, (int, float)) else (text or "")
+        if kind == "text":
+            values[attribute] = text
+            continue
+        try:
+            value = parse_field_value(kind, text)
+            if format_field_value(kind, value) != text:
+                raise ValueError(text)
+            values[attribute] = value
+        except ValueError:
+            unparsed[attribute] = text
+    return CertificateRecord(file_name=file_name, page_count=int(page_count), unparsed=unparsed or None, **values)
+
+def record_from_structured(structured_data, file_name="", page_count=1):
+    return record_from_form(flatten_structured_data(structured_data), file_name, page_count)
+
+def record_form_values(record):
+    """Form values (strings) of a record."""
+    unparsed = record.unparsed or {}
+    return {
+        f"{attribute}_value": unparsed[attribute] if attribute in unparsed
+        else format_field_value(kind, getattr(record, attribute))
+        for attribute, kind, _, _, _ in CERTIFICATE_FIELDS
+    }
+
+def record_structured(record):
+    """The nested schema of a record, with the form's strings as values."""
+    form_values = record_form_values(record)
+    structured = {}
+    for attribute, _, (section, field), _, _ in CERTIFICATE_FIELDS:
+        structured.setdefault(section, {})[field] = form_values[f"{attribute}_value"]
+    return structured
+
+def record_columns(records):
+    """{attribute: values} over a batch, transposed in one pass."""
+    attributes = ["file_name", "page_count"] + [attribute for attribute, _, _, _, _ in CERTIFICATE_FIELDS]
+    rows = list(map(operator.attrgetter(*attributes), records))
+    return dict(zip(attributes, map(list, zip(*rows)))) if rows else {attribute: [] for attribute in attributes}
+
+def records_frame(records):
+    """Certificates-table rows (export columns, all strings) for a batch of records."""
+    columns = record_columns(records)
+    frame = {"Page Count": [str(count) for count in columns["page_count"]], "Name of file": columns["file_name"]}
+    for attribute, kind, _, _, column in CERTIFICATE_FIELDS:
+        if column:
+            values = columns[attribute]
+            if kind == "amount":
+                # Equal decimals can differ in scale (2000000 and 2000000.00), so no memo here
+                values = [format_field_value(kind, value) for value in values]
+            elif kind != "text":
+                # Certificates repeat the same few dates, currencies and notice periods; format each once
+                formatted = {value: format_field_value(kind, value) for value in set(values)}
+                values = list(map(formatted.__getitem__, values))
+            frame[column] = values
+    # Text that didn't parse is put back as it was typed
+    for row, record in enumerate(records):
+        for attribute, text in (record.unparsed or {}).items():
+            column = FORM_VALUE_TO_EXPORT_COLUMN.get(f"{attribute}_value")
+            if column:
+                frame[column][row] = text
+    return pd.DataFrame(frame, columns=CERTIFICATE_COLUMNS)
+
+def records_arrow(records):
+    """
+    Typed Arrow table of a batch: dates as date32, amounts as decimals, currencies dictionary-encoded.
+    Markers and unparsed text are nulls here; records_frame keeps them.
+    """
+    import pyarrow as pa
+
+    columns = record_columns(records)
+    arrays = {"Name of file": pa.array(columns["file_name"], pa.string()),
+              "Page Count": pa.array(columns["page_count"], pa.int32())}
+    for attribute, kind, _, _, _ in CERTIFICATE_FIELDS:
+        values = columns[attribute]
+        if kind == "text":
+            arrays[attribute] = pa.array(values, pa.string())
+            continue
+        values = [None if isinstance(value, FieldMarker) else value for value in values]
+        if kind == "date":
+            arrays[attribute] = pa.array(values, pa.date32())
+        elif kind == "amount":
+            arrays[attribute] = pa.array(values, pa.decimal128(18, 2))
+        elif kind == "currency":
+            arrays[attribute] = pa.array([value.value if value else None for value in values], pa.string()).dictionary_encode()
+        else:
+            arrays[attribute] = pa.array(values, pa.int16())
+    return pa.table(arrays)
 
 # Configure page layout
 st.set_page_config(page_title="Insurance Certificate Classifier", page_icon="📜", layout="wide")
@@ -28,100 +269,703 @@ if 'api_configured' not in st.session_state:
     st.session_state.api_configured = False
     st.session_state.endpoint = endpoint
     st.session_state.api_key = api_key
+    st.session_state.fast_endpoint = os.getenv("AZURE_OPENAI_FAST_ENDPOINT", "")
+    st.session_state.fast_api_key = os.getenv("AZURE_OPENAI_FAST_API_KEY", "")
     
-# Create folders for processing
-if 'temp_dir' not in st.session_state:
-    st.session_state.temp_dir = tempfile.mkdtemp()
-    st.session_state.pdf_folder = os.path.join(st.session_state.temp_dir, "pdfs")
-    st.session_state.image_folder = os.path.join(st.session_state.temp_dir, "images")
-    os.makedirs(st.session_state.pdf_folder, exist_ok=True)
-    os.makedirs(st.session_state.image_folder, exist_ok=True)
-
 # Initialize session state for storing certificates
 if 'certificates' not in st.session_state:
-    st.session_state.certificates = pd.DataFrame(columns=[
-        'Template Form', 'Page Count', 'Name of file',
-        'Automobile Liability Insurance Company', 'Automobile Liability Currency',
-        'Automobile Liability Amount', 'Automobile Liability DED. Currency',
-        'Automobile Liability DED. Amount', 'Automobile Liability Expiry Date (yyyy/mm/dd)',
-        'Each occ Commercial General Liability Insurance Company', 'Each occ Commercial General Liability Currency',
-        'Each occ Commercial General Liability Amount', 'Each occ Commercial General Liability DED. Currency',
-        'Each occ Commercial General Liability DED. Amount', 'Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)',
-        'Non-owned Trailer Insurance Company', 'Non-owned Trailer Currency',
-        'Non-owned Trailer Amount', 'Non-owned Trailer DED. Currency',
-        'Non-owned Trailer DED. Amount', 'Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)',
-        'Additional insured', 'Certificate Holder', 'Cancellation Notice Period (days)'
-    ])
+    st.session_state.certificates = pd.DataFrame(columns=CERTIFICATE_COLUMNS)
 
 # Initialize form values in session state
 if 'form_values' not in st.session_state:
-    st.session_state.form_values = {
-        'template_form_value': "",
-        'cert_number_value': "",
-        'effective_date_value': "",
-        'expiration_date_value': "",
-        'insured_name_value': "",
-        'address_value': "",
-        'description_value': "",
-        'auto_liability_insurance_company_value': "",
-        'auto_liability_currency_value': "",
-        'auto_liability_amount_value': "",
-        'auto_liability_ded_currency_value': "",
-        'auto_liability_ded_amount_value': "",
-        'auto_liability_expiry_date_value': "",
-        'cgl_company_value': "",
-        'cgl_currency_value': "",
-        'cgl_amount_value': "",
-        'cgl_ded_currency_value': "",
-        'cgl_ded_amount_value': "",
-        'cgl_expiry_value': "",
-        'trailer_company_value': "",
-        'trailer_currency_value': "",
-        'trailer_amount_value': "",
-        'trailer_ded_currency_value': "",
-        'trailer_ded_amount_value': "",
-        'trailer_expiry_value': "",
-        'additional_insured_value': "",
-        'certificate_holder_value': "",
-        'cancellation_period_value': ""
-    }
+    st.session_state.form_values = dict.fromkeys(FORM_WIDGET_KEYS, "")
+
+# --------------------- Scratch Spool ---------------------
+
+# Scratch files live on /dev/shm (RAM-backed) when the host has it
+SPOOL_ROOT = os.getenv("CERT_SPOOL_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "certificate_spool"
+)
+SPOOL_TOTAL_QUOTA_BYTES = int(os.getenv("CERT_SPOOL_TOTAL_QUOTA_MB", "2048")) * 1024 * 1024
+SPOOL_JOB_QUOTA_BYTES = int(os.getenv("CERT_SPOOL_JOB_QUOTA_MB", "512")) * 1024 * 1024
+SPOOL_PAGE_CACHE_BYTES = int(os.getenv("CERT_SPOOL_PAGE_CACHE_MB", "256")) * 1024 * 1024
+SPOOL_SESSION_TTL_SECONDS = int(os.getenv("CERT_SPOOL_SESSION_TTL", "3600"))
+
+class SpoolQuotaExceeded(Exception):
+    """Raised when a job would push the spool past its per-job or total size quota."""
+
+class SpoolJob:
+    """Scratch directory for one document, removed when the job finishes."""
+
+    def __init__(self, spool, session_id):
+        self.spool = spool
+        self.session_id = session_id
+        self.job_id = uuid.uuid4().hex
+        self.path = os.path.join(spool.session_dir(session_id), self.job_id)
+        self.pdf_folder = os.path.join(self.path, "pdfs")
+        self.image_folder = os.path.join(self.path, "images")
+        self.bytes_used = 0
+        os.makedirs(self.pdf_folder, exist_ok=True)
+        os.makedirs(self.image_folder, exist_ok=True)
+
+    def account(self, paths):
+        """Charge files written by third-party code (e.g. pdf2image output) to the job."""
+        self.spool.reserve(self, sum(os.path.getsize(path) for path in paths))
+
+class Spool:
+    """
+    Bounded scratch area shared by every session in the process.
+    Layout: <root>/<pid>/<session id>/<job id>/{pdfs,images}. Jobs are deleted on completion,
+    sessions idle longer than the TTL are swept least-recently-used first, and
+    preprocessed pages are kept as in-memory PNG buffers in a byte-bounded LRU cache.
+    """
+
+    def __init__(self, root, total_quota, job_quota, page_cache_bytes, session_ttl):
+        self.root = root
+        self.total_quota = total_quota
+        self.job_quota = job_quota
+        self.page_cache_bytes = page_cache_bytes
+        self.session_ttl = session_ttl
+        self.lock = threading.RLock()
+        self.sessions = collections.OrderedDict()  # session id -> last use, oldest first
+        self.active_jobs = {}  # job id -> SpoolJob
+        self.bytes_used = 0
+        self.pages = collections.OrderedDict()  # content key -> list of PNG bytes
+        self.page_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "jobs": 0, "swept_sessions": 0, "quota_rejections": 0}
+        os.makedirs(root, exist_ok=True)
+        self.remove_dead_process_spools()
+
+    def remove_dead_process_spools(self):
+        """Spools are per process (<base>/<pid>); delete the ones left behind by dead processes."""
+        base = os.path.dirname(self.root)
+        for name in os.listdir(base):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+            except PermissionError:
+                pass
+
+    def session_dir(self, session_id):
+        path = os.path.join(self.root, session_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def touch(self, session_id):
+        """Mark a session as active and sweep the ones that have been abandoned."""
+        with self.lock:
+            self.sessions[session_id] = time.time()
+            self.sessions.move_to_end(session_id)
+        self.sweep()
+        return self.session_dir(session_id)
+
+    @contextlib.contextmanager
+    def job(self, session_id):
+        """Per-document scratch area; everything in it is deleted when the block exits."""
+        self.touch(session_id)
+        job = SpoolJob(self, session_id)
+        with self.lock:
+            self.active_jobs[job.job_id] = job
+            self.stats["jobs"] += 1
+        try:
+            yield job
+        finally:
+            with self.lock:
+                del self.active_jobs[job.job_id]
+                self.bytes_used -= job.bytes_used
+            shutil.rmtree(job.path, ignore_errors=True)
+
+    def reserve(self, job, nbytes):
+        with self.lock:
+            if self.bytes_used + nbytes > self.total_quota:
+                self.sweep(force=True)
+            if job.bytes_used + nbytes > self.job_quota or self.bytes_used + nbytes > self.total_quota:
+                self.stats["quota_rejections"] += 1
+                raise SpoolQuotaExceeded(
+                    f"Scratch quota exceeded: job would use {(job.bytes_used + nbytes) / 1e6:.1f} MB "
+                    f"(limit {self.job_quota / 1e6:.0f} MB), spool {(self.bytes_used + nbytes) / 1e6:.1f} MB "
+                    f"(limit {self.total_quota / 1e6:.0f} MB)"
+                )
+            job.bytes_used += nbytes
+            self.bytes_used += nbytes
+
+    def sweep(self, force=False):
+        """
+        Remove sessions idle for longer than the TTL. With ``force`` (the spool is full),
+        also drop the page cache and idle sessions least-recently-used first.
+        """
+        with self.lock:
+            busy = {job.session_id for job in self.active_jobs.values()}
+            now = time.time()
+            expired = [sid for sid, last_used in self.sessions.items()
+                       if sid not in busy and (force or now - last_used > self.session_ttl)]
+            for session_id in expired:
+                del self.sessions[session_id]
+                shutil.rmtree(os.path.join(self.root, session_id), ignore_errors=True)
+                self.stats["swept_sessions"] += 1
+            if force:
+                self.pages.clear()
+                self.page_bytes = 0
+
+    def cached_pages(self, key):
+        with self.lock:
+            pages = self.pages.get(key)
+            if pages is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.pages.move_to_end(key)
+            return pages
+
+    def cache_pages(self, key, pages):
+        size = sum(len(page) for page in pages)
+        if size > self.page_cache_bytes:
+            return
+        with self.lock:
+            if key in self.pages:
+                return
+            self.pages[key] = pages
+            self.page_bytes += size
+            while self.page_bytes > self.page_cache_bytes:
+                _, evicted = self.pages.popitem(last=False)
+                self.page_bytes -= sum(len(page) for page in evicted)
+
+    def snapshot(self):
+        """Disk use, quotas and cache statistics for the settings tab."""
+        disk_bytes = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                try:
+                    disk_bytes += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                root=self.root,
+                disk_mb=round(disk_bytes / 1e6, 2),
+                reserved_mb=round(self.bytes_used / 1e6, 2),
+                quota_mb=round(self.total_quota / 1e6, 2),
+                page_cache_mb=round(self.page_bytes / 1e6, 2),
+                hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                sessions=len(self.sessions),
+                active_jobs=len(self.active_jobs),
+            )
+
+@st.cache_resource
+def get_spool():
+    """Process-wide scratch spool."""
+    return Spool(os.path.join(SPOOL_ROOT, str(os.getpid())), SPOOL_TOTAL_QUOTA_BYTES, SPOOL_JOB_QUOTA_BYTES,
+                 SPOOL_PAGE_CACHE_BYTES, SPOOL_SESSION_TTL_SECONDS)
+
+# --------------------- Session Memory ---------------------
+
+# Sessions idle this long are offloaded to disk; so are the least recently used idle ones while
+# the accounted total is over budget. Offloaded entries come back on the session's next rerun,
+# full or fragment.
+SESSION_IDLE_SECONDS = int(os.getenv("CERT_SESSION_IDLE_SECONDS", "1800"))
+SESSION_MIN_IDLE_SECONDS = int(os.getenv("CERT_SESSION_MIN_IDLE_SECONDS", "60"))
+SESSION_MEMORY_BUDGET_BYTES = int(os.getenv("CERT_SESSION_MEMORY_BUDGET_MB", "512")) * 1024 * 1024
+SESSION_SWEEP_SECONDS = 30
+# On disk rather than next to the spool, which may be RAM-backed
+SESSION_OFFLOAD_DIR = os.getenv("CERT_SESSION_OFFLOAD_DIR") or os.path.join(tempfile.gettempdir(), "certificate_sessions")
+# App-owned entries that may be offloaded; widget values stay in memory, Streamlit manages those.
+# The queued-jobs poller reads queued_jobs and queued_failures every few seconds, so they stay too.
+SESSION_OFFLOAD_KEYS = [
+    "certificates", "batch_results", "last_structured_data", "form_values", "excel_cache",
+    "compliance_cache", "ledger", "ledger_merge", "document_anomalies",
+]
+
+def approximate_size(value, depth=0):
+    """Rough in-memory size of a session value in bytes: DataFrames and arrays exactly, containers recursively."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if depth > 6 or isinstance(value, (str, bytes, bytearray)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(approximate_size(key, depth + 1) + approximate_size(item, depth + 1) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(approximate_size(item, depth + 1) for item in value)
+    if hasattr(value, "__dict__"):
+        return size + approximate_size(vars(value), depth + 1)
+    return size
+
+def directory_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+class SessionRegistry:
+    """
+    Every session of the process with its last activity, approximate memory and scratch files.
+    A background sweep pickles the offloadable entries of idle sessions to disk and drops them
+    from the session; touch() at the start of the session's next rerun or fragment rerun puts
+    them back. Offloading holds the session state's lock, so no script statement sees half of it.
+    Sessions are held by weak reference, so closed ones disappear with their offload files.
+    """
+
+    def __init__(self, offload_dir, idle_seconds, min_idle_seconds, budget_bytes):
+        self.offload_dir = offload_dir
+        self.idle_seconds = idle_seconds
+        self.min_idle_seconds = min_idle_seconds
+        self.budget_bytes = budget_bytes
+        self.lock = threading.RLock()
+        # session id -> {"state", "safe_state", "last_active", "offloaded", "offloaded_bytes", "sizes"}
+        self.sessions = {}
+        self.stats = {"offloads": 0, "restores": 0, "offloaded_mb": 0.0, "last_sweep_ms": 0.0}
+        os.makedirs(offload_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(SESSION_SWEEP_SECONDS)
+            try:
+                self.sweep()
+            except Exception:
+                traceback.print_exc()
+
+    def touch(self):
+        """
+        Mark the running session active, restoring its entries if they were offloaded.
+        Call before anything reads the session: at the top of main() and of every fragment.
+        """
+        ctx = get_script_run_ctx()
+        state = getattr(ctx.session_state, "_state", None) if ctx else None
+        if state is None:
+            return
+        with self.lock:
+            entry = self.sessions.get(ctx.session_id)
+            if entry is None or entry["state"]() is not state:
+                entry = self.sessions[ctx.session_id] = {
+                    "state": weakref.ref(state), "offloaded": None, "offloaded_bytes": 0, "sizes": {},
+                }
+            # Each script runner wraps the state in its own SafeSessionState; offload() takes its lock
+            entry["safe_state"] = weakref.ref(ctx.session_state)
+            entry["last_active"] = time.time()
+            if entry["offloaded"]:
+                with ctx.session_state._lock:
+                    self.restore(entry)
+
+    def offload_path(self, session_id):
+        return os.path.join(self.offload_dir, f"{session_id}.pkl")
+
+    def offload(self, session_id, entry):
+        state = entry["state"]()
+        safe_state = entry["safe_state"]()
+        with safe_state._lock if safe_state is not None else contextlib.nullcontext():
+            values = {}
+            for key in SESSION_OFFLOAD_KEYS:
+                if key in state:
+                    try:
+                        values[key] = pickle.dumps(state[key], protocol=pickle.HIGHEST_PROTOCOL)
+                    except Exception:
+                        # Kept in memory; nothing else about the session depends on it being offloaded
+                        continue
+            if not values:
+                return
+            path = self.offload_path(session_id)
+            with open(path, "wb") as f:
+                pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for key in values:
+                del state[key]
+        entry["offloaded"] = path
+        entry["offloaded_bytes"] = os.path.getsize(path)
+        entry["sizes"] = {}
+        self.stats["offloads"] += 1
+        self.stats["offloaded_mb"] = round(self.stats["offloaded_mb"] + entry["offloaded_bytes"] / 1e6, 2)
+
+    def restore(self, entry):
+        state = entry["state"]()
+        with open(entry["offloaded"], "rb") as f:
+            values = pickle.load(f)
+        for key, value in values.items():
+            state[key] = pickle.loads(value)
+        os.remove(entry["offloaded"])
+        entry["offloaded"], entry["offloaded_bytes"] = None, 0
+        self.stats["restores"] += 1
+
+    def account(self, entry):
+        """Approximate bytes per session_state entry; a session mutated mid-count keeps its previous sizes."""
+        state = entry["state"]()
+        try:
+            entry["sizes"] = {key: approximate_size(value) for key, value in state.filtered_state.items()}
+        except RuntimeError:
+            pass
+        return sum(entry["sizes"].values())
+
+    def sweep(self):
+        """Drop closed sessions, offload idle ones, then the least recently used while over budget."""
+        start = time.perf_counter()
+        now = time.time()
+        spool = get_spool()
+        with spool.lock:
+            # Extracting sessions may not rerun for minutes, but they are far from idle
+            busy = {job.session_id for job in spool.active_jobs.values()}
+        # Neither are sessions whose upload is waiting for, or between, extraction slots
+        busy |= get_admission_scheduler().active_sessions()
+        with self.lock:
+            for session_id, entry in list(self.sessions.items()):
+                if entry["state"]() is None:
+                    if entry["offloaded"]:
+                        with contextlib.suppress(OSError):
+                            os.remove(entry["offloaded"])
+                    del self.sessions[session_id]
+            resident = {session_id: self.account(entry) for session_id, entry in self.sessions.items()
+                        if not entry["offloaded"] and session_id not in busy}
+            total = sum(resident.values())
+            for session_id in sorted(resident, key=lambda session_id: self.sessions[session_id]["last_active"]):
+                idle = now - self.sessions[session_id]["last_active"]
+                if idle > self.idle_seconds or (total > self.budget_bytes and idle > self.min_idle_seconds):
+                    self.offload(session_id, self.sessions[session_id])
+                    total -= resident[session_id]
+            self.stats["last_sweep_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def frame(self):
+        """One row per session for the admin view; sizes are as of the last sweep (the caller's are fresh)."""
+        spool = get_spool()
+        current = current_session_id()
+        rows = []
+        with self.lock:
+            for session_id, entry in self.sessions.items():
+                if entry["state"]() is None:
+                    continue
+                if session_id == current:
+                    self.account(entry)
+                largest = sorted(entry["sizes"].items(), key=lambda item: item[1], reverse=True)[:3]
+                rows.append({
+                    "Session": session_id[:8] + (" (you)" if session_id == current else ""),
+                    "Idle (s)": round(time.time() - entry["last_active"]),
+                    "State MB": round(sum(entry["sizes"].values()) / 1e6, 2),
+                    "Temp files MB": round(directory_bytes(os.path.join(spool.root, session_id)) / 1e6, 2),
+                    "Offloaded MB": round(entry["offloaded_bytes"] / 1e6, 2),
+                    "Largest entries": ", ".join(f"{key} {size / 1e3:.0f} KB" for key, size in largest),
+                })
+        return pd.DataFrame(rows)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, sessions=len(self.sessions),
+                        offloaded_sessions=sum(1 for entry in self.sessions.values() if entry["offloaded"]),
+                        idle_seconds=self.idle_seconds, budget_mb=self.budget_bytes // 2**20)
+
+@st.cache_resource
+def get_session_registry():
+    """Process-wide session registry."""
+    return SessionRegistry(os.path.join(SESSION_OFFLOAD_DIR, str(os.getpid())), SESSION_IDLE_SECONDS,
+                           SESSION_MIN_IDLE_SECONDS, SESSION_MEMORY_BUDGET_BYTES)
+
+# --------------------- Ingestion ---------------------
+
+INGEST_CHUNK_BYTES = 1024 * 1024
+RSS_SAMPLE_SECONDS = 0.05
+INGEST_HISTORY_SIZE = 50
+
+class IngestedDocument:
+    """An upload written once into a spool job; later stages read it by path instead of holding bytes."""
+
+    def __init__(self, job, path, name, size, sha1):
+        self.job = job
+        self.path = path
+        self.name = name
+        self.size = size
+        self.sha1 = sha1
+
+    @property
+    def is_pdf(self):
+        return self.name.lower().endswith('.pdf')
+
+class RssMonitor:
+    """Samples the process RSS in a background thread while a document is being processed."""
+
+    def __init__(self):
+        self.process = psutil.Process()
+        self.baseline = self.peak = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    @property
+    def peak_delta(self):
+        """Peak growth over the baseline; the process is shared, so concurrent sessions add to it."""
+        return self.peak - self.baseline
+
+def upload_buffer(source):
+    """
+    Zero-copy view of an upload: Streamlit UploadedFile/BytesIO, bytes or any buffer.
+    getvalue() hands back the BytesIO's initial bytes object as long as it was never written to,
+    whereas getbuffer() would unshare (copy) it.
+    """
+    if hasattr(source, "getvalue"):
+        source = source.getvalue()
+    return memoryview(source).cast("B")
+
+def write_buffer(view, path):
+    """Write a buffer to ``path`` in fixed-size chunks; returns its SHA-1."""
+    digest = hashlib.sha1()
+    with open(path, "wb") as f:
+        for offset in range(0, view.nbytes, INGEST_CHUNK_BYTES):
+            chunk = view[offset:offset + INGEST_CHUNK_BYTES]
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def ingest_document(job, source, file_name):
+    """Write an upload into the job in fixed-size chunks, hashing it on the way."""
+    view = upload_buffer(source)
+    try:
+        job.spool.reserve(job, view.nbytes)
+        base_name = os.path.basename(file_name)
+        folder = job.pdf_folder if base_name.lower().endswith('.pdf') else job.image_folder
+        path = os.path.join(folder, base_name)
+        return IngestedDocument(job, path, base_name, view.nbytes, write_buffer(view, path))
+    finally:
+        view.release()
+
+@st.cache_resource
+def get_ingest_stats():
+    """Process-wide history of recent uploads with their size and peak RSS growth."""
+    return {"lock": threading.Lock(), "uploads": collections.deque(maxlen=INGEST_HISTORY_SIZE), "peak_rss_mb": 0.0}
+
+def record_ingestion(document, monitor, seconds):
+    stats = get_ingest_stats()
+    with stats["lock"]:
+        stats["uploads"].append({
+            "File": document.name,
+            "Size (MB)": round(document.size / 1e6, 2),
+            "Peak RSS growth (MB)": round(monitor.peak_delta / 1e6, 2),
+            "Seconds": round(seconds, 2),
+        })
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], round(monitor.peak / 1e6, 2))
+
+def ingest_stats_frame():
+    stats = get_ingest_stats()
+    with stats["lock"]:
+        return pd.DataFrame(list(stats["uploads"]), columns=["File", "Size (MB)", "Peak RSS growth (MB)", "Seconds"])
+
+# --------------------- PDF Backends ---------------------
+
+# pymupdf renders and reads text in-process; poppler shells out to pdftoppm and reads text with PyPDF2
+PDF_BACKEND = os.getenv("CERT_PDF_BACKEND", "pymupdf")
+
+class PageImages:
+    """
+    Pages of one document as numpy arrays (RGB, or single-channel when grayscale), loaded on
+    demand so only one page is held at a time; ``files`` lists what was written to disk.
+    """
+
+    def __init__(self, count, load, files=()):
+        self.count = count
+        self.load = load
+        self.files = list(files)
+        self.last = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        # Relevance checks and rendering ask for the same page back to back
+        if self.last[0] != index:
+            self.last = (index, self.load(index))
+        return self.last[1]
+
+def read_page_file(path, grayscale):
+    if grayscale:
+        return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    with Image.open(path) as image:
+        return np.array(image.convert("RGB"))
+
+def image_file_pages(path, grayscale):
+    """An uploaded photo or scan as a one-page document."""
+    return PageImages(1, lambda index: read_page_file(path, grayscale))
+
+class PdfBackend(abc.ABC):
+    """Reads the text layer of PDFs and rasterizes their pages."""
+
+    name = None
+
+    @abc.abstractmethod
+    def page_texts(self, source):
+        """Text of each page (empty strings for scanned pages); ``source`` is a path or bytes."""
+
+    @abc.abstractmethod
+    def render(self, path, output_folder, dpi, grayscale):
+        """The pages of the PDF at ``path`` as a PageImages sequence."""
+
+class PyMuPDFBackend(PdfBackend):
+    """
+    MuPDF in-process: pages are rasterized straight into numpy arrays in the requested
+    colorspace, and text is assembled from layout blocks in reading order.
+    """
+
+    name = "pymupdf"
+
+    def __init__(self):
+        import fitz
+        self.fitz = fitz
+
+    def open(self, source):
+        return self.fitz.open(source) if isinstance(source, str) else self.fitz.open(stream=source, filetype="pdf")
+
+    def page_blocks(self, source):
+        """Per page, the text blocks as (x0, y0, x1, y1, text) sorted top-to-bottom, left-to-right."""
+        with self.open(source) as document:
+            return [[block[:5] for block in page.get_text("blocks", sort=True) if block[6] == 0]
+                    for page in document]
+
+    def page_texts(self, source):
+        return ["\n".join(block[4].strip() for block in blocks) for blocks in self.page_blocks(source)]
+
+    def render(self, path, output_folder, dpi, grayscale):
+        colorspace = self.fitz.csGRAY if grayscale else self.fitz.csRGB
+        with self.open(path) as document:
+            count = document.page_count
+
+        def load(index):
+            with self.open(path) as document:
+                pixmap = document[index].get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+            pixels = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+            return pixels[:, :, 0] if grayscale else pixels
+
+        return PageImages(count, load)
+
+class PopplerBackend(PdfBackend):
+    """pdf2image (poppler's pdftoppm subprocess) for pages written to disk, PyPDF2 for text."""
+
+    name = "poppler"
+
+    def page_texts(self, source):
+        import PyPDF2
+
+        # PdfReader copies a path into memory but reads an open file lazily
+        with (open(source, "rb") if isinstance(source, str) else BytesIO(source)) as pdf_file:
+            return [page.extract_text() or "" for page in PyPDF2.PdfReader(pdf_file).pages]
+
+    def render(self, path, output_folder, dpi, grayscale):
+        page_paths, count = convert_pdf_to_images(path, output_folder, dpi=dpi)
+        return PageImages(count, lambda index: read_page_file(page_paths[index], grayscale), files=page_paths)
+
+PDF_BACKENDS = {backend.name: backend for backend in (PyMuPDFBackend, PopplerBackend)}
+
+def build_pdf_backend(name=PDF_BACKEND):
+    """The configured backend; falls back to poppler when PyMuPDF is not installed."""
+    if name not in PDF_BACKENDS:
+        raise ValueError(f"Unknown PDF backend {name}; choose from {', '.join(PDF_BACKENDS)}")
+    try:
+        return PDF_BACKENDS[name]()
+    except ImportError:
+        return PopplerBackend()
+
+def pdf_backend():
+    return resources().get("pdf_backend")
+
+# --------------------- Pipeline Profile ---------------------
 
-# Function to export the data as an Excel file
-def export_to_excel(dataframe):
-    towrite = BytesIO()
-    dataframe.to_excel(towrite, index=False, header=True)
-    towrite.seek(0)  # reset pointer
-    return towrite
+# Rasterization, preprocessing and encoding settings; autotune.py writes a tuned profile to this file
+PIPELINE_PROFILE_PATH = os.getenv("CERT_PIPELINE_PROFILE", "pipeline_profile.json")
+DEFAULT_PIPELINE_PROFILE = {
+    "dpi": 200,
+    "preprocess": "threshold",  # threshold (fixed then adaptive), adaptive, gray or none
+    "fixed_threshold": 200,
+    "fixed_max": 235,
+    "adaptive_block": 21,
+    "adaptive_c": 5,
+    "format": "PNG",  # PNG, JPEG or WEBP
+    "quality": 85,  # JPEG/WEBP only
+    "max_side": 0,  # longest page side in pixels after preprocessing; 0 keeps the rendered size
+}
+PREPROCESS_VARIANTS = ("threshold", "adaptive", "gray", "none")
+PAGE_FORMATS = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def load_pipeline_profile(path=PIPELINE_PROFILE_PATH):
+    """The defaults overlaid with the profile file, when there is one; unknown keys are ignored."""
+    profile = dict(DEFAULT_PIPELINE_PROFILE)
+    if path and os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+        profile.update({key: stored[key] for key in DEFAULT_PIPELINE_PROFILE if key in stored})
+    if profile["preprocess"] not in PREPROCESS_VARIANTS or profile["format"] not in PAGE_FORMATS:
+        raise ValueError(f"Invalid pipeline profile in {path}: {profile}")
+    return profile
+
+def pipeline_profile():
+    return resources().get("pipeline_profile")
+
+def encode_page(image, profile):
+    """Scale a preprocessed page to the profile's size limit and encode it in the profile's format."""
+    if profile["max_side"] and max(image.size) > profile["max_side"]:
+        image = image.copy()
+        image.thumbnail((profile["max_side"], profile["max_side"]), Image.LANCZOS)
+    buffer = BytesIO()
+    if profile["format"] == "PNG":
+        image.save(buffer, "PNG")
+    else:
+        image.convert("L" if image.mode in ("1", "L") else "RGB").save(buffer, profile["format"], quality=profile["quality"])
+    return buffer.getvalue()
+
+def page_mime_type(page):
+    """MIME type of an encoded page buffer, from its signature."""
+    if page[:4] == b"\x89PNG":
+        return "image/png"
+    if page[:2] == b"\xff\xd8":
+        return "image/jpeg"
+    if page[:4] == b"RIFF" and page[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
 
 # --------------------- Image Preprocessing Functions ---------------------
 
-def convert_pdf_to_images(pdf_path, output_folder):
-    """Step 1: PDF → Image"""
+def convert_pdf_to_images(pdf_path, output_folder, dpi=None):
+    """Step 1: PDF → Image (pages are written straight to disk, never held in memory together)"""
     try:
         import pdf2image
-        images = pdf2image.convert_from_path(pdf_path)
-        image_paths = []
-        for i, image in enumerate(images):
-            image_path = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page_{i + 1}.png")
-            image.save(image_path, "PNG")
-            image_paths.append(image_path)
-        return image_paths, len(images)
+        image_paths = pdf2image.convert_from_path(
+            pdf_path, dpi=dpi or pipeline_profile()["dpi"], output_folder=output_folder, fmt="png", paths_only=True,
+            output_file=f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page"
+        )
+        return image_paths, len(image_paths)
     except Exception as e:
         st.error(f"Error converting PDF to images: {e}")
         return [], 0
 
-def preprocess_image(image):
+def preprocess_image(image, profile=None):
     """
     Improve image quality for OCR:
-      - Convert to OpenCV format and grayscale.
+      - Convert to grayscale (pages rendered in gray are used as they are).
       - Find external contours and crop to the largest contour.
       - Apply fixed threshold then adaptive thresholding.
+    ``image`` is a PIL image or a numpy array (RGB or single-channel).
+    The pipeline profile picks the thresholds and which of these steps run.
     """
-    # Convert PIL image to OpenCV format (RGB to BGR)
-    open_cv_image = np.array(image)
-    open_cv_image = cv2.cvtColor(open_cv_image, cv2.COLOR_RGB2BGR)
-    # Convert to grayscale
-    gray = cv2.cvtColor(open_cv_image, cv2.COLOR_BGR2GRAY)
+    profile = profile or pipeline_profile()
+    pixels = image if isinstance(image, np.ndarray) else np.array(image.convert("RGB"))
+    gray = pixels if pixels.ndim == 2 else cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
     # Find contours and crop to the largest contour
     contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if contours:
@@ -129,10 +973,17 @@ def preprocess_image(image):
         cnt = cnts_sorted[0]
         x, y, w, h = cv2.boundingRect(cnt)
         gray = gray[y:y+h, x:x+w]
+    if profile["preprocess"] == "none":
+        return Image.fromarray(pixels[y:y+h, x:x+w] if contours else pixels)
+    if profile["preprocess"] == "gray":
+        return Image.fromarray(gray)
     # Apply fixed threshold and adaptive thresholding
-    _, thresh = cv2.threshold(gray, 200, 235, cv2.THRESH_BINARY)
+    thresh = gray
+    if profile["preprocess"] == "threshold":
+        _, thresh = cv2.threshold(gray, profile["fixed_threshold"], profile["fixed_max"], cv2.THRESH_BINARY)
     adaptive_thresh = cv2.adaptiveThreshold(
-        thresh, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 5
+        thresh, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+        profile["adaptive_block"], profile["adaptive_c"]
     )
     processed_image = Image.fromarray(adaptive_thresh)
     return processed_image
@@ -146,18 +997,168 @@ def convert_image_to_base64(image_path):
         base64_encoded_data = base64.b64encode(image_file.read()).decode("utf-8")
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
-def get_raw_text(image_data_url):
+def convert_bytes_to_base64(image_bytes, mime_type=None):
+    """Step 2 for in-memory pages: image buffer → Base64 data URL"""
+    mime_type = mime_type or page_mime_type(image_bytes)
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+# --------------------- Stage Pipeline ---------------------
+
+# Worker threads per page stage; rasterizing stays on one thread since MuPDF documents aren't thread-safe.
+# Extra preprocess/encode workers only pay off with cores to spare (OpenCV and zlib release the GIL).
+PAGE_STAGE_DEFAULT_WORKERS = "2" if (os.cpu_count() or 1) >= 4 else "1"
+PAGE_STAGE_WORKERS = {
+    "rasterize": 1,
+    "preprocess": int(os.getenv("CERT_PREPROCESS_WORKERS", PAGE_STAGE_DEFAULT_WORKERS)),
+    "encode": int(os.getenv("CERT_ENCODE_WORKERS", PAGE_STAGE_DEFAULT_WORKERS)),
+}
+# Pages that may wait between two stages; a full queue blocks the stage feeding it, which bounds memory
+PAGE_QUEUE_CAPACITY = int(os.getenv("CERT_PAGE_QUEUE_CAPACITY", "2"))
+# Render a document's pages while the fast tier's call is in flight, so a vision escalation finds them ready
+PRERENDER_PAGES = os.getenv("CERT_PRERENDER_PAGES", "1") == "1"
+
+def start_thread(target, *args):
+    """A daemon thread that keeps the running script's context, so it can read the session."""
+    thread = threading.Thread(target=profiled(target), args=args, daemon=True)
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        add_script_run_ctx(thread, ctx)
+    thread.start()
+    return thread
+
+def run_in_background(function, *args):
+    """Call ``function`` on its own thread; returns a Future with its result."""
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    start_thread(run)
+    return future
+
+class StagePipeline:
     """
-    Step 3a: Extract raw text (OCR) from the image.
-    The prompt instructs the LLM to return the plain text found in the image.
+    Passes items through named stages, each with its own worker threads, over bounded queues:
+    while one page is being encoded the next is preprocessed and the one after that rasterized.
+    ``stages`` is a list of (name, function, workers). An item that fails skips the remaining
+    stages; run() raises the first failure once every item is through.
     """
-    if not st.session_state.api_configured:
-        st.error("API credentials not configured.")
-        return None
-        
-    
-    # system_prompt = """
-    system_prompt = """
+
+    def __init__(self, name, stages, capacity=PAGE_QUEUE_CAPACITY):
+        self.name = name
+        self.stages = stages
+        self.capacity = capacity
+
+    def run(self, items):
+        """Results of every item, in input order."""
+        items = list(items)
+        if not items:
+            return []
+        # The last queue collects results, so it is left unbounded and the stages can always drain
+        queues = [queue.Queue(maxsize=self.capacity) for _ in self.stages] + [queue.Queue()]
+        done = object()
+        lock = threading.Lock()
+        stats = {name: {"workers": workers, "items": 0, "busy": 0.0, "blocked": 0.0, "queued": 0, "gets": 0, "peak": 0}
+                 for name, _, workers in self.stages}
+        finished = [0] * len(self.stages)
+
+        def worker(position):
+            name, function, _ = self.stages[position]
+            inbound, outbound = queues[position], queues[position + 1]
+            stage = stats[name]
+            while True:
+                waiting = inbound.qsize()
+                item = inbound.get()
+                if item is done:
+                    break
+                index, value, error = item
+                start = time.perf_counter()
+                if error is None:
+                    try:
+                        value = function(value)
+                    except Exception as e:
+                        value, error = None, e
+                busy = time.perf_counter() - start
+                start = time.perf_counter()
+                outbound.put((index, value, error))
+                with lock:
+                    stage["items"] += 1
+                    stage["busy"] += busy
+                    stage["blocked"] += time.perf_counter() - start
+                    stage["queued"] += waiting
+                    stage["gets"] += 1
+                    stage["peak"] = max(stage["peak"], waiting)
+            with lock:
+                finished[position] += 1
+                last = finished[position] == self.stages[position][2]
+            # The stage's last worker to finish tells every worker of the next stage
+            if last and position + 1 < len(self.stages):
+                for _ in range(self.stages[position + 1][2]):
+                    outbound.put(done)
+
+        start = time.perf_counter()
+        threads = [start_thread(worker, position)
+                   for position, (_, _, workers) in enumerate(self.stages) for _ in range(workers)]
+        for item in enumerate(items):
+            queues[0].put((*item, None))
+        for _ in range(self.stages[0][2]):
+            queues[0].put(done)
+        results = {}
+        for _ in items:
+            index, value, error = queues[-1].get()
+            results[index] = (value, error)
+        # Every worker is past its last item; waiting for them lets a document profile collect their time
+        for thread in threads:
+            thread.join()
+        record_stage_stats(self.name, stats, time.perf_counter() - start)
+
+        for index in range(len(items)):
+            if results[index][1] is not None:
+                raise results[index][1]
+        return [results[index][0] for index in range(len(items))]
+
+@st.cache_resource
+def get_stage_stats():
+    """Process-wide per-stage totals of every pipeline run, for tuning worker counts and queue sizes."""
+    return {"lock": threading.Lock(), "stages": {}}
+
+def record_stage_stats(pipeline, stats, elapsed):
+    totals = get_stage_stats()
+    with totals["lock"]:
+        for name, stage in stats.items():
+            total = totals["stages"].setdefault((pipeline, name), {
+                "runs": 0, "workers": 0, "items": 0, "busy": 0.0, "capacity": 0.0, "blocked": 0.0,
+                "queued": 0, "gets": 0, "peak": 0,
+            })
+            total["runs"] += 1
+            total["workers"] = stage["workers"]
+            total["capacity"] += elapsed * stage["workers"]
+            total["peak"] = max(total["peak"], stage["peak"])
+            for key in ("items", "busy", "blocked", "queued", "gets"):
+                total[key] += stage[key]
+
+def stage_stats_frame():
+    """Utilization (busy share of the stage's worker time), queue occupancy and backpressure per stage."""
+    totals = get_stage_stats()
+    with totals["lock"]:
+        return pd.DataFrame([{
+            "Pipeline": pipeline,
+            "Stage": name,
+            "Workers": total["workers"],
+            "Items": total["items"],
+            "Utilization %": round(100 * total["busy"] / total["capacity"], 1) if total["capacity"] else 0.0,
+            "Mean queue": round(total["queued"] / total["gets"], 2) if total["gets"] else 0.0,
+            "Peak queue": total["peak"],
+            "Blocked on full queue (s)": round(total["blocked"], 3),
+        } for (pipeline, name), total in totals["stages"].items()])
+
+# --------------------- Prompts ---------------------
+
+# Built once per process through the resource registry rather than on every call
+VISION_SYSTEM_PROMPT = """
     You are an AI assistant designed to tackle complex tasks with the reasoning capabilities of a human genius. Your goal is to complete user-provided tasks while demonstrating thorough self-evaluation, critical thinking, and the ability to navigate ambiguities. You must only provide a final answer when you are 100% certain of its accuracy.
 
     Here is the task you need to complete:
@@ -171,7 +1172,7 @@ def get_raw_text(image_data_url):
     Key Objectives:
     • Parse multi-page insurance certificates into a single, coherent JSON output.  
     • Precisely extract only the specified data fields; mark all missing or unclear values as instructed.  
-    • Maintain strict adherence to date (yyyy/mm/dd) and numeric formatting rules.  
+    • Copy dates, amounts and currencies exactly as printed; they are normalized after extraction.  
     • Omit all non-insurance, handwritten, or inferred details.
 
     1.2 Critical Requirements:
@@ -180,10 +1181,8 @@ def get_raw_text(image_data_url):
     • Missing fields must be explicitly labeled as "missing"
     • Multi-page documents must be combined into a single structured JSON object
     • No assumptions or inferences: Only extract what is explicitly visible in the PDF. Do not infer, assume, or guess any values not clearly provided. If any data is ambiguous or unclear, mark the field as "[unclear]".
-    • ALL dates MUST be in yyyy/mm/dd format WITHOUT EXCEPTION
     • NEVER extract "bodily injury" amounts
-    • Currency validation: Follow insured name's address currency
-    • Numeric Accuracy: Ensure that numeric values are extracted exactly as they appear. For example, if the PDF shows "10,000," do not change it to "100,000" or vice versa. Remove formatting (such as commas or currency symbols) only after verifying that the underlying digit sequence remains unchanged.
+    • Numeric Accuracy: Copy numeric values exactly as they appear, digit for digit. For example, if the PDF shows "10,000", do not change it to "100,000" or vice versa.
     • Ensure all extracted data is logically consistent
 
     ────────────────────────────────────────────────────────
@@ -236,27 +1235,9 @@ def get_raw_text(image_data_url):
             • If no clear data is found, label all related fields as "missing".
 
     3.2 Insurance Company
-        3.2.1 Automobile Liability Insurance Company:
-            • Extract company name from the "Automobile Liability" or "Auto Liability" section.
-            • Extract only the name, excluding policy numbers.
-            • If a "CO LTR" or "Ins." column exists, reference the FULL company name values.
-        
-        3.2.2 Each occ Commercial General Liability Insurance Company:
-            • Extract company name from the "Commercial General Liability" section.
-            • Extract only the name, excluding policy numbers.
-            • If a "CO LTR" or "Ins." column exists, reference the FULL company name values.
-        
-        3.2.3 Non-Owned Trailer Insurance Company:
-            • Extract company name from the "Non-Owned Trailer" section.
-            • Extract only the name, excluding policy numbers.
-            • If a "CO LTR" or "Ins." column exists, reference the FULL company name values.
-        
-        3.2.4 Multiple Insurers Handling:
-            • Sometimes, there are multiple insurers (e.g., Insurer A, B, C, etc.).
-            • Insurers for each type of insurance are separate; an insurer providing one type does not automatically provide another—check each type individually.
-            • Refer to the "Ins." column if present; if multiple insurers are referenced only by letter (A, B, C, etc.) in the subsequent coverage sections, create a list of insurers and map each letter to the corresponding full insurer name.
-            • **Detailed Insurer Mapping:** If an insurer is referenced by a letter and no corresponding full name is explicitly found in the document, output the letter reference but flag it as "[unclear]" or log it for manual review to avoid misattribution.
-            • Output the name of the insurer, not just the letter, for each insurance type.
+        • For each insurance type, copy the insurer exactly as printed in its row: the company name, or only the letter from the "INSR LTR", "CO LTR" or "Ins." column if that is all the row shows. Names and letters are resolved to canonical insurer names after extraction.
+        • Insurers for each type of insurance are separate; check each type individually.
+        • Copy the insurer table of the certificate (e.g. "INSURER A: ...") into "Insurers" as a letter → name object.
 
     3.3 Amount Extraction
         ⚠️ Extract ONLY the numeric values that are explicitly visible.
@@ -275,12 +1256,8 @@ def get_raw_text(image_data_url):
             ❌ Invalid deductible identifiers:
                 • Non-Owned Trailer Amount for Bodily Injury (DO NOT extract Bodily Injury for Non-Owned Trailer!!!)
             
-        3.3.2 Amount Formatting and Comprehensive Numeric Extraction
-            • Extract numeric values only, ensuring complete fidelity to the raw text extracted earlier.
-            • Remove any currency symbols, commas, or extraneous formatting only after verifying that the underlying digit sequence remains exactly as shown.
-            • Validate that the number’s digit sequence, including decimals if present, is preserved. For example, if the raw text is "10,000", ensure the output is "10000" without altering the digit count.
-            • If any discrepancies or formatting anomalies are detected (e.g., misplaced decimals, extra spaces, or unusual separators), flag the field as "[unclear]" and log the anomaly for further review.
-            • Implement consistency checks on numeric values to ensure that they match expected formats (e.g., no loss of decimal precision or incorrect digit reordering).
+        3.3.2 Amount Formatting
+            • Copy each amount exactly as printed, including commas and currency symbols. Formatting is stripped and validated after extraction.
 
         3.3.3 Field-Specific Rules
             1. Automobile Liability Amount
@@ -351,54 +1328,13 @@ def get_raw_text(image_data_url):
             • In cases where multiple values are present in a single cell (e.g., for other liability), utilize alignment cues and spatial separation (e.g., column delimiters) to correctly separate and extract these values.
             • Reinforce that the insurance deductible is separate for each insurance type; the AI must search on a row-by-row basis. If there is no value for a particular row (for either the coverage amount or the deductible), that field must be tagged as "missing".
 
-    3.4 Currency Assignment
-        Determine Currency Based on Insured’s Address
-        • If the address explicitly indicates a Canadian location (e.g., “Alberta, Canada” or a valid Canadian postal code), set currency to "CAD".
-        • If the address explicitly indicates a United States location (e.g., “Seattle, WA” or a valid U.S. ZIP code), set currency to "USD".
-        • If the address clearly belongs to another country and the currency is explicitly stated (e.g., “GBP” or “EUR” for a UK/EU address), use that currency.
-        • If the address is ambiguous or does not clearly show a specific country, do not infer currency—mark all currency fields as "missing".
+    3.4 Currency and Dates
+        • Copy any currency code or symbol printed next to an amount; otherwise leave the currency field empty. Currencies are assigned from the insured's address after extraction.
+        • Copy every date exactly as printed (e.g. "24/11/15", "11/03/2024"); do not reorder or reformat it. Dates are converted to yyyy/mm/dd after extraction.
+        • Copy the insured's full mailing address into "Insured Address".
 
-        Link Currency to Each Coverage or Deductible
-        • For any coverage or deductible you successfully extract, assign the currency determined above.
-        • If you cannot extract a coverage or deductible value for a particular insurance type (i.e., it is “missing”), then the corresponding currency field must also be "missing".
-
-        No Assumptions, No Inferences
-        • Do not guess currency based on any indirect information (e.g., phone numbers or area codes). If the document does not explicitly confirm Canada, the U.S., or another recognized currency, label the currency as "missing".
-        • If any data is unclear or contradictory, mark it as "[unclear]".
-
-    3.5 Date Parsing and Standardization
-        ⚠️ All extracted dates MUST be converted to yyyy/mm/dd format
-
-            
-        3.5.1 Date Format Rules for Initial Extraction
-            CRITICAL: When you see dates in YY/MM/DD format (like 24/11/15):
-            • The FIRST number is ALWAYS the YEAR
-            • The SECOND number is ALWAYS the MONTH
-            • The THIRD number is ALWAYS the DAY
-            
-            Examples of correct initial extraction:
-            • 24/11/15 should be extracted as 2024/11/15 (NOT 11/24/2015)
-            • 23/05/20 should be extracted as 2023/05/20 (NOT 05/23/2020)
-            • 25/12/31 should be extracted as 2025/12/31 (NOT 12/25/2031)
-            
-            ❌ INCORRECT interpretations:
-            • 24/11/15 as November 24, 2015
-            • 23/05/20 as May 23, 2020
-            • 25/12/31 as December 25, 2031
-            
-            CRITICAL: When you see dates in MM/DD/YYYY format (like 11/03/2024):
-            • The FIRST number is ALWAYS the MONTH
-            • The SECOND number is ALWAYS the DATE
-            • The THIRD number is ALWAYS the YEAR
-            
-            Examples of correct initial extraction:
-            • 11/03/2024 should be extracted as 2024/11/03 (NOT 03/11/2024)
-            
-            ❌ INCORRECT interpretations:
-            • 11/03/2024 as March 11, 2024
-
-    3.6 Additional Fields
-        3.6.1 Certificate Holder
+    3.5 Additional Fields
+        3.5.1 Certificate Holder
             • Look for fields labeled specifically as "Certificate Holder"
             • Also look for text preceded by phrases like "This is to certify to..."
             • If an address is present, include it. If no clear data is found, label as "missing"
@@ -409,7 +1345,7 @@ def get_raw_text(image_data_url):
                 - In a section following "This certificate is issued to..."
                 - In a section starting with "This is to certify to..."
         
-        3.6.2 Additional Insured
+        3.5.2 Additional Insured
             • Labeled ONLY as "Additional Insured". NO OTHER LABELS.
             • ❌ NOT THE SAME AS "CERTIFICATE HOLDER"
             • ❌ NOT THE SAME AS "ADDITIONAL INFORMATION"
@@ -420,7 +1356,7 @@ def get_raw_text(image_data_url):
                 - In a dedicated "Additional Insured" section.
             • If no clear data is found, label as "missing".
 
-    3.7 Handling Missing and Unclear Data
+    3.6 Handling Missing and Unclear Data
         • Explicitly mark missing values as "missing".
         • If a field is unclear across pages, flag it as "[unclear]".
         • No assumptions—only extract what is present.
@@ -433,24 +1369,26 @@ def get_raw_text(image_data_url):
     {
             "Template Form": "[Monarch|Lloyd Sadd|NFP|CSIO|Rogers|Wylie Crump|MHK|Fleet|ACORD|O HUB|All Insurance Ltd.|WESTLAND|Mango Insurance|AON|Goldkey Insurance|Brokerlink|One Insurance|A-KAN|Ing+Mckee|BFL Canada Insurance Services Inc.|Co-Operators|Federated Insurance|Prl|Foster Park|Risktech Insurance Services Inc.|Drayden Insurance|Unknown]",
             "Page Count": "integer",
+            "Insured Address": "string",
+            "Insurers": {"A": "string", "B": "string"},
             "Automobile Liability Insurance Company": "string",
             "Automobile Liability Currency": "string",
             "Automobile Liability Amount": "[integer|string]",
             "Automobile Liability DED. Currency": "string",
             "Automobile Liability DED. Amount": "[integer|string]",                          // NOT THE SAME AS 'NON-OWNED TRAILER DED. AMOUNT'
-            "Automobile Liability Expiry Date (yyyy/mm/dd)": "date",                         // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Automobile Liability Expiry Date (yyyy/mm/dd)": "date",
             "Each occ Commercial General Liability Insurance Company": "string",
             "Each occ Commercial General Liability Currency": "string",
             "Each occ Commercial General Liability Amount": "[integer|string]",
             "Each occ Commercial General Liability DED. Currency": "string",
             "Each occ Commercial General Liability DED. Amount": "[integer|string]",
-            "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": "date",        // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": "date",
             "Non-owned Trailer Insurance Company": "string",
             "Non-owned Trailer Currency": "string",
             "Non-owned Trailer Amount": "[integer|string]",
             "Non-owned Trailer DED. Currency": "string",
             "Non-owned Trailer DED. Amount": "[integer|string]",
-            "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)": "date",                     // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)": "date",
             "Additional insured": "string",
             "Certificate Holder": "string",
             "Cancellation Notice Period (days)": "[integer|string]"
@@ -460,7 +1398,7 @@ def get_raw_text(image_data_url):
     • Mark any field explicitly absent as “missing.”  
     • If the data is visible but unclear, use “[unclear].”  
     • Ensure no extraneous keys are added.  
-    • Numeric accuracy: preserve the exact digit sequence shown, removing commas or currency symbols only after verifying correctness.
+    • Numeric accuracy: preserve the exact digit sequence shown.
 
     ────────────────────────────────────────────────────────
     5. OUTPUT EXAMPLE
@@ -470,24 +1408,26 @@ def get_raw_text(image_data_url):
     {
             "Template Form": "CSIO",
             "Page Count": "2",
-            "Automobile Liability Insurance Company": "ABC Insurance Co.",
+            "Insured Address": "123 Main Street, Toronto, ON M5J 2N8",
+            "Insurers": {"A": "ABC Insurance Co.", "B": "XYZ Insurance", "C": "DEF Insurance"},
+            "Automobile Liability Insurance Company": "A",
             "Automobile Liability Currency": "CAD",
             "Automobile Liability Amount": "500,000.00",
             "Automobile Liability DED. Currency": "CAD",
             "Automobile Liability DED. Amount": "1,000.00",
-            "Automobile Liability Expiry Date (yyyy/mm/dd)": "2025/01/31",                         // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Automobile Liability Expiry Date (yyyy/mm/dd)": "25/01/31",
             "Each occ Commercial General Liability Insurance Company": "XYZ Insurance",
-            "Each occ Commercial General Liability Currency": "USD",
+            "Each occ Commercial General Liability Currency": "CAD",
             "Each occ Commercial General Liability Amount": "1,000,000.00",
-            "Each occ Commercial General Liability DED. Currency": "USD",
+            "Each occ Commercial General Liability DED. Currency": "CAD",
             "Each occ Commercial General Liability DED. Amount": "50,000.00",
-            "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": "2026/01/15",        // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": "2026/01/15",
             "Non-owned Trailer Insurance Company": "DEF Insurance",
             "Non-owned Trailer Currency": "CAD",
             "Non-owned Trailer Amount": "5,000.00",
             "Non-owned Trailer DED. Currency": "CAD",
             "Non-owned Trailer DED. Amount": "750.00",
-            "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)": "2026/06/30",                     // ALWAYS REFER TO Date Parsing and Standardization. STRICT FORMAT: yyyy/mm/dd ONLY
+            "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)": "2026/06/30",
             "Additional insured": "missing",
             "Certificate Holder": "Company XYZ 123 Main Street, Toronto, ON M5J 2N8, Canada",
             "Cancellation Notice Period (days)": "30"
@@ -496,10 +1436,10 @@ def get_raw_text(image_data_url):
     ────────────────────────────────────────────────────────
     6. IMPORTANT NOTES
     ────────────────────────────────────────────────────────
-    • Numeric Integrity: Under no circumstance alter the digit count. For instance, “10,000” should become “10000,” preserving the “10000” sequence precisely.  
+    • Numeric Integrity: Under no circumstance alter the digit count.  
     • Deductible isolation: Avoid mixing coverage amounts with deductibles or referencing the wrong insurance type. Match each deductible to its coverage type.  
     • Non-Owned Trailer Coverage: Strictly exclude bodily injury amounts and “Non-Owned Automobile.” Only capture trailer-specific coverage.  
-    • If multiple insurers appear, map them carefully (e.g., from columns labeled “Insurer A,” “Insurer B,” etc.). Do not guess the full name if only letters are provided—use “[unclear]” for unresolvable insurer names.
+    • If multiple insurers appear, copy the insurer table into "Insurers"; do not guess full names for letters.
 
     ────────────────────────────────────────────────────────
     7. FINAL REMINDERS
@@ -510,7 +1450,7 @@ def get_raw_text(image_data_url):
     • Ensure structure uniformity—every response must match the specified JSON format.
     • Clearly mark missing fields using "missing" instead of leaving fields blank.
     • Strict Numeric Integrity: Preserve numeric values exactly as they appear in the PDF. Any transformation must not alter the actual digits, their count, or their order.
-    • The AI must follow all insurance handling rules and extraction logic as explicitly mentioned in this prompt, including handling each insurance type’s deductible and coverage on a row-by-row basis, separate insurer mapping per insurance type with detailed handling for letter references, and the hard coded logic for overriding corresponding currency fields when amounts are missing.
+    • The AI must follow all insurance handling rules and extraction logic as explicitly mentioned in this prompt, including handling each insurance type’s deductible and coverage on a row-by-row basis, and a separate insurer per insurance type.
 
     </user_task>
 
@@ -562,24 +1502,106 @@ def get_raw_text(image_data_url):
 
     Only if you are absolutely certain of your conclusion, present your final answer in <answer> tags. Your answer must strictly be valid JSON that follows the "OUTPUT STRUCTURE" from <user_task>. Explain why you are confident in this solution.
 """
+
+# Schema expected from the LLM for the text tiers
+TEXT_EXTRACTION_SCHEMA = {
+    "certificateInfo": {
+        "certificateNumber": "string",
+        "templateForm": "string",
+        "effectiveDate": "date (yyyy/mm/dd)",
+        "expirationDate": "date (yyyy/mm/dd)",
+        "insuredName": "string",
+        "address": "string",
+        "description": "string"
+    },
+    "automobileLiability": {
+        "insuranceCompany": "string",
+        "currency": "string",
+        "amount": "number",
+        "deductibleCurrency": "string",
+        "deductibleAmount": "number",
+        "expiryDate": "date (yyyy/mm/dd)"
+    },
+    "commercialGeneralLiability": {
+        "insuranceCompany": "string",
+        "currency": "string",
+        "amount": "number",
+        "deductibleCurrency": "string",
+        "deductibleAmount": "number",
+        "expiryDate": "date (yyyy/mm/dd)"
+    },
+    "nonOwnedTrailer": {
+        "insuranceCompany": "string",
+        "currency": "string",
+        "amount": "number",
+        "deductibleCurrency": "string",
+        "deductibleAmount": "number",
+        "expiryDate": "date (yyyy/mm/dd)"
+    },
+    "other": {
+        "additionalInsured": "string",
+        "certificateHolder": "string",
+        "cancellationNoticePeriod": "number (days)"
+    },
+    "insurers": {"<letter>": "string"}
+}
+
+TEXT_SYSTEM_PROMPT_TEMPLATE = """
+    You are an AI assistant specialized in extracting insurance certificate data.
+    
+    Extract data from the provided insurance certificate text according to this schema:
+    {schema}
     
+    Follow these rules:
+    1. Extract all available information that fits the schema.
+    2. If information is missing, leave the field empty.
+    3. Copy currencies, dates and amounts exactly as printed; they are normalized afterwards.
+    4. Copy the insured's full mailing address into the address field.
+    5. Leave a currency field empty unless a currency is printed next to the amount.
+    6. Copy insuranceCompany as printed in the coverage row (a name or just the insurer letter) and list the insurer table under "insurers".
+    7. If multiple values could fit a field, choose the most appropriate one.
+    8. Respond ONLY with a valid JSON object following the schema.
+    """
+
+def vision_payload(image_urls):
+    """Chat-completions body for the vision tier: every page of a document in one request."""
+    return {
+        "messages": [
+            {"role": "system", "content": resources().get("vision_system_prompt")},
+            {"role": "user", "content": [{"type": "image_url", "image_url": {"url": url}} for url in image_urls]}
+        ],
+        "max_tokens": 2000,
+        "temperature": 0
+    }
+
+def text_payload(raw_text, max_tokens=2000):
+    """Chat-completions body for the text tiers."""
+    return {
+        "messages": [
+            {"role": "system", "content": resources().get("text_system_prompt")},
+            {"role": "user", "content": [
+                {"type": "text", "text": "Extract and structure the information based on the following extracted text. Provide your response strictly in JSON format wrapped within ```json and ``` inside <initial_attempt> tags."},
+                {"type": "text", "text": raw_text}
+            ]}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.2  # Lower temperature for more consistent extraction
+    }
+
+def get_raw_text(image_data_url):
+    """
+    Step 3a: Extract raw text (OCR) from the image.
+    The prompt instructs the LLM to return the plain text found in the image.
+    A list of data URLs sends every page of a document in a single request.
+    """
+    if not st.session_state.api_configured:
+        st.error("API credentials not configured.")
+        return None
+        
     try:
         with st.spinner("Processing OCR..."):
-            data = {
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_data_url}}]}
-                ],
-                "max_tokens": 2000,
-                "temperature": 0
-            }
-            
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": st.session_state.api_key
-            }
-            
-            response = requests.post(st.session_state.endpoint, headers=headers, json=data)
+            image_urls = image_data_url if isinstance(image_data_url, list) else [image_data_url]
+            response = post_chat_completion(vision_payload(image_urls))
             if response.status_code == 200:
                 return response.json()["choices"][0]["message"]["content"]
             else:
@@ -625,321 +1647,3826 @@ def parse_structured_response(response_content):
     st.error(f"Unexpected response content type: {type(response_content)}")
     return None
 
-def get_structured_data_from_text(raw_text):
-    """Extract structured JSON data from the raw OCR text."""
-    if not st.session_state.api_configured:
-        st.error("API credentials not configured.")
-        return None
-        
-    # Define the schema expected from the LLM
-    schema = {
-        "certificateInfo": {
-            "certificateNumber": "string",
-            "templateForm": "string",
-            "effectiveDate": "date (yyyy/mm/dd)",
-            "expirationDate": "date (yyyy/mm/dd)",
-            "insuredName": "string",
-            "address": "string",
-            "description": "string"
-        },
-        "automobileLiability": {
-            "insuranceCompany": "string",
-            "currency": "string",
-            "amount": "number",
-            "deductibleCurrency": "string",
-            "deductibleAmount": "number",
-            "expiryDate": "date (yyyy/mm/dd)"
-        },
-        "commercialGeneralLiability": {
-            "insuranceCompany": "string",
-            "currency": "string",
-            "amount": "number",
-            "deductibleCurrency": "string",
-            "deductibleAmount": "number",
-            "expiryDate": "date (yyyy/mm/dd)"
-        },
-        "nonOwnedTrailer": {
-            "insuranceCompany": "string",
-            "currency": "string",
-            "amount": "number",
-            "deductibleCurrency": "string",
-            "deductibleAmount": "number",
-            "expiryDate": "date (yyyy/mm/dd)"
-        },
-        "other": {
-            "additionalInsured": "string",
-            "certificateHolder": "string",
-            "cancellationNoticePeriod": "number (days)"
-        }
+# --------------------- Capture Quality ---------------------
+
+# Analysis runs on a fixed-width copy so the thresholds do not depend on the camera resolution
+CAPTURE_ANALYSIS_WIDTH = 1000
+CAPTURE_MIN_SHARPNESS = 60.0        # Laplacian variance below this is too blurry to read
+CAPTURE_MIN_PAGE_COVERAGE = 0.3     # the page outline must fill at least this share of the frame
+CAPTURE_MAX_GLARE = 0.03            # share of hotspot pixels (flash or lamp reflections)
+CAPTURE_MIN_BRIGHTNESS = 60
+CAPTURE_MIN_SKEW = 1.0              # smaller angles are left alone
+CAPTURE_MAX_SIDE = 2000             # the vision model downsamples anything larger anyway
+CAPTURE_JPEG_QUALITY = 90
+
+def order_quad_points(points):
+    """Top-left, top-right, bottom-right, bottom-left."""
+    points = points.reshape(4, 2).astype("float32")
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([points[np.argmin(sums)], points[np.argmin(diffs)],
+                     points[np.argmax(sums)], points[np.argmax(diffs)]], dtype="float32")
+
+def find_page_quad(gray):
+    """Largest four-sided outline in the frame, or None when the page edges are not visible."""
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            return order_quad_points(approx)
+    return None
+
+def estimate_skew(gray):
+    """Median angle of the long near-horizontal lines (certificate table rules and text baselines)."""
+    edges = cv2.Canny(gray, 50, 150)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, 100, minLineLength=gray.shape[1] // 4, maxLineGap=10)
+    if lines is None:
+        return 0.0
+    x1, y1, x2, y2 = lines.reshape(-1, 4).T.astype(float)
+    angles = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+    angles = angles[np.abs(angles) < 45]
+    return float(np.median(angles)) if angles.size else 0.0
+
+def glare_share(gray):
+    """Share of saturated pixels clearly brighter than the paper around them."""
+    otsu, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    light = gray[gray > otsu]
+    paper = float(np.median(light)) if light.size else 255.0
+    # Paper that is already saturated (scanner-like exposure) leaves nothing to compare against
+    if paper >= 240:
+        return 0.0
+    return float(np.count_nonzero(gray >= max(250, paper + 15))) / gray.size
+
+def assess_capture_quality(image):
+    """
+    Sharpness, page coverage, skew and exposure of a BGR camera frame.
+    Measurements are taken on a CAPTURE_ANALYSIS_WIDTH-wide grayscale copy.
+    """
+    scale = CAPTURE_ANALYSIS_WIDTH / image.shape[1]
+    gray = cv2.cvtColor(cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    quad = find_page_quad(gray)
+    coverage = cv2.contourArea(quad) / (gray.shape[0] * gray.shape[1]) if quad is not None else None
+    return {
+        "sharpness": float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        "coverage": coverage,
+        "quad": quad / scale if quad is not None else None,
+        "skew": estimate_skew(gray),
+        "glare": glare_share(gray),
+        "brightness": float(gray.mean()),
     }
-    
-    # Create a clear system prompt that provides the expected schema
-    system_prompt = f"""
-    You are an AI assistant specialized in extracting insurance certificate data.
-    
-    Extract data from the provided insurance certificate text according to this schema:
-    {json.dumps(schema, indent=2)}
-    
-    Follow these rules:
-    1. Extract all available information that fits the schema.
-    2. If information is missing, leave the field empty.
-    3. For currency fields, use the standard 3-letter currency code (e.g., USD, EUR).
-    4. For date fields, use the format yyyy/mm/dd.
-    5. For amount fields, extract only the numeric value without currency symbols or commas.
-    6. If multiple values could fit a field, choose the most appropriate one.
-    7. Respond ONLY with a valid JSON object following the schema.
+
+def capture_problems(quality):
+    """Reasons to ask for a retake instead of sending the frame to the API."""
+    problems = []
+    if quality["sharpness"] < CAPTURE_MIN_SHARPNESS:
+        problems.append("the image is blurry; hold the camera steady and let it focus")
+    if quality["coverage"] is not None and quality["coverage"] < CAPTURE_MIN_PAGE_COVERAGE:
+        problems.append("the certificate is too small in the frame; move closer")
+    if quality["glare"] > CAPTURE_MAX_GLARE:
+        problems.append("there is glare on the page; tilt it away from the light")
+    if quality["brightness"] < CAPTURE_MIN_BRIGHTNESS:
+        problems.append("the image is too dark")
+    return problems
+
+def correct_capture(image, quality):
     """
-    
-    try:
-        with st.spinner("Extracting structured data..."):
-            data = {
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": "Extract and structure the information based on the following extracted text. Provide your response strictly in JSON format wrapped within ```json and ``` inside <initial_attempt> tags."},
-                        {"type": "text", "text": raw_text}
-                    ]}
-                ],
-                "max_tokens": 2000,
-                "temperature": 0.2  # Lower temperature for more consistent extraction
-            }
-            
-            headers = {
-                "Content-Type": "application/json",
-                "api-key": st.session_state.api_key
-            }
-            
-            response = requests.post(st.session_state.endpoint, headers=headers, json=data)
-            response.raise_for_status()
-            response_content = response.json()["choices"][0]["message"]["content"]
+    Flatten the page (perspective warp, or rotation when no outline was found) and cap the size.
+    Returns (image, whether it was changed); a rotation keeps the frame's shape.
+    """
+    changed = True
+    if quality["quad"] is not None:
+        top_left, top_right, bottom_right, bottom_left = quality["quad"]
+        width = int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+        height = int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+        target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype="float32")
+        image = cv2.warpPerspective(image, cv2.getPerspectiveTransform(quality["quad"], target), (width, height))
+    elif abs(quality["skew"]) >= CAPTURE_MIN_SKEW:
+        height, width = image.shape[:2]
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), quality["skew"], 1.0)
+        image = cv2.warpAffine(image, rotation, (width, height), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    else:
+        changed = False
+    longest = max(image.shape[:2])
+    if longest > CAPTURE_MAX_SIDE:
+        image = cv2.resize(image, None, fx=CAPTURE_MAX_SIDE / longest, fy=CAPTURE_MAX_SIDE / longest,
+                           interpolation=cv2.INTER_AREA)
+        changed = True
+    return image, changed
 
-            # Use the robust parsing function
-            structured_data = parse_structured_response(response_content)
-            
-            # Log the structured data for debugging
-            st.session_state.last_structured_data = structured_data
-            return structured_data
+@st.cache_resource
+def get_capture_stats():
+    """Process-wide accepted/rejected camera capture counts."""
+    return {"lock": threading.Lock(), "accepted": 0, "corrected": 0, "rejected": 0}
 
-    except requests.exceptions.RequestException as e:
-        st.error(f"API request error: {e}")
-    except Exception as e:
-        st.error(f"Unexpected error: {e}")
-        st.error(traceback.format_exc())
+def gate_camera_capture(file_content):
+    """
+    Check a camera frame before any API call.
+    Returns (corrected JPEG bytes or None when a retake is needed, list of problems).
+    """
+    image = cv2.imdecode(np.frombuffer(file_content, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None, ["the camera image could not be decoded"]
+    quality = assess_capture_quality(image)
+    problems = capture_problems(quality)
+    stats = get_capture_stats()
+    if problems:
+        with stats["lock"]:
+            stats["rejected"] += 1
+        return None, problems
+    corrected, changed = correct_capture(image, quality)
+    with stats["lock"]:
+        stats["accepted"] += 1
+        stats["corrected"] += int(changed)
+    ok, encoded = cv2.imencode(".jpg", corrected, [cv2.IMWRITE_JPEG_QUALITY, CAPTURE_JPEG_QUALITY])
+    return (encoded.tobytes() if ok else file_content), []
 
-    return None
+# --------------------- Rate Limiting ---------------------
 
-def process_document(file_content, file_name):
-    """Process a document (image or PDF) and extract information"""
-    # Initialize OCR if not already done
-    if not hasattr(st.session_state, 'ocr_processor'):
-        st.session_state.ocr_processor = initialize_ocr()
-    
+DEFAULT_RPM_LIMIT = int(os.getenv("AZURE_OPENAI_RPM_LIMIT", "60"))
+DEFAULT_TPM_LIMIT = int(os.getenv("AZURE_OPENAI_TPM_LIMIT", "60000"))
+MAX_THROTTLE_RETRIES = 3
+
+# Token estimates: ~4 characters per text token, 85 tokens per image plus 170 per 512px tile
+CHARS_PER_TOKEN = 4
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+
+def current_session_id():
+    """Streamlit session id of the running script, or a per-thread id for headless callers."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else f"headless-{threading.get_ident()}"
+
+def estimate_image_tokens(image_data_url):
+    """Vision token cost of a data URL: scale to fit 2048px, shortest side to 768px, then count 512px tiles."""
     try:
-        # Extract text using OCR - this would be replaced with your actual OCR implementation
-        with st.spinner("Extracting text from document..."):
-            if file_name.lower().endswith('.pdf'):
-                # Process PDF file
-                raw_text = extract_text_from_pdf(file_content)
-            else:
-                # Process image file
-                raw_text = extract_text_from_image(file_content)
-            
-            if not raw_text:
-                st.error("No text could be extracted from the document.")
-                return None
-            
-            # Show extracted text in an expander for debugging
-            with st.expander("View Extracted Text"):
-                st.text(raw_text)
-            
-            # Get structured data from the raw text
-            structured_data = get_structured_data_from_text(raw_text)
-            
-            if structured_data:
-                # Convert the nested structure to flat dictionary for form values
-                flat_data = flatten_structured_data(structured_data)
-                
-                # Update the form values
-                update_form_values(flat_data)
-                
-                return structured_data
+        encoded = image_data_url.split(",", 1)[1]
+        width, height = Image.open(BytesIO(base64.b64decode(encoded))).size
+    except Exception:
+        width, height = 2048, 2048
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+def estimate_request_tokens(data):
+    """Tokens a chat-completions payload will be charged against the TPM quota (prompt plus max_tokens)."""
+    tokens = 0
+    for message in data.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif part.get("type") == "image_url":
+                tokens += estimate_image_tokens(part["image_url"]["url"])
+    return tokens + data.get("max_tokens", 0)
+
+class RateLimiter:
+    """
+    Token buckets for one deployment's requests-per-minute and tokens-per-minute quotas.
+    Both buckets refill continuously; callers waiting for capacity are served
+    round-robin across sessions so one large batch cannot starve other reviewers.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.condition = threading.Condition()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests_available = float(rpm)
+        self.tokens_available = float(tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = {}  # session id -> number of queued calls
+        self.turns = collections.deque()  # session ids in round-robin order
+        self.stats = {"requests": 0, "tokens_estimated": 0, "tokens_used": 0,
+                      "throttled": 0, "wait_total": 0.0}
+
+    def configure(self, rpm, tpm):
+        with self.condition:
+            self._refill()
+            self.rpm, self.tpm = rpm, tpm
+            self.requests_available = min(self.requests_available, rpm)
+            self.tokens_available = min(self.tokens_available, tpm)
+            self.condition.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests_available = min(self.rpm, self.requests_available + elapsed * self.rpm / 60)
+        self.tokens_available = min(self.tpm, self.tokens_available + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens, session_id):
+        """Block until this session's turn comes up and both buckets can cover the call."""
+        tokens = min(tokens, self.tpm)
+        start = time.monotonic()
+        with self.condition:
+            if session_id not in self.waiting:
+                self.waiting[session_id] = 0
+                self.turns.append(session_id)
+            self.waiting[session_id] += 1
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if (self.turns[0] == session_id and now >= self.blocked_until
+                        and self.requests_available >= 1 and self.tokens_available >= tokens):
+                    break
+                if self.turns[0] != session_id:
+                    timeout = None
+                else:
+                    timeout = max(
+                        self.blocked_until - now,
+                        (1 - self.requests_available) * 60 / self.rpm,
+                        (tokens - self.tokens_available) * 60 / self.tpm,
+                        0.01
+                    )
+                self.condition.wait(timeout)
+
+            self.requests_available -= 1
+            self.tokens_available -= tokens
+            self.turns.popleft()
+            self.waiting[session_id] -= 1
+            if self.waiting[session_id]:
+                self.turns.append(session_id)
             else:
-                st.error("Failed to extract structured data from the document.")
+                del self.waiting[session_id]
+            waited = time.monotonic() - start
+            self.stats["requests"] += 1
+            self.stats["tokens_estimated"] += tokens
+            self.stats["wait_total"] += waited
+            self.condition.notify_all()
+        return waited
+
+    def reconcile(self, estimated_tokens, response):
+        """Correct the budget from the response's usage data and x-ratelimit-* headers."""
+        with self.condition:
+            self._refill()
+            if response.status_code == 429:
+                self.stats["throttled"] += 1
+                retry_after = response.headers.get("retry-after-ms")
+                delay = float(retry_after) / 1000 if retry_after else float(response.headers.get("retry-after", 10))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                # The call was not charged; give its estimate back
+                self.requests_available = min(self.rpm, self.requests_available + 1)
+                self.tokens_available = min(self.tpm, self.tokens_available + min(estimated_tokens, self.tpm))
+            elif response.status_code == 200:
+                try:
+                    used = response.json().get("usage", {}).get("total_tokens")
+                except ValueError:
+                    used = None
+                if used is not None:
+                    self.stats["tokens_used"] += used
+                    self.tokens_available = min(self.tpm, self.tokens_available + max(0, estimated_tokens - used))
+
+            # The service's own view of the remaining quota wins when it is tighter than ours
+            remaining_requests = response.headers.get("x-ratelimit-remaining-requests")
+            remaining_tokens = response.headers.get("x-ratelimit-remaining-tokens")
+            if remaining_requests is not None:
+                self.requests_available = min(self.requests_available, float(remaining_requests))
+            if remaining_tokens is not None:
+                self.tokens_available = min(self.tokens_available, float(remaining_tokens))
+            self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            self._refill()
+            return dict(self.stats, rpm=self.rpm, tpm=self.tpm,
+                        requests_available=round(self.requests_available, 1),
+                        tokens_available=int(self.tokens_available),
+                        sessions_waiting=len(self.waiting))
+
+@st.cache_resource
+def get_rate_limiter(endpoint):
+    """One limiter per deployment, shared by every session in the process."""
+    return RateLimiter(DEFAULT_RPM_LIMIT, DEFAULT_TPM_LIMIT)
+
+# --------------------- Deployment Pool ---------------------
+
+# A deployment is taken out of rotation for a cool-down after this many consecutive failures
+DEPLOYMENT_FAILURE_THRESHOLD = 3
+DEPLOYMENT_COOLDOWN_SECONDS = 30
+DEPLOYMENT_LATENCY_WINDOW = 200
+# Hedge only once a deployment's p95 rests on enough samples, and never before this floor
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_SECONDS = 1.0
+DEPLOYMENT_WORKERS = 16
+
+def parse_deployments(text):
+    """Deployments from the settings text: one per line (or ';'-separated) as ``endpoint, api key[, weight]``."""
+    deployments = []
+    for line in re.split(r'[\n;]', text or ""):
+        parts = [part.strip() for part in line.split(",")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        try:
+            weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        except ValueError:
+            weight = 1.0
+        deployments.append({"endpoint": parts[0], "api_key": parts[1], "weight": max(weight, 0.01)})
+    return deployments
+
+def is_valid_completion(response):
+    """A 200 whose body carries at least one choice; anything else is worth failing over."""
+    if response.status_code != 200:
+        return False
+    try:
+        return bool(response.json().get("choices"))
+    except ValueError:
+        return False
+
+class DeploymentHealth:
+    """Latency and failure history of one deployment, shared by every session of the process."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.latencies = collections.deque(maxlen=DEPLOYMENT_LATENCY_WINDOW)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.stats = {"requests": 0, "failures": 0, "hedges_won": 0}
+
+    def healthy(self, now):
+        return now >= self.cooldown_until
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+class DeploymentPool:
+    """
+    Routes chat-completion calls across several deployments of the same model.
+    Each call goes to the healthy deployment with the lowest expected wait
+    (in-flight calls times median latency, divided by its weight), fails over to
+    the next one on errors, and can hedge a call that outlives the deployment's p95
+    by sending a duplicate elsewhere and keeping whichever valid answer arrives first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.health = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=DEPLOYMENT_WORKERS, thread_name_prefix="deployment")
+        self.stats = {"calls": 0, "failovers": 0, "hedged": 0}
+
+    def _health(self, endpoint):
+        if endpoint not in self.health:
+            self.health[endpoint] = DeploymentHealth(endpoint)
+        return self.health[endpoint]
+
+    def rank(self, deployments):
+        """Deployments in the order they should be tried: healthy ones by expected wait, then the rest.
+
+        Deployments that just failed go after those that didn't; one without latency samples
+        yet ranks first so it gets measured.
+        """
+        now = time.monotonic()
+        with self.lock:
+            def cost(deployment):
+                health = self._health(deployment["endpoint"])
+                median = health.percentile(50) or 0.0
+                return (not health.healthy(now), health.consecutive_failures > 0,
+                        (health.in_flight + 1) * median / deployment.get("weight", 1.0))
+            return sorted(deployments, key=cost)
+
+    def hedge_delay(self, endpoint):
+        """Seconds after which a call to ``endpoint`` is hedged, or None while its p95 is unknown."""
+        with self.lock:
+            health = self._health(endpoint)
+            if len(health.latencies) < HEDGE_MIN_SAMPLES:
                 return None
+            return max(health.percentile(95), HEDGE_MIN_DELAY_SECONDS)
+
+    def send(self, deployment, data, session_id, http_session):
+        """One call to one deployment (paced by its rate limiter), recorded in its health history."""
+        endpoint = deployment["endpoint"]
+        headers = {"Content-Type": "application/json", "api-key": deployment["api_key"]}
+        limiter = get_rate_limiter(endpoint)
+        estimated_tokens = estimate_request_tokens(data)
+        with self.lock:
+            health = self._health(endpoint)
+            health.in_flight += 1
+        start = time.monotonic()
+        response = None
+        try:
+            for attempt in range(MAX_THROTTLE_RETRIES + 1):
+                limiter.acquire(estimated_tokens, session_id)
+                response = http_session.post(endpoint, headers=headers, json=data)
+                limiter.reconcile(estimated_tokens, response)
+                if response.status_code != 429:
+                    break
+            return response
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                health.in_flight -= 1
+                health.stats["requests"] += 1
+                if response is not None and is_valid_completion(response):
+                    health.latencies.append(elapsed)
+                    health.consecutive_failures = 0
+                    health.cooldown_until = 0.0
+                else:
+                    health.stats["failures"] += 1
+                    health.consecutive_failures += 1
+                    if health.consecutive_failures >= DEPLOYMENT_FAILURE_THRESHOLD:
+                        health.cooldown_until = time.monotonic() + DEPLOYMENT_COOLDOWN_SECONDS
+
+    def dispatch(self, data, deployments, session_id, http_session, hedge=False):
+        """
+        Send ``data`` to the best deployment, failing over down the ranking.
+        Returns the first valid response, else the last response; raises the last
+        connection error if no deployment answered at all.
+        """
+        with self.lock:
+            self.stats["calls"] += 1
+        pending = {}
+        candidates = collections.deque(self.rank(deployments))
+        last_response, last_error = None, None
+
+        def launch():
+            deployment = candidates.popleft()
+            future = self.executor.submit(profiled(self.send), deployment, data, session_id, http_session)
+            pending[future] = (deployment, time.monotonic())
+
+        first = candidates[0]
+        launch()
+        hedged = False
+        while pending:
+            timeout = None
+            if hedge and not hedged and candidates and len(pending) == 1:
+                (deployment, started), = pending.values()
+                delay = self.hedge_delay(deployment["endpoint"])
+                if delay is not None:
+                    timeout = max(0.0, delay - (time.monotonic() - started))
+            done, _ = concurrent.futures.wait(pending, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                # The call outlived the deployment's p95: race a duplicate against it
+                hedged = True
+                with self.lock:
+                    self.stats["hedged"] += 1
+                launch()
+                continue
+            for future in done:
+                deployment, _ = pending.pop(future)
+                try:
+                    response = future.result()
+                except requests.exceptions.RequestException as e:
+                    last_error = e
+                    continue
+                if is_valid_completion(response):
+                    if hedged and deployment is not first:
+                        with self.lock:
+                            self._health(deployment["endpoint"]).stats["hedges_won"] += 1
+                    return response
+                last_response = response
+            if not pending and candidates:
+                with self.lock:
+                    self.stats["failovers"] += 1
+                launch()
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return dict(self.stats, deployments=[{
+                "endpoint": health.endpoint,
+                "healthy": health.healthy(now),
+                "in_flight": health.in_flight,
+                "p50_ms": round(health.percentile(50) * 1000) if health.latencies else None,
+                "p95_ms": round(health.percentile(95) * 1000) if health.latencies else None,
+                **health.stats,
+            } for health in self.health.values()])
+
+@st.cache_resource
+def get_deployment_pool():
+    """Health and latency history is per process, so every session routes on the same picture."""
+    return DeploymentPool()
+
+def session_deployments():
+    """The main deployment from the API settings followed by the additional ones."""
+    deployments = [{"endpoint": st.session_state.endpoint, "api_key": st.session_state.api_key, "weight": 1.0}]
+    for deployment in st.session_state.get("extra_deployments", []):
+        if deployment["endpoint"] != st.session_state.endpoint:
+            deployments.append(deployment)
+    return deployments
+
+def post_chat_completion(data, endpoint=None, api_key=None):
+    """POST a chat-completions payload to an Azure OpenAI deployment.
+
+    By default the call is routed across the main deployment and any additional
+    ones from the API settings (with failover, and hedging when enabled); an explicit
+    ``endpoint`` pins the call to that deployment. Calls wait for the deployment's
+    rate limiter and are retried after a 429.
+    """
+    if endpoint:
+        deployments = [{"endpoint": endpoint, "api_key": api_key or st.session_state.api_key}]
+    else:
+        deployments = session_deployments()
+    # Captured here: the pool's threads have no script context or session state
+    return get_deployment_pool().dispatch(
+        data, deployments, current_session_id(), resources().get("http_session"),
+        hedge=bool(st.session_state.get("hedge_requests")) and len(deployments) > 1)
+
+def get_structured_data_from_text(raw_text, endpoint=None, api_key=None, max_tokens=2000):
+    """Extract structured JSON data from the raw OCR text.
+
+    ``endpoint``/``api_key`` select another deployment (e.g. the cheap cascade tier);
+    by default the main deployment from the API settings is used.
+    """
+    if not st.session_state.api_configured:
+        st.error("API credentials not configured.")
+        return None
+        
+    try:
+        with st.spinner("Extracting structured data..."):
+            response = post_chat_completion(text_payload(raw_text, max_tokens), endpoint=endpoint, api_key=api_key)
+            response.raise_for_status()
+            response_content = response.json()["choices"][0]["message"]["content"]
+
+            # Use the robust parsing function, then enforce the formatting rules locally
+            structured_data, anomalies = normalize_structured_data(parse_structured_response(response_content))
+            record_anomalies(anomalies)
+            
+            # Log the structured data for debugging
+            st.session_state.last_structured_data = structured_data
+            return structured_data
+
+    except requests.exceptions.RequestException as e:
+        st.error(f"API request error: {e}")
+    except Exception as e:
+        st.error(f"Unexpected error: {e}")
+        st.error(traceback.format_exc())
+
+    return None
+
+# --------------------- Page Relevance ---------------------
+
+# Pages with at least this much text-layer text are classified by keywords, others by layout
+PAGE_TEXT_MIN_CHARS = 40
+PAGE_MIN_KEYWORD_HITS = 3
+PAGE_MIN_FORM_LINES = 8
+PAGE_AUDIT_SIZE = 500
+
+CERTIFICATE_PAGE_KEYWORDS = [re.compile(pattern, re.I) for pattern in (
+    r'certificate\s+of\s+(?:liability\s+)?insurance', r'\bINSURER\s+[A-F]\b', r'\bINSR\s*LTR\b',
+    r'policy\s+(?:number|no\.?)', r'\beff(?:ective)?\b.{0,20}\bdate\b', r'\bexp(?:iry|iration)?\b.{0,20}\bdate\b',
+    r'certificate\s+holder', r'additional\s+insured', r'automobile\s+liability', r'general\s+liability',
+    r'non[-\s]?owned\s+trailer', r'each\s+occurrence', r'\blimits?\b', r'cancell?ation',
+)]
+NON_CERTIFICATE_PAGE_KEYWORDS = [re.compile(pattern, re.I) for pattern in (
+    r'\bdear\b', r'\bsincerely\b', r'\bregards\b', r'table\s+of\s+contents', r'policy\s+wording',
+    r'terms\s+and\s+conditions', r'\bthis\s+endorsement\s+changes\b', r'\bdefinitions\b',
+)]
+
+def page_keyword_hits(text):
+    """Distinct certificate keywords on the page minus distinct letter/wording keywords."""
+    return (sum(1 for pattern in CERTIFICATE_PAGE_KEYWORDS if pattern.search(text))
+            - sum(1 for pattern in NON_CERTIFICATE_PAGE_KEYWORDS if pattern.search(text)))
+
+def page_form_lines(image):
+    """Number of long horizontal and vertical rules; certificates are boxed forms, letters are prose."""
+    if isinstance(image, str):
+        gray = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+    elif isinstance(image, np.ndarray):
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    else:
+        gray = np.array(image.convert("L"))
+    scale = 1000 / gray.shape[1]
+    gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    lines = 0
+    for kernel in ((gray.shape[1] // 10, 1), (1, gray.shape[0] // 20)):
+        rules = cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, kernel))
+        contours, _ = cv2.findContours(rules, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        lines += len(contours)
+    return lines
+
+def classify_page(text, image=None):
+    """
+    Returns (relevant, reason) for one page from its text layer, or from its layout
+    (a PIL image, numpy array or image path) when it has none.
+    """
+    text = text or ""
+    if len(text.strip()) >= PAGE_TEXT_MIN_CHARS:
+        hits = page_keyword_hits(text)
+        return hits >= PAGE_MIN_KEYWORD_HITS, f"{hits} certificate keywords"
+    if image is None:
+        return True, "no text layer"
+    lines = page_form_lines(image)
+    return lines >= PAGE_MIN_FORM_LINES, f"{lines} form lines, no text layer"
+
+@st.cache_resource
+def get_page_audit():
+    """Process-wide record of skipped pages, newest last."""
+    return {"lock": threading.Lock(), "pages": collections.OrderedDict()}
+
+def select_relevant_pages(file_name, page_texts, images=None):
+    """
+    Decide which pages need extraction; returns one bool per page.
+    When no page looks like a certificate every page is kept. Skipped pages are audited.
+    """
+    count = len(images) if images is not None else len(page_texts)
+    page_texts = list(page_texts or []) + [""] * (count - len(page_texts or []))
+    decisions = [classify_page(page_texts[i], images[i] if images is not None else None) for i in range(count)]
+    if not any(relevant for relevant, _ in decisions):
+        return [True] * count
+
+    audit = get_page_audit()
+    with audit["lock"]:
+        for page, (relevant, reason) in enumerate(decisions, start=1):
+            if not relevant:
+                key = (current_session_id(), file_name, page)
+                audit["pages"].pop(key, None)
+                audit["pages"][key] = {"File": file_name, "Page": page, "Reason": reason,
+                                       "Skipped at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        while len(audit["pages"]) > PAGE_AUDIT_SIZE:
+            audit["pages"].popitem(last=False)
+    return [relevant for relevant, _ in decisions]
+
+def page_audit_frame():
+    audit = get_page_audit()
+    with audit["lock"]:
+        return pd.DataFrame(list(audit["pages"].values()), columns=["File", "Page", "Reason", "Skipped at"])
+
+# --------------------- Resource Registry ---------------------
+
+HTTP_POOL_SIZE = 32
+
+class ResourceRegistry:
+    """
+    Named process-wide resources, each built once on first use or during warm-up.
+    Records how long every build took (the cold cost) and how often the built value was reused,
+    plus per-document latency so a fresh process can be compared with steady state.
+    """
+
+    def __init__(self, factories):
+        self.factories = factories
+        self.values = {}
+        self.lock = threading.Lock()
+        self.metrics = {name: {"build_ms": None, "hits": 0} for name in factories}
+        self.document_ms = collections.deque(maxlen=100)
+        self.first_document_ms = None
+        self.warmed_ms = None
+
+    def get(self, name):
+        if name in self.values:
+            self.metrics[name]["hits"] += 1
+            return self.values[name]
+        with self.lock:
+            if name not in self.values:
+                start = time.perf_counter()
+                self.values[name] = self.factories[name]()
+                self.metrics[name]["build_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return self.values[name]
+
+    def warm(self):
+        """Build every resource now (idempotent), e.g. when the server or a worker starts."""
+        if self.warmed_ms is None:
+            start = time.perf_counter()
+            for name in self.factories:
+                self.get(name)
+            self.warmed_ms = round((time.perf_counter() - start) * 1000, 2)
+        return self.warmed_ms
+
+    def record_document(self, seconds):
+        milliseconds = round(seconds * 1000, 2)
+        if self.first_document_ms is None:
+            self.first_document_ms = milliseconds
+        self.document_ms.append(milliseconds)
+
+    def snapshot(self):
+        return {
+            "warm_up_ms": self.warmed_ms,
+            "first_document_ms": self.first_document_ms,
+            "median_document_ms": float(np.median(self.document_ms)) if self.document_ms else None,
+            "resources": {name: dict(metrics) for name, metrics in self.metrics.items()},
+        }
+
+def build_http_session():
+    """Keep-alive connections (and their TLS sessions) shared by every request of the process."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    if endpoint:
+        # Open the first connection now so the first document doesn't pay for DNS and the TLS handshake
+        with contextlib.suppress(requests.exceptions.RequestException):
+            session.head(endpoint, timeout=5)
+    return session
+
+def import_document_libraries():
+    """The OCR library is imported lazily by the extractor; importing it once here moves the cost to warm-up."""
+    import pytesseract
+    return [pytesseract.__name__]
+
+def build_resource_registry():
+    return ResourceRegistry({
+        "document_libraries": import_document_libraries,
+        "pdf_backend": build_pdf_backend,
+        "vision_system_prompt": lambda: VISION_SYSTEM_PROMPT,
+        "text_system_prompt": lambda: TEXT_SYSTEM_PROMPT_TEMPLATE.format(schema=json.dumps(TEXT_EXTRACTION_SCHEMA, indent=2)),
+        "ocr": lambda: initialize_ocr(),
+        "http_session": build_http_session,
+        "pipeline_profile": load_pipeline_profile,
+        "spool": lambda: get_spool(),
+        "insurer_index": lambda: get_insurer_index(),
+        "certificate_index": lambda: get_certificate_index(),
+    })
+
+# Headless callers (worker.py, scripts) import the module once, so a module-level registry lasts the process
+HEADLESS_RESOURCES = build_resource_registry()
+
+@st.cache_resource
+def get_app_resources():
+    """The app re-executes this module on every rerun; the registry has to live in the resource cache."""
+    return build_resource_registry()
+
+def resources():
+    return get_app_resources() if get_script_run_ctx() is not None else HEADLESS_RESOURCES
+
+# --------------------- Model Cascade ---------------------
+
+COVERAGE_SECTIONS = ['automobileLiability', 'commercialGeneralLiability', 'nonOwnedTrailer']
+COVERAGE_FIELDS = ['insuranceCompany', 'currency', 'amount', 'deductibleCurrency', 'deductibleAmount', 'expiryDate']
+CASCADE_TIERS = ['rules', 'fast', 'vision']
+
+# A document is accepted from the rules tier only when its score reaches this threshold
+CASCADE_CONFIDENCE_THRESHOLD = 0.9
+FAST_TIER_MAX_TOKENS = 1000
+
+# Keys returned by the vision prompt in get_raw_text, mapped onto the nested schema
+EXPORT_COLUMN_TO_SCHEMA = {
+    'Template Form': ('certificateInfo', 'templateForm'),
+    'Insured Address': ('certificateInfo', 'address'),
+    'Automobile Liability Insurance Company': ('automobileLiability', 'insuranceCompany'),
+    'Automobile Liability Currency': ('automobileLiability', 'currency'),
+    'Automobile Liability Amount': ('automobileLiability', 'amount'),
+    'Automobile Liability DED. Currency': ('automobileLiability', 'deductibleCurrency'),
+    'Automobile Liability DED. Amount': ('automobileLiability', 'deductibleAmount'),
+    'Automobile Liability Expiry Date (yyyy/mm/dd)': ('automobileLiability', 'expiryDate'),
+    'Each occ Commercial General Liability Insurance Company': ('commercialGeneralLiability', 'insuranceCompany'),
+    'Each occ Commercial General Liability Currency': ('commercialGeneralLiability', 'currency'),
+    'Each occ Commercial General Liability Amount': ('commercialGeneralLiability', 'amount'),
+    'Each occ Commercial General Liability DED. Currency': ('commercialGeneralLiability', 'deductibleCurrency'),
+    'Each occ Commercial General Liability DED. Amount': ('commercialGeneralLiability', 'deductibleAmount'),
+    'Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)': ('commercialGeneralLiability', 'expiryDate'),
+    'Non-owned Trailer Insurance Company': ('nonOwnedTrailer', 'insuranceCompany'),
+    'Non-owned Trailer Currency': ('nonOwnedTrailer', 'currency'),
+    'Non-owned Trailer Amount': ('nonOwnedTrailer', 'amount'),
+    'Non-owned Trailer DED. Currency': ('nonOwnedTrailer', 'deductibleCurrency'),
+    'Non-owned Trailer DED. Amount': ('nonOwnedTrailer', 'deductibleAmount'),
+    'Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)': ('nonOwnedTrailer', 'expiryDate'),
+    'Additional insured': ('other', 'additionalInsured'),
+    'Certificate Holder': ('other', 'certificateHolder'),
+    'Cancellation Notice Period (days)': ('other', 'cancellationNoticePeriod'),
+}
+
+TEMPLATE_FORMS = [
+    "Monarch", "Lloyd Sadd", "NFP", "CSIO", "Rogers", "Wylie Crump", "MHK", "Fleet", "ACORD", "O HUB",
+    "All Insurance Ltd.", "WESTLAND", "Mango Insurance", "AON", "Goldkey Insurance", "Brokerlink",
+    "One Insurance", "A-KAN", "Ing+Mckee", "BFL Canada Insurance Services Inc.", "Co-Operators",
+    "Federated Insurance", "Prl", "Foster Park", "Risktech Insurance Services Inc.", "Drayden Insurance"
+]
+
+DATE_PATTERN = re.compile(r'\b(\d{4}[/-]\d{1,2}[/-]\d{1,2}|\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b')
+AMOUNT_PATTERN = re.compile(r'\$?\s*(\d{1,3}(?:,\d{3})+(?:\.\d{2})?|\d{4,}(?:\.\d{2})?)')
+DEDUCTIBLE_PATTERN = re.compile(r'(?:DED(?:UCTIBLE)?S?\.?|ALL PERILS)\s*:?\s*\$?\s*(\d[\d,]*(?:\.\d{2})?)', re.I)
+INSURER_PATTERN = re.compile(r'INSURER\s+([A-F])\s*:\s*([^\n]+)', re.I)
+CERT_NUMBER_PATTERN = re.compile(r'CERTIFICATE\s+(?:NUMBER|NO\.?|#)\s*:?\s*([A-Z0-9][A-Z0-9-]{2,})', re.I)
+CANCELLATION_PATTERN = re.compile(r'\b(\d{1,3})\s*DAYS?\b[^\n]{0,40}NOTICE', re.I)
+# The insured block: the rest of the INSURED line and the two lines after it (name, then address)
+INSURED_PATTERN = re.compile(r'^[ \t]*INSURED\b[ \t]*:?([^\n]*(?:\n[^\n]+){0,2})', re.I | re.M)
+HOLDER_PATTERN = re.compile(r'CERTIFICATE\s+HOLDER\s*:?\s*\n?([^\n]+(?:\n[^\n]+)?)', re.I)
+# A province code counts only next to a postal code: bare ON, BC or NS are common words in caps text
+CANADA_ADDRESS_PATTERN = re.compile(
+    r'\b(?:AB|BC|MB|NB|NL|NS|NT|NU|ON|PE|QC|SK|YT),?\s+'
+    r'[ABCEGHJ-NPRSTVXY]\d[ABCEGHJ-NPRSTV-Z]\s?\d[ABCEGHJ-NPRSTV-Z]\d\b|\bCanada\b'
+)
+USA_ADDRESS_PATTERN = re.compile(r'\b[A-Z]{2}\s+\d{5}(?:-\d{4})?\b|\bUnited States\b|\bU\.?S\.?A\.?\b')
+CURRENCY_CODE_PATTERN = re.compile(r'^[A-Z]{3}$')
+
+SECTION_ANCHORS = {
+    'automobileLiability': re.compile(r'AUTO(?:MOBILE)?\s+LIABILITY', re.I),
+    'commercialGeneralLiability': re.compile(r'COMMERCIAL\s+GENERAL\s+LIABILITY', re.I),
+    'nonOwnedTrailer': re.compile(r'NON[-\s]?OWNED\s+TRAILER|\bM?SEF\s*(?:NO\.?\s*)?27\b', re.I),
+}
+AMOUNT_ANCHORS = {
+    'automobileLiability': re.compile(r'COMBINED\s+SINGLE\s+LIMIT|LIMITS?\s+OF\s+LIABILITY', re.I),
+    'commercialGeneralLiability': re.compile(r'EACH\s+OCCURRENCE', re.I),
+    'nonOwnedTrailer': SECTION_ANCHORS['nonOwnedTrailer'],
+}
+SECTION_WINDOW = 500
+
+def is_blank(value):
+    """True for values the model or the extractor left empty or unreadable."""
+    return value is None or str(value).strip() in ("", "[unclear]")
+
+def is_missing(value):
+    return str(value).strip().lower() == "missing"
+
+def normalize_date(value):
+    """Convert a date string to yyyy/mm/dd; returns None when it cannot be read unambiguously.
+
+    Four-digit leading years are taken as yyyy/mm/dd, trailing four-digit years as MM/DD/YYYY
+    and two-digit triples as YY/MM/DD, matching the rules given to the model.
+    """
+    parts = re.split(r'[/-]', str(value).strip())
+    if len(parts) != 3 or not all(p.isdigit() for p in parts):
+        return None
+    if len(parts[0]) == 4:
+        year, month, day = parts
+    elif len(parts[2]) == 4:
+        month, day, year = parts
+    elif all(len(p) <= 2 for p in parts):
+        year, month, day = "20" + parts[0].zfill(2), parts[1], parts[2]
+    else:
+        return None
+    try:
+        return datetime(int(year), int(month), int(day)).strftime('%Y/%m/%d')
+    except ValueError:
+        return None
+
+def is_valid_date(value):
+    """A date is valid only if it is already in strict yyyy/mm/dd form."""
+    return normalize_date(value) == str(value).strip()
+
+def is_valid_amount(value):
+    return re.fullmatch(r'\$?\s*\d[\d,]*(\.\d+)?', str(value).strip()) is not None
+
+def currency_from_address(address):
+    """Return CAD/USD when the address clearly names a Canadian or US location, else None."""
+    if not address:
+        return None
+    is_canada = CANADA_ADDRESS_PATTERN.search(address) is not None
+    is_usa = USA_ADDRESS_PATTERN.search(address) is not None
+    if is_canada and not is_usa:
+        return "CAD"
+    if is_usa and not is_canada:
+        return "USD"
+    return None
+
+def extract_with_rules(raw_text):
+    """Cheap local extractor: pull schema fields out of a text layer with regular expressions."""
+    upper_text = raw_text.upper()
+    insurers = {letter.upper(): name.strip() for letter, name in INSURER_PATTERN.findall(raw_text)}
+
+    template_form = "Unknown"
+    for form in TEMPLATE_FORMS:
+        if form.upper() in upper_text:
+            template_form = form
+            break
+
+    cert_number = CERT_NUMBER_PATTERN.search(raw_text)
+    holder = HOLDER_PATTERN.search(raw_text)
+    cancellation = CANCELLATION_PATTERN.search(raw_text)
+    insured = INSURED_PATTERN.search(raw_text)
+    # Only the insured's address decides the currency; the rest of the page mentions other parties
+    address_currency = currency_from_address(insured.group(1)) if insured else None
+
+    structured = {
+        "certificateInfo": {
+            "certificateNumber": cert_number.group(1) if cert_number else "missing",
+            "templateForm": template_form,
+            "effectiveDate": "missing",
+            "expirationDate": "missing",
+            "insuredName": "",
+            "address": "",
+            "description": ""
+        },
+        "other": {
+            "additionalInsured": "missing",
+            "certificateHolder": " ".join(holder.group(1).split()) if holder else "missing",
+            "cancellationNoticePeriod": cancellation.group(1) if cancellation else "missing"
+        },
+        "insurers": insurers
+    }
+
+    anchors = {section: SECTION_ANCHORS[section].search(raw_text) for section in COVERAGE_SECTIONS}
+    for section in COVERAGE_SECTIONS:
+        values = {field: "missing" for field in COVERAGE_FIELDS}
+        anchor = anchors[section]
+        if anchor:
+            # A section's window stops where the next coverage section begins
+            window_end = min([anchor.start() + SECTION_WINDOW] + [
+                other.start() for other in anchors.values() if other and other.start() > anchor.start()
+            ])
+            window = raw_text[anchor.start():window_end]
+            # The insurer letter (INSR LTR column) precedes the coverage type on the same line
+            line_start = raw_text.rfind("\n", 0, anchor.start()) + 1
+            letter = re.match(r'\s*([A-F])\b', raw_text[line_start:anchor.start()])
+            if letter and letter.group(1) in insurers:
+                values["insuranceCompany"] = letter.group(1)
+            elif len(insurers) == 1:
+                values["insuranceCompany"] = next(iter(insurers.values()))
+            else:
+                values["insuranceCompany"] = ""
+
+            amount_anchor = AMOUNT_ANCHORS[section].search(window)
+            amount = AMOUNT_PATTERN.search(window, amount_anchor.end() if amount_anchor else 0)
+            if amount:
+                values["amount"] = amount.group(1).replace(",", "")
+                values["currency"] = address_currency or ""
+            deductible = DEDUCTIBLE_PATTERN.search(window)
+            if deductible:
+                values["deductibleAmount"] = deductible.group(1).replace(",", "")
+                values["deductibleCurrency"] = address_currency or ""
+            dates = [d for d in (normalize_date(m) for m in DATE_PATTERN.findall(window)) if d]
+            # Policy rows list the effective date before the expiry date
+            values["expiryDate"] = max(dates) if dates else ""
+        structured[section] = values
+
+    resolve_structured_insurers(structured)
+    return structured
+
+def score_structured_data(structured_data):
+    """
+    Deterministic confidence checks on a structured result.
+    Returns (score between 0 and 1, list of failing (section, field) pairs) based on
+    schema completeness, date and amount validity and currency agreement.
+    """
+    if not isinstance(structured_data, dict):
+        return 0.0, [(section, field) for section in COVERAGE_SECTIONS for field in COVERAGE_FIELDS]
+
+    failing = []
+    total = 0
+    info = structured_data.get("certificateInfo") or {}
+    other = structured_data.get("other") or {}
+    expected_currency = currency_from_address(info.get("address") or "")
+
+    for section, field in [("certificateInfo", "templateForm"), ("other", "certificateHolder")]:
+        total += 1
+        if is_blank((structured_data.get(section) or {}).get(field)):
+            failing.append((section, field))
+
+    total += 1
+    period = other.get("cancellationNoticePeriod")
+    if is_blank(period) or not (is_missing(period) or str(period).strip().isdigit()):
+        failing.append(("other", "cancellationNoticePeriod"))
+
+    for section in COVERAGE_SECTIONS:
+        values = structured_data.get(section) or {}
+        for amount_field, currency_field in [("amount", "currency"), ("deductibleAmount", "deductibleCurrency")]:
+            amount = values.get(amount_field)
+            currency = values.get(currency_field)
+            total += 2
+            if is_blank(amount) or not (is_missing(amount) or is_valid_amount(amount)):
+                failing.append((section, amount_field))
+            if is_blank(currency) or is_missing(amount) != is_missing(currency):
+                failing.append((section, currency_field))
+            elif not is_missing(currency) and (
+                not CURRENCY_CODE_PATTERN.match(str(currency).strip())
+                or (expected_currency and str(currency).strip() != expected_currency)
+            ):
+                failing.append((section, currency_field))
+
+        total += 2
+        expiry = values.get("expiryDate")
+        if is_blank(expiry) or not (is_missing(expiry) or is_valid_date(expiry)):
+            failing.append((section, "expiryDate"))
+        company = values.get("insuranceCompany")
+        if is_blank(company) or (is_missing(company) and not is_missing(values.get("amount"))):
+            failing.append((section, "insuranceCompany"))
+
+    # A certificate without a single coverage amount is an incomplete read, not a valid answer
+    if all(is_missing((structured_data.get(section) or {}).get("amount")) for section in COVERAGE_SECTIONS):
+        failing.extend((section, "amount") for section in COVERAGE_SECTIONS
+                       if (section, "amount") not in failing)
+
+    return max(0.0, 1 - len(failing) / total), failing
+
+def merge_structured_fields(base, update, fields):
+    """Copy the given (section, field) values from ``update`` into a copy of ``base``."""
+    merged = {section: dict(values) for section, values in (base or {}).items() if isinstance(values, dict)}
+    for section, field in fields:
+        value = (update.get(section) or {}).get(field)
+        if not is_blank(value):
+            merged.setdefault(section, {})[field] = value
+    return merged
+
+def merge_escalated_answer(structured, escalated, failing):
+    """
+    Fold a higher tier's answer into the current result: only the failing fields are taken
+    when there is a result to repair, the whole answer when earlier tiers produced nothing.
+    """
+    if not isinstance(structured, dict):
+        return escalated
+    return merge_structured_fields(structured, escalated, failing)
+
+def structured_from_export_row(row):
+    """Convert the flat export-column JSON produced by the vision prompt to the nested schema."""
+    structured = {}
+    for column, (section, field) in EXPORT_COLUMN_TO_SCHEMA.items():
+        if column in row:
+            structured.setdefault(section, {})[field] = row[column]
+    if isinstance(row.get("Insurers"), dict):
+        structured["insurers"] = row["Insurers"]
+    return structured
+
+def render_page_images(document, page_texts=None, profile=None):
+    """
+    Rasterize, preprocess and encode the relevant pages of an ingested document with a pipeline
+    profile (the configured one by default), returning one encoded buffer per page.
+    The three steps run as a StagePipeline, so at most a few decoded pages are held at once.
+    """
+    profile = profile or pipeline_profile()
+    # Every variant but "none" starts from grayscale, so render straight to one channel
+    grayscale = profile["preprocess"] != "none"
+    if document.is_pdf:
+        images = pdf_backend().render(document.path, document.job.image_folder, profile["dpi"], grayscale)
+        document.job.account(images.files)
+    else:
+        images = image_file_pages(document.path, grayscale)
+
+    relevant = select_relevant_pages(document.name, page_texts or [], images)
+    pipeline = StagePipeline("pages", [
+        ("rasterize", images.__getitem__, PAGE_STAGE_WORKERS["rasterize"]),
+        ("preprocess", lambda image: preprocess_image(image, profile), PAGE_STAGE_WORKERS["preprocess"]),
+        ("encode", lambda image: encode_page(image, profile), PAGE_STAGE_WORKERS["encode"]),
+    ])
+    return pipeline.run(index for index, keep in enumerate(relevant) if keep)
+
+def render_document_pages(document, page_texts=None):
+    """
+    Rendered pages of a document (see render_page_images); the buffers are cached by content
+    so a re-run of the same document skips rendering.
+    """
+    spool = get_spool()
+    pages = spool.cached_pages(document.sha1)
+    if pages is not None:
+        return pages
+    pages = render_page_images(document, page_texts)
+    spool.cache_pages(document.sha1, pages)
+    return pages
+
+@st.cache_resource
+def get_cascade_stats():
+    """Process-wide per-tier counters shared by every session."""
+    return {
+        "lock": threading.Lock(),
+        "tiers": {tier: {"documents": 0, "escalations": 0, "latency_total": 0.0, "latency_max": 0.0}
+                  for tier in CASCADE_TIERS}
+    }
+
+def record_cascade_tier(tier, latency, escalated):
+    stats = get_cascade_stats()
+    with stats["lock"]:
+        tier_stats = stats["tiers"][tier]
+        tier_stats["documents"] += 1
+        tier_stats["escalations"] += int(escalated)
+        tier_stats["latency_total"] += latency
+        tier_stats["latency_max"] = max(tier_stats["latency_max"], latency)
+
+def cascade_stats_frame():
+    """Escalation rate and latency per tier, for display in the settings tab."""
+    stats = get_cascade_stats()
+    with stats["lock"]:
+        rows = []
+        for tier, tier_stats in stats["tiers"].items():
+            documents = tier_stats["documents"]
+            rows.append({
+                "Tier": tier,
+                "Documents": documents,
+                "Escalated": tier_stats["escalations"],
+                "Escalation rate": tier_stats["escalations"] / documents if documents else 0.0,
+                "Avg latency (s)": tier_stats["latency_total"] / documents if documents else 0.0,
+                "Max latency (s)": tier_stats["latency_max"],
+            })
+    return pd.DataFrame(rows)
+
+def structure_with_cascade(raw_text, document=None, page_texts=None):
+    """
+    Structure a document through increasingly expensive tiers:
+      1. local rules extractor on the text layer
+      2. fast deployment on the raw text (falls back to the main deployment)
+      3. vision model on the page images with the full prompt; only the fields that still fail
+         are taken from its answer
+    Returns (structured_data, name of the last tier used).
+    """
+    start = time.perf_counter()
+    structured = extract_with_rules(raw_text) if raw_text else None
+    score, failing = score_structured_data(structured)
+    escalate = score < CASCADE_CONFIDENCE_THRESHOLD
+    record_cascade_tier("rules", time.perf_counter() - start, escalate)
+    if not escalate:
+        return structured, "rules"
+
+    tier = "rules"
+    prerender = None
+    if raw_text:
+        start = time.perf_counter()
+        if document is not None and PRERENDER_PAGES:
+            # The CPU would idle during the call; a vision escalation or section re-extraction uses the pages
+            prerender = run_in_background(render_document_pages, document, page_texts)
+        fast_data = get_structured_data_from_text(
+            raw_text,
+            endpoint=st.session_state.get("fast_endpoint") or None,
+            api_key=st.session_state.get("fast_api_key") or None,
+            max_tokens=FAST_TIER_MAX_TOKENS
+        )
+        if fast_data:
+            # Rules output is only trusted as a whole; the model answer replaces it
+            structured, tier = fast_data, "fast"
+            score, failing = score_structured_data(structured)
+        record_cascade_tier("fast", time.perf_counter() - start, bool(failing))
+
+    if failing and document is not None:
+        start = time.perf_counter()
+        pages = prerender.result() if prerender else render_document_pages(document, page_texts)
+        if pages:
+            vision_response = get_raw_text([convert_bytes_to_base64(page) for page in pages])
+            vision_row = parse_structured_response(vision_response) if vision_response else None
+            if vision_row:
+                vision_data, anomalies = normalize_structured_data(structured_from_export_row(vision_row))
+                record_anomalies(anomalies)
+                structured = merge_escalated_answer(structured, vision_data, failing)
+                tier = "vision"
+                score, failing = score_structured_data(structured)
+        record_cascade_tier("vision", time.perf_counter() - start, False)
+    elif prerender:
+        # The document's spool files go away with its job, so rendering has to finish first
+        concurrent.futures.wait([prerender])
+
+    return structured, tier
+
+# --------------------- Section Re-extraction ---------------------
+
+# Review form tabs in order, with the schema section each one edits
+FORM_TAB_SECTIONS = [
+    ("Certificate Info", "certificateInfo"),
+    ("Automobile Liability", "automobileLiability"),
+    ("Commercial General Liability", "commercialGeneralLiability"),
+    ("Non-owned Trailer", "nonOwnedTrailer"),
+    ("Others", "other"),
+]
+SECTION_MAX_TOKENS = 400
+
+SECTION_SYSTEM_PROMPT_TEMPLATE = """
+    You are an AI assistant specialized in extracting insurance certificate data.
+    
+    Extract only the "{section}" section of the certificate, with exactly these fields:
+    {schema}
+    
+    Follow these rules:
+    1. Copy currencies, dates and amounts exactly as printed; they are normalized afterwards.
+    2. Write "missing" for a field the certificate does not have and "[unclear]" for one you cannot read.
+    3. Copy insuranceCompany as printed in the coverage row (a name or just the insurer letter).
+    4. Never use "bodily injury" amounts.
+    5. Respond ONLY with a JSON object of these fields, wrapped within ```json and ``` inside <initial_attempt> tags.
+    """
+
+def section_fields_to_reextract(structured_data, section):
+    """Fields of a section that are blank, missing or unclear; all of them when the section looks complete."""
+    fields = list(TEXT_EXTRACTION_SCHEMA[section])
+    values = (structured_data or {}).get(section) or {}
+    failing = [field for field in fields if is_blank(values.get(field)) or is_missing(values.get(field))]
+    return failing or fields
+
+def section_payload(section, fields, raw_text=None, image_urls=()):
+    """Short chat-completions body asking for the given fields of one section, from text or page images."""
+    schema = json.dumps({field: TEXT_EXTRACTION_SCHEMA[section][field] for field in fields}, indent=2)
+    content = [{"type": "text", "text": f"Extract the {section} fields from this certificate."}]
+    if raw_text:
+        content.append({"type": "text", "text": raw_text})
+    content.extend({"type": "image_url", "image_url": {"url": url}} for url in image_urls)
+    return {
+        "messages": [
+            {"role": "system", "content": SECTION_SYSTEM_PROMPT_TEMPLATE.format(section=section, schema=schema)},
+            {"role": "user", "content": content}
+        ],
+        "max_tokens": SECTION_MAX_TOKENS,
+        "temperature": 0
+    }
+
+def request_section(section, fields, structured_data, raw_text=None, pages=None):
+    """Ask the model for one section and normalize the answer in the context of the rest of the document."""
+    image_urls = [convert_bytes_to_base64(page) for page in pages or []]
+    response = post_chat_completion(section_payload(section, fields, raw_text, image_urls))
+    response.raise_for_status()
+    answer = parse_structured_response(response.json()["choices"][0]["message"]["content"])
+    if not isinstance(answer, dict):
+        return {}, []
+    # Currency follows the insured's address and insurer letters follow the insurer table
+    context = {key: (structured_data or {}).get(key) for key in ("certificateInfo", "insurers")
+               if (structured_data or {}).get(key)}
+    # The answer carries only the requested fields; the section's stored values fill in the rest,
+    # so a currency re-asked on its own is normalized against the amount it belongs to
+    current = (structured_data or {}).get(section)
+    context[section] = dict(current if isinstance(current, dict) else {}, **answer.get(section, answer))
+    normalized, anomalies = normalize_structured_data(context)
+    return normalized, [anomaly for anomaly in anomalies if anomaly.startswith(f"{section}.")]
+
+def reextract_section(entry, section, fields=None):
+    """
+    Re-ask only the failing fields of one section for a queued document and merge the answer
+    into the entry, the review form and the certificate index.
+    Uses the text stored in the index and, when the text answer still fails, the page images
+    left in the spool's page cache; nothing is rasterized or OCR'd again.
+    Returns (fields that changed, name of the input that answered).
+    """
+    fields = fields or section_fields_to_reextract(entry["structured_data"], section)
+    cached = get_certificate_index().cached_extraction(entry["key"]) if entry.get("key") else None
+    raw_text = cached["raw_text"] if cached else ""
+    pages = get_spool().cached_pages(entry["key"]) if entry.get("key") else None
+    if not raw_text and not pages:
+        raise ValueError("The document's text and pages are no longer cached; process the file again.")
+
+    structured = entry["structured_data"] or {}
+    source, answer, anomalies = None, {}, []
+    if raw_text:
+        answer, anomalies = request_section(section, fields, structured, raw_text=raw_text)
+        source = "text"
+    still_failing = [field for field in fields
+                     if is_blank((answer.get(section) or {}).get(field)) or is_missing((answer.get(section) or {}).get(field))]
+    if still_failing and pages:
+        vision_answer, vision_anomalies = request_section(section, still_failing, structured, pages=pages)
+        answer = merge_structured_fields(answer, vision_answer, [(section, field) for field in still_failing])
+        anomalies.extend(vision_anomalies)
+        source = "pages"
+
+    before = (structured.get(section) or {}).copy()
+    merged = merge_structured_fields(structured, answer, [(section, field) for field in fields])
+    changed = [field for field in fields if (merged.get(section) or {}).get(field) != before.get(field)]
+
+    # Reviewer edits in other sections are kept; only this section's form values are replaced
+    section_values = flat_form_values({section: merged.get(section, {})})
+    entry["structured_data"] = merged
+    entry["form_values"] = dict(entry["form_values"], **section_values)
+    entry["anomalies"] = [anomaly for anomaly in entry["anomalies"] if not anomaly.startswith(f"{section}.")] + anomalies
+    st.session_state.last_structured_data = merged
+    st.session_state.form_values.update(section_values)
+    status = "saved" if entry["status"] == "saved" else "extracted"
+    get_certificate_index().upsert(entry["key"], entry["file_name"], status, entry["form_values"],
+                                   page_count=entry["page_count"], structured=merged)
+    return changed, source
+
+# --------------------- Insurer Index ---------------------
+
+# Canonical carrier names with the spellings and brands they appear under on certificates
+CANONICAL_INSURERS = {
+    # Canada
+    "Intact Insurance Company": ["Intact", "Intact Insurance", "Intact Compagnie d'assurance"],
+    "Aviva Insurance Company of Canada": ["Aviva", "Aviva Canada", "Aviva General Insurance"],
+    "Northbridge General Insurance Corporation": ["Northbridge", "Northbridge Insurance", "Northbridge General"],
+    "Definity Insurance Company": ["Economical Insurance", "Economical Mutual Insurance Company", "Definity"],
+    "Wawanesa Mutual Insurance Company": ["Wawanesa", "Wawanesa Insurance"],
+    "Co-operators General Insurance Company": ["Co-operators", "The Co-operators", "Cooperators"],
+    "Royal & Sun Alliance Insurance Company of Canada": ["RSA", "RSA Canada", "Royal Sun Alliance", "Royal & SunAlliance"],
+    "Travelers Insurance Company of Canada": ["Travelers Canada", "Travelers Guarantee Company of Canada", "Dominion of Canada General Insurance"],
+    "Zurich Insurance Company Ltd": ["Zurich", "Zurich Canada"],
+    "Chubb Insurance Company of Canada": ["Chubb", "Chubb Canada", "ACE INA Insurance"],
+    "AIG Insurance Company of Canada": ["AIG", "AIG Canada"],
+    "Lloyd's Underwriters": ["Lloyd's", "Lloyds", "Certain Underwriters at Lloyd's", "Lloyd's of London"],
+    "Gore Mutual Insurance Company": ["Gore Mutual", "Gore Insurance"],
+    "SGI Canada Insurance Services Ltd": ["SGI", "SGI Canada", "Saskatchewan Government Insurance"],
+    "Insurance Corporation of British Columbia": ["ICBC"],
+    "Manitoba Public Insurance": ["MPI"],
+    "Trisura Guarantee Insurance Company": ["Trisura"],
+    "Markel Canada Limited": ["Markel", "Markel Insurance Company of Canada"],
+    "Berkley Canada": ["Berkley Insurance Company", "Berkley Canada a W. R. Berkley Company"],
+    "The Sovereign General Insurance Company": ["Sovereign", "Sovereign Insurance"],
+    "Temple Insurance Company": ["Temple"],
+    "Echelon Insurance": ["Echelon General Insurance", "Echelon"],
+    "Jevco Insurance Company": ["Jevco"],
+    "Pembridge Insurance Company": ["Pembridge"],
+    "Peace Hills General Insurance Company": ["Peace Hills", "Peace Hills Insurance"],
+    "Portage Mutual Insurance": ["Portage Mutual", "Portage La Prairie Mutual"],
+    "Wynward Insurance Group": ["Wynward"],
+    "Optimum West Insurance Company": ["Optimum West", "Optimum Insurance"],
+    "Unica Insurance Inc.": ["Unica", "York Fire & Casualty"],
+    "CAA Insurance Company": ["CAA Insurance"],
+    "Desjardins General Insurance Inc.": ["Desjardins", "Certas Direct", "State Farm Canada"],
+    "Old Republic Insurance Company of Canada": ["Old Republic Canada"],
+    "Heartland Farm Mutual": ["Heartland"],
+    "Perth Insurance Company": ["Perth Insurance"],
+    "Lombard General Insurance Company of Canada": ["Lombard", "Lombard Canada"],
+    "Allianz Global Risks US Insurance Company": ["Allianz", "Allianz Global Risks", "AGCS"],
+    "AXA XL": ["XL Specialty Insurance Company", "XL Catlin", "AXA XL Insurance"],
+    "Arch Insurance Canada Ltd": ["Arch Insurance", "Arch"],
+    "Tokio Marine & Nichido Fire Insurance Co.": ["Tokio Marine"],
+    "Starr Insurance & Reinsurance Limited": ["Starr", "Starr Indemnity"],
+    "Swiss Reinsurance Company Ltd": ["Swiss Re", "Swiss Re Corporate Solutions"],
+    "Great American Insurance Group": ["Great American", "Great American Insurance Company"],
+    "Family Insurance Solutions Inc.": ["Family Insurance"],
+    "Max Insurance": ["MAX Insurance", "Manitoba Agricultural Mutual"],
+    # United States
+    "Progressive Casualty Insurance Company": ["Progressive", "Progressive Commercial", "Progressive Insurance"],
+    "Great West Casualty Company": ["Great West Casualty", "Great West"],
+    "Canal Insurance Company": ["Canal Insurance", "Canal"],
+    "National Interstate Insurance Company": ["National Interstate"],
+    "Sentry Insurance": ["Sentry", "Sentry Select Insurance Company"],
+    "Travelers Property Casualty Company of America": ["Travelers", "Travelers Indemnity Company", "The Travelers"],
+    "Hartford Fire Insurance Company": ["The Hartford", "Hartford", "Hartford Casualty Insurance Company"],
+    "Nationwide Mutual Insurance Company": ["Nationwide"],
+    "State Farm Mutual Automobile Insurance Company": ["State Farm"],
+    "Allstate Insurance Company": ["Allstate"],
+    "Continental Casualty Company": ["CNA", "CNA Insurance", "Continental Insurance"],
+    "Zurich American Insurance Company": ["Zurich American", "Zurich North America"],
+    "Liberty Mutual Insurance Company": ["Liberty Mutual", "Liberty Mutual Fire Insurance Company", "Liberty Insurance Corporation"],
+    "National Indemnity Company": ["Berkshire Hathaway", "National Indemnity", "BHHC"],
+    "Old Republic Insurance Company": ["Old Republic", "Old Republic General"],
+    "Lancer Insurance Company": ["Lancer"],
+    "Northland Insurance Company": ["Northland"],
+    "Carolina Casualty Insurance Company": ["Carolina Casualty"],
+    "Westfield Insurance Company": ["Westfield"],
+    "The Cincinnati Insurance Company": ["Cincinnati Insurance", "Cincinnati"],
+    "Erie Insurance Exchange": ["Erie Insurance", "Erie"],
+    "Auto-Owners Insurance Company": ["Auto-Owners", "Auto Owners"],
+    "Selective Insurance Company of America": ["Selective"],
+    "Federated Mutual Insurance Company": ["Federated Insurance", "Federated Mutual"],
+    "Amerisure Mutual Insurance Company": ["Amerisure"],
+    "Acuity, A Mutual Insurance Company": ["Acuity"],
+    "Federal Insurance Company": ["Chubb USA", "Federal Insurance"],
+    "National Union Fire Insurance Company of Pittsburgh, PA": ["National Union Fire", "AIG USA"],
+    "Philadelphia Indemnity Insurance Company": ["Philadelphia Insurance", "PHLY"],
+    "The Hanover Insurance Company": ["Hanover"],
+    "Employers Mutual Casualty Company": ["EMC Insurance", "EMC"],
+    "Protective Insurance Company": ["Protective Insurance", "Baldwin & Lyons"],
+    "Crum & Forster": ["Crum and Forster", "North River Insurance Company"],
+    "Navigators Insurance Company": ["Navigators"],
+    "Berkley National Insurance Company": ["Berkley National", "W. R. Berkley"],
+    "Sompo America Insurance Company": ["Sompo"],
+    "Markel American Insurance Company": ["Markel American"],
+}
+
+# Extra carriers can be supplied as lines of "Canonical name|alias|alias"
+INSURER_LIST_PATH = os.getenv("CERT_INSURER_LIST", "")
+INSURER_MATCH_THRESHOLD = 0.6
+INSURER_STOPWORDS = {
+    "insurance", "assurance", "company", "compagnie", "co", "ltd", "limited", "inc", "incorporated",
+    "corp", "corporation", "the", "of", "and", "a", "group", "general", "na", "llc", "plc",
+}
+INSURER_LETTER_PATTERN = re.compile(r'^\s*(?:INSURER|INSR|INS\.?|CO\.?\s*LTR)?\s*([A-F])\s*$', re.I)
+
+def normalize_insurer_name(name):
+    """Lower-case key without punctuation, policy-number tokens or generic words like 'Insurance Company'."""
+    tokens = re.findall(r"[a-z0-9&']+", str(name).lower().replace("'s", "s"))
+    return " ".join(t for t in tokens if t not in INSURER_STOPWORDS and not any(c.isdigit() for c in t))
+
+def insurer_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class InsurerIndex:
+    """
+    Fuzzy resolver from extracted insurer strings to canonical carrier names.
+    Exact normalized keys are a dict lookup; everything else is ranked by trigram
+    Dice similarity through an inverted index. Answers are memoized.
+    """
+
+    def __init__(self, canonical_insurers):
+        self.canonical = []
+        self.keys = {}
+        self.trigram_sets = []
+        self.postings = collections.defaultdict(list)
+        self.cache = {}
+        for canonical, aliases in canonical_insurers.items():
+            for name in [canonical] + list(aliases):
+                key = normalize_insurer_name(name)
+                if not key or key in self.keys:
+                    continue
+                self.keys[key] = canonical
+                entry_id = len(self.canonical)
+                self.canonical.append(canonical)
+                trigrams = insurer_trigrams(key)
+                self.trigram_sets.append(len(trigrams))
+                for trigram in trigrams:
+                    self.postings[trigram].append(entry_id)
+
+    def resolve(self, name):
+        """Canonical name for ``name``, or None when nothing is similar enough."""
+        if name in self.cache:
+            return self.cache[name]
+        key = normalize_insurer_name(name)
+        result = self.keys.get(key)
+        if result is None and key:
+            trigrams = insurer_trigrams(key)
+            shared = collections.Counter()
+            for trigram in trigrams:
+                shared.update(self.postings.get(trigram, ()))
+            best_score = 0.0
+            for entry_id, count in shared.items():
+                score = 2 * count / (len(trigrams) + self.trigram_sets[entry_id])
+                if score > best_score:
+                    best_score, result = score, self.canonical[entry_id]
+            if best_score < INSURER_MATCH_THRESHOLD:
+                result = None
+        if len(self.cache) < 100000:
+            self.cache[name] = result
+        return result
+
+    def resolve_reference(self, value, letter_map=None):
+        """
+        Resolve an insuranceCompany value that may be a bare letter (A, "Insurer B", ...).
+        Returns (resolved value, anomaly or None); unknown names are kept as printed.
+        """
+        if is_blank(value) or is_missing(value):
+            return value, None
+        letter = INSURER_LETTER_PATTERN.match(str(value))
+        if letter:
+            name = (letter_map or {}).get(letter.group(1).upper())
+            if not name:
+                return "[unclear]", f"insurer letter {letter.group(1).upper()} has no name in the insurer table"
+            value = name
+        return self.resolve(value) or str(value).strip(), None
+
+    def resolve_many(self, names):
+        """Vectorized resolution for a pandas Series: each distinct value is resolved once."""
+        uniques = pd.Series(names.dropna().unique())
+        mapping = dict(zip(uniques, (self.resolve(name) or name for name in uniques)))
+        return names.map(mapping).where(names.notna(), names)
+
+def load_insurer_list(path):
+    """Read extra carriers from a "Canonical|alias|alias" file."""
+    insurers = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            names = [name.strip() for name in line.split("|") if name.strip()]
+            if names:
+                insurers[names[0]] = names[1:]
+    return insurers
+
+@st.cache_resource
+def get_insurer_index():
+    """Built once per process."""
+    insurers = dict(CANONICAL_INSURERS)
+    if INSURER_LIST_PATH and os.path.exists(INSURER_LIST_PATH):
+        insurers.update(load_insurer_list(INSURER_LIST_PATH))
+    return InsurerIndex(insurers)
+
+def resolve_structured_insurers(structured_data):
+    """Replace insurer letters and spellings in every coverage with canonical names; returns anomalies."""
+    index = get_insurer_index()
+    letter_map = {str(letter).strip().upper(): name for letter, name in (structured_data.get("insurers") or {}).items()
+                  if not is_blank(name)}
+    anomalies = []
+    for section in COVERAGE_SECTIONS:
+        values = structured_data.get(section)
+        if isinstance(values, dict) and "insuranceCompany" in values:
+            values["insuranceCompany"], anomaly = index.resolve_reference(values["insuranceCompany"], letter_map)
+            if anomaly:
+                anomalies.append(f"{section}.insuranceCompany: {anomaly}")
+    return anomalies
+
+INSURER_COLUMNS = [
+    "Automobile Liability Insurance Company",
+    "Each occ Commercial General Liability Insurance Company",
+    "Non-owned Trailer Insurance Company",
+]
+
+def resolve_certificate_insurers(certificates):
+    """Canonical insurer names for every insurer column of the certificates table."""
+    index = get_insurer_index()
+    resolved = certificates.copy()
+    for column in INSURER_COLUMNS:
+        if column in resolved:
+            resolved[column] = index.resolve_many(resolved[column])
+    return resolved
+
+# --------------------- Profiling ---------------------
+
+PROFILE_SAMPLE_SECONDS = 0.005
+PROFILE_HISTORY = 5
+PROFILE_TOP_ROWS = 15
+# Where a function's time is attributed in the summary, by module path or built-in name
+PROFILE_LAYERS = [
+    ("OpenCV", ("cv2",)),
+    ("PDF", ("PyPDF2", "pdf2image", "fitz", "pymupdf")),
+    ("HTTP", ("requests", "urllib3", "http/client", "ssl", "socket")),
+    ("Images", ("PIL",)),
+    ("SQLite", ("sqlite3",)),
+    ("Streamlit", ("streamlit",)),
+]
+# cProfile names OpenCV functions "<GaussianBlur>" without their module
+OPENCV_FUNCTIONS = frozenset(dir(cv2))
+
+class StackSampler:
+    """
+    Samples the Python stacks of a set of threads at a fixed interval; native calls show up
+    under their Python caller. Threads join and leave while sampling runs (see DocumentProfile).
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_SECONDS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread_ids = set()
+        self.frames = {}  # (name, file, line) -> frame index
+        self.samples = collections.defaultdict(list)  # thread id -> stacks
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def add_thread(self, thread_id):
+        with self.lock:
+            self.thread_ids.add(thread_id)
+
+    def remove_thread(self, thread_id):
+        with self.lock:
+            self.thread_ids.discard(thread_id)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                thread_ids = list(self.thread_ids)
+            current = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = current.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_name, code.co_filename, code.co_firstlineno)
+                    stack.append(self.frames.setdefault(key, len(self.frames)))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[thread_id].append(stack[::-1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def speedscope(self, name):
+        """Speedscope 'sampled' profile (https://www.speedscope.app), one profile per sampled thread."""
+        return json.dumps({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "certificate-classifier",
+            "shared": {"frames": [{"name": frame_name, "file": file, "line": line}
+                                  for frame_name, file, line in self.frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{name} (thread {number})",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": len(samples) * self.interval,
+                "samples": samples,
+                "weights": [self.interval] * len(samples),
+            } for number, samples in enumerate(self.samples.values())],
+        })
+
+# The document profile the running thread's work belongs to, if any
+PROFILE_CONTEXT = threading.local()
+
+class DocumentProfile:
+    """
+    cProfile and stack samples of one document across every thread that works on it.
+    cProfile only sees the thread that enables it, so work handed to another thread (stage
+    pipeline workers, pre-rendering, deployment calls) is wrapped with profiled(), which
+    profiles it on that thread into the same document profile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profilers = []
+        self.sampler = StackSampler()
+
+    @contextlib.contextmanager
+    def attach(self):
+        """Count the calling thread's time in this profile until the block ends."""
+        thread_id = threading.get_ident()
+        outer = getattr(PROFILE_CONTEXT, "profile", None)
+        profiler = cProfile.Profile()
+        PROFILE_CONTEXT.profile = self
+        self.sampler.add_thread(thread_id)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.sampler.remove_thread(thread_id)
+            PROFILE_CONTEXT.profile = outer
+            with self.lock:
+                self.profilers.append(profiler)
+
+    def run(self, function, *args, **kwargs):
+        with self.attach():
+            return function(*args, **kwargs)
+
+    def stats(self):
+        """Combined pstats of every thread; work still running on other threads is left out."""
+        with self.lock:
+            return pstats.Stats(*self.profilers)
+
+def profiled(function):
+    """``function`` wrapped to run inside the calling thread's document profile, or unchanged when there is none."""
+    profile = getattr(PROFILE_CONTEXT, "profile", None)
+    if profile is None:
+        return function
+    return functools.partial(profile.run, function)
+
+def profile_layer(filename, function_name):
+    if filename == "~" and function_name.strip("<>") in OPENCV_FUNCTIONS:
+        return "OpenCV"
+    location = f"{filename} {function_name}"
+    for layer, markers in PROFILE_LAYERS:
+        if any(marker in location for marker in markers):
+            return layer
+    return "App" if filename.endswith("UI.py") else "Other"
+
+def summarize_profile(stats):
+    """Own time per layer and the functions with the most own time."""
+    rows = []
+    for (filename, line, function_name), (_, calls, own, cumulative, _) in stats.stats.items():
+        rows.append({
+            "Function": function_name if filename == "~" else f"{function_name} ({os.path.basename(filename)}:{line})",
+            "Layer": profile_layer(filename, function_name),
+            "Calls": calls,
+            "Own s": own,
+            "Cumulative s": cumulative,
+        })
+    frame = pd.DataFrame(rows)
+    layers = frame.groupby("Layer")["Own s"].sum().sort_values(ascending=False).round(4)
+    top = frame.sort_values("Own s", ascending=False).head(PROFILE_TOP_ROWS).round({"Own s": 4, "Cumulative s": 4})
+    return layers.to_dict(), top
+
+@contextlib.contextmanager
+def profiled_document(file_name):
+    """Profile the enclosed block if profiling was requested for this document; otherwise do nothing."""
+    if st.session_state.get("profile_remaining", 0) <= 0:
+        yield
+        return
+    st.session_state.profile_remaining -= 1
+    profile = DocumentProfile()
+    start = time.perf_counter()
+    with profile.sampler as sampler, profile.attach():
+        yield
+    stats = profile.stats()
+    layers, top = summarize_profile(stats)
+    profiles = st.session_state.setdefault("profiles", [])
+    profiles.append({
+        "file_name": file_name,
+        "seconds": time.perf_counter() - start,
+        "layers": layers,
+        "top": top,
+        "pstats": marshal.dumps(stats.stats),
+        "speedscope": sampler.speedscope(file_name),
+    })
+    del profiles[:-PROFILE_HISTORY]
+
+def render_profiling_settings():
+    """Profiling controls and results for the API Settings tab."""
+    st.subheader("Profiling")
+    profile_col, button_col = st.columns([2, 1])
+    with profile_col:
+        count = st.number_input("Profile the next N documents", min_value=1, max_value=20, value=1)
+    with button_col:
+        st.write("")
+        if st.button("Start profiling"):
+            st.session_state.profile_remaining = int(count)
+    if st.session_state.get("profile_remaining", 0) > 0:
+        st.caption(f"The next {st.session_state.profile_remaining} document(s) will be profiled")
+
+    profiles = st.session_state.get("profiles", [])
+    if not profiles:
+        return
+    index = st.selectbox("Profile", range(len(profiles)), index=len(profiles) - 1,
+                         format_func=lambda i: f"{profiles[i]['file_name']} ({profiles[i]['seconds']:.2f}s)")
+    profile = profiles[index]
+    st.markdown("Own time by layer (s)")
+    st.json(profile["layers"])
+    st.dataframe(profile["top"], hide_index=True)
+    stem = os.path.splitext(profile["file_name"])[0]
+    pstats_col, speedscope_col = st.columns(2)
+    with pstats_col:
+        st.download_button("Download .pstats", profile["pstats"], file_name=f"{stem}.pstats")
+    with speedscope_col:
+        st.download_button("Download speedscope JSON", profile["speedscope"], file_name=f"{stem}.speedscope.json",
+                           mime="application/json")
+
+# --------------------- Normalization ---------------------
+
+DATE_FIELDS = {
+    "certificateInfo": ["effectiveDate", "expirationDate"],
+    "automobileLiability": ["expiryDate"],
+    "commercialGeneralLiability": ["expiryDate"],
+    "nonOwnedTrailer": ["expiryDate"],
+}
+AMOUNT_CURRENCY_FIELDS = [("amount", "currency"), ("deductibleAmount", "deductibleCurrency")]
+
+GROUPED_AMOUNT_PATTERN = re.compile(r'\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?')
+AMOUNT_CURRENCY_PATTERN = re.compile(r'^\s*(US\$|C\$|CA\$|CDN\$?|CAD|USD|\$)?\s*(.*?)\s*(CAD|USD|CDN)?\s*$', re.I)
+DAYS_PATTERN = re.compile(r'^\s*(\d{1,3})\s*(?:days?)?\s*$', re.I)
+
+# Printed currency markers → ISO codes; a bare "$" says nothing about the country
+CURRENCY_ALIASES = {
+    "US$": "USD", "USD": "USD",
+    "C$": "CAD", "CA$": "CAD", "CDN": "CAD", "CDN$": "CAD", "CAD": "CAD",
+}
+
+def normalize_amount(value):
+    """
+    Strip currency markers and thousands separators from an amount.
+    Returns (amount, printed currency code or None, anomaly or None);
+    amounts with irregular separators become "[unclear]".
+    """
+    text = str(value).strip()
+    match = AMOUNT_CURRENCY_PATTERN.match(text)
+    prefix, number, suffix = match.groups()
+    printed = CURRENCY_ALIASES.get((prefix or suffix or "").upper())
+    if GROUPED_AMOUNT_PATTERN.fullmatch(number):
+        return number.replace(",", ""), printed, None
+    return "[unclear]", printed, f"unusual amount format '{text}'"
+
+def normalize_currency(value):
+    code = str(value).strip().upper()
+    code = CURRENCY_ALIASES.get(code, code)
+    return code if CURRENCY_CODE_PATTERN.match(code) else None
+
+def normalize_structured_data(structured_data):
+    """
+    Apply the formatting rules locally instead of asking the model to follow them:
+      - dates to yyyy/mm/dd (YY/MM/DD and MM/DD/YYYY handled as in the extraction rules)
+      - amounts without commas or currency symbols
+      - currency taken from the insured's address, "missing" whenever the amount is missing
+      - insurer letters and spellings resolved to canonical carrier names
+    Returns (normalized copy, list of anomaly descriptions).
+    """
+    if not isinstance(structured_data, dict):
+        return structured_data, []
+
+    normalized = {section: dict(values) if isinstance(values, dict) else values
+                  for section, values in structured_data.items()}
+    anomalies = []
+
+    for section, fields in DATE_FIELDS.items():
+        values = normalized.get(section)
+        if not isinstance(values, dict):
+            continue
+        for field in fields:
+            value = values.get(field)
+            if is_blank(value) or is_missing(value):
+                continue
+            date = normalize_date(value)
+            if date is None:
+                anomalies.append(f"{section}.{field}: unreadable date '{value}'")
+                values[field] = "[unclear]"
+            else:
+                values[field] = date
+
+    info = normalized.get("certificateInfo") if isinstance(normalized.get("certificateInfo"), dict) else {}
+    address_currency = currency_from_address(info.get("address") or "")
+
+    for section in COVERAGE_SECTIONS:
+        values = normalized.get(section)
+        if not isinstance(values, dict):
+            continue
+        # The text prompt leaves absent values empty; the schema calls them "missing"
+        for field in COVERAGE_FIELDS:
+            value = values.get(field)
+            if value is None or str(value).strip() == "":
+                values[field] = "missing"
+
+        for amount_field, currency_field in AMOUNT_CURRENCY_FIELDS:
+            amount = values[amount_field]
+            if is_missing(amount):
+                if not is_missing(values[currency_field]):
+                    anomalies.append(f"{section}.{currency_field}: currency without an amount")
+                values[currency_field] = "missing"
+                continue
+            printed = None
+            if amount != "[unclear]":
+                amount, printed, anomaly = normalize_amount(amount)
+                values[amount_field] = amount
+                if anomaly:
+                    anomalies.append(f"{section}.{amount_field}: {anomaly}")
+            printed = normalize_currency(values[currency_field]) or printed
+            if address_currency:
+                if printed and printed != address_currency:
+                    anomalies.append(
+                        f"{section}.{currency_field}: printed {printed} but the address indicates {address_currency}"
+                    )
+                values[currency_field] = address_currency
+            else:
+                values[currency_field] = printed or "missing"
+
+    other = normalized.get("other")
+    if isinstance(other, dict):
+        period = other.get("cancellationNoticePeriod")
+        if isinstance(period, (int, float)):
+            other["cancellationNoticePeriod"] = str(int(period))
+        elif not (is_blank(period) or is_missing(period)):
+            days = DAYS_PATTERN.match(str(period))
+            if days:
+                other["cancellationNoticePeriod"] = days.group(1)
+            else:
+                anomalies.append(f"other.cancellationNoticePeriod: unreadable period '{period}'")
+
+    anomalies.extend(resolve_structured_insurers(normalized))
+    return normalized, anomalies
+
+def record_anomalies(anomalies):
+    """Collect normalization anomalies for the document being processed."""
+    st.session_state.setdefault("document_anomalies", []).extend(anomalies)
+
+def process_document(upload, file_name):
+    """
+    Process a document (image or PDF) and extract information.
+    ``upload`` is the uploaded file, bytes or any buffer; it is spooled to disk once and
+    every stage reads it from there.
+    """
+    # Built once per process; a no-op after warm-up
+    resources().get("ocr")
+    
+    try:
+        start = time.perf_counter()
+        with profiled_document(file_name), get_spool().job(current_session_id()) as job, RssMonitor() as monitor:
+            document = ingest_document(job, upload, file_name)
+            structured_data = extract_document(document)
+        record_ingestion(document, monitor, time.perf_counter() - start)
+        resources().record_document(time.perf_counter() - start)
+        return structured_data
                 
     except Exception as e:
         st.error(f"Error processing document: {str(e)}")
         st.error(traceback.format_exc())
         return None
 
-def flatten_structured_data(structured_data):
-    """Convert nested structured data to a flat dictionary for form values."""
-    flat_data = {}
-    
-    # Certificate Info
-    if "certificateInfo" in structured_data:
-        info = structured_data["certificateInfo"]
-        flat_data["cert_number_value"] = info.get("certificateNumber", "")
-        flat_data["template_form_value"] = info.get("templateForm", "")
-        flat_data["effective_date_value"] = info.get("effectiveDate", "")
-        flat_data["expiration_date_value"] = info.get("expirationDate", "")
-        flat_data["insured_name_value"] = info.get("insuredName", "")
-        flat_data["address_value"] = info.get("address", "")
-        flat_data["description_value"] = info.get("description", "")
-    
-    # Automobile Liability
-    if "automobileLiability" in structured_data:
-        auto = structured_data["automobileLiability"]
-        flat_data["auto_liability_insurance_company_value"] = auto.get("insuranceCompany", "")
-        flat_data["auto_liability_currency_value"] = auto.get("currency", "")
-        flat_data["auto_liability_amount_value"] = auto.get("amount", "")
-        flat_data["auto_liability_ded_currency_value"] = auto.get("deductibleCurrency", "")
-        flat_data["auto_liability_ded_amount_value"] = auto.get("deductibleAmount", "")
-        flat_data["auto_liability_expiry_date_value"] = auto.get("expiryDate", "")
-    
-    # Commercial General Liability
-    if "commercialGeneralLiability" in structured_data:
-        cgl = structured_data["commercialGeneralLiability"]
-        flat_data["cgl_company_value"] = cgl.get("insuranceCompany", "")
-        flat_data["cgl_currency_value"] = cgl.get("currency", "")
-        flat_data["cgl_amount_value"] = cgl.get("amount", "")
-        flat_data["cgl_ded_currency_value"] = cgl.get("deductibleCurrency", "")
-        flat_data["cgl_ded_amount_value"] = cgl.get("deductibleAmount", "")
-        flat_data["cgl_expiry_value"] = cgl.get("expiryDate", "")
-    
-    # Non-owned Trailer
-    if "nonOwnedTrailer" in structured_data:
-        trailer = structured_data["nonOwnedTrailer"]
-        flat_data["trailer_company_value"] = trailer.get("insuranceCompany", "")
-        flat_data["trailer_currency_value"] = trailer.get("currency", "")
-        flat_data["trailer_amount_value"] = trailer.get("amount", "")
-        flat_data["trailer_ded_currency_value"] = trailer.get("deductibleCurrency", "")
-        flat_data["trailer_ded_amount_value"] = trailer.get("deductibleAmount", "")
-        flat_data["trailer_expiry_value"] = trailer.get("expiryDate", "")
-    
-    # Other fields
-    if "other" in structured_data:
-        other = structured_data["other"]
-        flat_data["additional_insured_value"] = other.get("additionalInsured", "")
-        flat_data["certificate_holder_value"] = other.get("certificateHolder", "")
-        flat_data["cancellation_period_value"] = other.get("cancellationNoticePeriod", "")
-    
-    return flat_data
+def document_text(document):
+    """Returns (text of the relevant pages, per-page texts or None for images, skipped page numbers)."""
+    if document.is_pdf:
+        # Process PDF file; cover letters and policy wordings are left out of the text
+        page_texts = extract_pdf_page_texts(document.path)
+        relevant = select_relevant_pages(document.name, page_texts)
+        raw_text = "\n".join(text for text, keep in zip(page_texts, relevant) if keep)
+        return raw_text, page_texts, [page for page, keep in enumerate(relevant, start=1) if not keep]
+    # Process image file
+    return extract_text_from_image(document.path), None, []
+
+def run_extraction(document):
+    """
+    Text layer → rules/fast/vision cascade for one ingested document, without any UI.
+    Returns structured_data (None on failure), tier, anomalies, raw_text, page_count and skipped_pages.
+    """
+    st.session_state.document_anomalies = []
+    raw_text, page_texts, skipped = document_text(document)
+
+    # Get structured data through the rules → fast model → vision model cascade
+    structured_data, tier = structure_with_cascade(raw_text, document, page_texts)
+    return {
+        "structured_data": structured_data,
+        "tier": tier,
+        "anomalies": list(st.session_state.document_anomalies),
+        "raw_text": raw_text,
+        "page_count": len(page_texts) if page_texts is not None else 1,
+        "skipped_pages": skipped,
+    }
+
+def index_extraction(document, result):
+    """Record a finished extraction in the certificate index; returns its form values."""
+    form_values = flat_form_values(result["structured_data"])
+    get_certificate_index().upsert(document.sha1, document.name, "extracted", form_values,
+                                   page_count=result["page_count"], structured=result["structured_data"],
+                                   raw_text=result["raw_text"])
+    return form_values
+
+def extract_document(document):
+    """Extract one ingested document (or reuse the indexed answer) and queue it for review."""
+    if st.session_state.get("reuse_extractions", True):
+        cached = get_certificate_index().cached_extraction(document.sha1)
+        if cached:
+            st.caption("Answered from the certificate index; no model call was made")
+            enqueue_result(document.name, cached["page_count"], cached["structured_data"], "index",
+                           key=document.sha1, form_values=cached["form_values"])
+            return cached["structured_data"]
+
+    # Extract text using OCR - this would be replaced with your actual OCR implementation
+    with st.spinner("Extracting text from document..."):
+        result = run_extraction(document)
+
+    if result["skipped_pages"]:
+        st.caption(f"Skipped non-certificate pages: {', '.join(map(str, result['skipped_pages']))}")
+    if result["raw_text"]:
+        # Show extracted text in an expander for debugging
+        with st.expander("View Extracted Text"):
+            st.text(result["raw_text"])
+    else:
+        st.warning("No text could be extracted from the document; the pages went to the vision model.")
+
+    structured_data = result["structured_data"]
+    if structured_data:
+        st.caption(f"Structured by the {result['tier']} tier")
+        for anomaly in result["anomalies"]:
+            st.warning(f"Check {anomaly}")
+        
+        # Keep every document of the batch for review; the first one fills the form
+        form_values = index_extraction(document, result)
+        enqueue_result(document.name, result["page_count"], structured_data, result["tier"], result["anomalies"],
+                       key=document.sha1, form_values=form_values)
+        return structured_data
+    else:
+        st.error("Failed to extract structured data from the document.")
+        return None
+
+def flatten_structured_data(structured_data):
+    """Convert nested structured data to a flat dictionary for form values."""
+    flat_data = {}
+    for attribute, _, (section, field), _, _ in CERTIFICATE_FIELDS:
+        if section in structured_data:
+            flat_data[f"{attribute}_value"] = structured_data[section].get(field, "")
+    return flat_data
+
+def update_form_values(flat_data):
+    """Update form values from processed data."""
+    for key, value in flat_data.items():
+        if key in st.session_state.form_values:
+            if isinstance(value, (int, float)):
+                st.session_state.form_values[key] = str(value)
+            else:
+                st.session_state.form_values[key] = value
+
+def extract_pdf_page_texts(pdf_source):
+    """Text layer of each PDF page through the PDF backend (empty strings for scanned pages); accepts a path or bytes."""
+    try:
+        return pdf_backend().page_texts(pdf_source)
+    except Exception as e:
+        st.error(f"Error extracting text from PDF: {str(e)}")
+        return []
+
+def extract_text_from_pdf(pdf_content):
+    """Extract text from a PDF file."""
+    return "\n".join(extract_pdf_page_texts(pdf_content))
+
+def extract_text_from_image(image_source):
+    """Extract text from an image (path or bytes) using OCR."""
+    # This is a placeholder - implement with your preferred OCR library
+    try:
+        import pytesseract
+        from PIL import Image
+        from io import BytesIO
+        
+        image = Image.open(image_source if isinstance(image_source, str) else BytesIO(image_source))
+        text = pytesseract.image_to_string(image)
+        return text
+    except Exception as e:
+        st.error(f"Error extracting text from image: {str(e)}")
+        return ""
+
+def initialize_ocr():
+    """Initialize OCR engine."""
+    # Placeholder for OCR initialization
+    return "OCR initialized"
+
+def initialize_session_state():
+    """Initialize session state variables if they don't exist."""
+    if 'api_configured' not in st.session_state:
+        st.session_state.api_configured = False
+    
+    if 'endpoint' not in st.session_state:
+        st.session_state.endpoint = ""
+    
+    if 'api_key' not in st.session_state:
+        st.session_state.api_key = ""
+    
+    if 'fast_endpoint' not in st.session_state:
+        st.session_state.fast_endpoint = ""
+    
+    if 'fast_api_key' not in st.session_state:
+        st.session_state.fast_api_key = ""
+    
+    if 'rpm_limit' not in st.session_state:
+        st.session_state.rpm_limit = DEFAULT_RPM_LIMIT
+    
+    if 'tpm_limit' not in st.session_state:
+        st.session_state.tpm_limit = DEFAULT_TPM_LIMIT
+    
+    if 'extra_deployments' not in st.session_state:
+        st.session_state.extra_deployments = parse_deployments(os.getenv("AZURE_OPENAI_EXTRA_DEPLOYMENTS", ""))
+    
+    if 'hedge_requests' not in st.session_state:
+        st.session_state.hedge_requests = os.getenv("AZURE_OPENAI_HEDGE_REQUESTS", "") == "1"
+    
+    if 'admission_weight' not in st.session_state:
+        st.session_state.admission_weight = 1.0
+    
+    if 'certificates' not in st.session_state:
+        st.session_state.certificates = pd.DataFrame(columns=CERTIFICATE_COLUMNS)
+    
+    if 'form_values' not in st.session_state:
+        st.session_state.form_values = dict.fromkeys(FORM_WIDGET_KEYS, "")
+    
+    if 'last_structured_data' not in st.session_state:
+        st.session_state.last_structured_data = None
+    
+    if 'compliance_rules' not in st.session_state:
+        st.session_state.compliance_rules = json.loads(json.dumps(DEFAULT_COMPLIANCE_RULES))
+    
+    if 'batch_results' not in st.session_state:
+        start_results_batch()
+    
+    if 'certificates_version' not in st.session_state:
+        st.session_state.certificates_version = 0
+    
+    # Builds prompts, connections and indexes before the first upload instead of during it
+    resources().warm()
+    
+    # Scratch folders live in the shared spool so abandoned sessions get swept
+    st.session_state.temp_dir = get_spool().touch(current_session_id())
+
+def export_to_excel(df):
+    """Export dataframe to Excel format."""
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Certificates', index=False)
+    output.seek(0)
+    return output.getvalue()
+
+# --------------------- Certificate Index ---------------------
+
+CERT_INDEX_PATH = os.getenv("CERT_INDEX_PATH", "certificate_index.db")
+CERT_SEARCH_LIMIT = 20
+CERT_FUZZY_MIN_COVERAGE = 0.5   # share of the query's trigrams a fuzzy match must contain
+
+# Form values kept as searchable columns of the index
+INDEX_FORM_FIELDS = {
+    "insured_name": "insured_name_value",
+    "certificate_holder": "certificate_holder_value",
+    "certificate_number": "cert_number_value",
+    "auto_expiry": "auto_liability_expiry_date_value",
+    "cgl_expiry": "cgl_expiry_value",
+    "trailer_expiry": "trailer_expiry_value",
+}
+INDEX_INSURER_FIELDS = ["auto_liability_insurance_company_value", "cgl_company_value", "trailer_company_value"]
+
+class CertificateIndex:
+    """
+    Persistent SQLite index of extracted and saved certificates.
+    ``certificates`` holds one row per document, keyed by content hash (or a generated key for
+    manual entries); ``certificate_words`` (FTS5 with prefix indexes) serves word and prefix
+    lookups and ``certificate_trigrams`` (FTS5 trigram tokenizer) serves fuzzy name lookups.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS certificates (
+            id INTEGER PRIMARY KEY,
+            key TEXT UNIQUE NOT NULL,
+            file_name TEXT,
+            status TEXT,
+            page_count INTEGER,
+            insured_name TEXT,
+            certificate_holder TEXT,
+            certificate_number TEXT,
+            insurers TEXT,
+            auto_expiry TEXT,
+            cgl_expiry TEXT,
+            trailer_expiry TEXT,
+            form_values TEXT,
+            structured TEXT,
+            raw_text TEXT,
+            updated_at TEXT
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS certificate_words USING fts5(
+            insured_name, certificate_holder, insurers, certificate_number, raw_text,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS certificate_trigrams USING fts5(names, tokenize = 'trigram');
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+        self.stats = {"lookups": 0, "cache_hits": 0, "searches": 0, "last_search_ms": 0.0}
+
+    def upsert(self, key, file_name, status, form_values, page_count=None, structured=None, raw_text=None):
+        """Insert or update a document; text and extraction are kept when an update doesn't carry them."""
+        fields = {column: form_values.get(form_key, "") or "" for column, form_key in INDEX_FORM_FIELDS.items()}
+        fields["insurers"] = " | ".join(dict.fromkeys(
+            form_values.get(form_key) for form_key in INDEX_INSURER_FIELDS if form_values.get(form_key)
+        ))
+        values = dict(
+            fields, key=key, file_name=file_name, status=status, page_count=page_count,
+            form_values=json.dumps(form_values),
+            structured=json.dumps(structured) if structured is not None else None,
+            raw_text=raw_text, updated_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        columns = ", ".join(values)
+        placeholders = ", ".join(f":{column}" for column in values)
+        updates = ", ".join(
+            f"{column} = COALESCE(excluded.{column}, {column})" if column in ("page_count", "structured", "raw_text")
+            else f"{column} = excluded.{column}"
+            for column in values if column != "key"
+        )
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT INTO certificates ({columns}) VALUES ({placeholders}) ON CONFLICT(key) DO UPDATE SET {updates}",
+                values
+            )
+            row = self.connection.execute("SELECT * FROM certificates WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("DELETE FROM certificate_words WHERE rowid = ?", (row["id"],))
+            self.connection.execute("DELETE FROM certificate_trigrams WHERE rowid = ?", (row["id"],))
+            self.connection.execute(
+                "INSERT INTO certificate_words (rowid, insured_name, certificate_holder, insurers, certificate_number, raw_text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (row["id"], row["insured_name"], row["certificate_holder"], row["insurers"],
+                 row["certificate_number"], row["raw_text"] or "")
+            )
+            self.connection.execute(
+                "INSERT INTO certificate_trigrams (rowid, names) VALUES (?, ?)",
+                (row["id"], " | ".join(filter(None, (row["insured_name"], row["certificate_holder"], row["insurers"]))).lower())
+            )
+
+    def cached_extraction(self, key):
+        """Earlier answer for the same file (reviewed form values when it was saved), or None."""
+        with self.lock:
+            self.stats["lookups"] += 1
+            row = self.connection.execute(
+                "SELECT structured, form_values, status, page_count, raw_text FROM certificates WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row["structured"] is None:
+                return None
+            self.stats["cache_hits"] += 1
+        return {
+            "structured_data": json.loads(row["structured"]),
+            "form_values": json.loads(row["form_values"]) if row["status"] == "saved" else None,
+            "page_count": row["page_count"],
+            "raw_text": row["raw_text"] or "",
+        }
+
+    def search(self, query, limit=CERT_SEARCH_LIMIT):
+        """Word/prefix matches ranked by bm25, topped up with fuzzy (trigram) matches on the names."""
+        start = time.perf_counter()
+        words = re.findall(r"\w+", query)
+        matches = []
+        with self.lock:
+            if words:
+                expression = " ".join(f'"{word}"*' for word in words)
+                matches = [(row[0], "words") for row in self.connection.execute(
+                    "SELECT rowid FROM certificate_words WHERE certificate_words MATCH ? ORDER BY bm25(certificate_words) LIMIT ?",
+                    (expression, limit)
+                )]
+            needle = " ".join(query.lower().split())
+            if len(matches) < limit and len(needle) >= 3:
+                grams = {needle[i:i + 3] for i in range(len(needle) - 2)}
+                expression = " OR ".join('"' + gram.replace('"', '""') + '"' for gram in grams)
+                seen = {rowid for rowid, _ in matches}
+                for rowid, names in self.connection.execute(
+                    "SELECT rowid, names FROM certificate_trigrams WHERE certificate_trigrams MATCH ? "
+                    "ORDER BY bm25(certificate_trigrams) LIMIT ?", (expression, limit * 5)
+                ):
+                    found = sum(1 for gram in grams if gram in names)
+                    if rowid not in seen and found / len(grams) >= CERT_FUZZY_MIN_COVERAGE:
+                        matches.append((rowid, "fuzzy"))
+                        if len(matches) >= limit:
+                            break
+
+            rows = {}
+            if matches:
+                placeholders = ", ".join("?" * len(matches))
+                rows = {row["id"]: row for row in self.connection.execute(
+                    f"SELECT * FROM certificates WHERE id IN ({placeholders})", [rowid for rowid, _ in matches]
+                )}
+            self.stats["searches"] += 1
+            self.stats["last_search_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+        return pd.DataFrame([{
+            "File": rows[rowid]["file_name"],
+            "Status": rows[rowid]["status"],
+            "Insured": rows[rowid]["insured_name"],
+            "Certificate Holder": rows[rowid]["certificate_holder"],
+            "Insurers": rows[rowid]["insurers"],
+            "Auto Expiry": rows[rowid]["auto_expiry"],
+            "CGL Expiry": rows[rowid]["cgl_expiry"],
+            "Trailer Expiry": rows[rowid]["trailer_expiry"],
+            "Updated": rows[rowid]["updated_at"],
+            "Match": kind,
+        } for rowid, kind in matches if rowid in rows])
+
+    def snapshot(self):
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM certificates").fetchone()[0]
+            return dict(self.stats, path=os.path.abspath(self.path), documents=count)
+
+@st.cache_resource
+def get_certificate_index():
+    """Process-wide connection to the certificate index."""
+    return CertificateIndex(CERT_INDEX_PATH)
+
+def index_saved_result(entry, form_values):
+    """Record reviewed values; entries without an uploaded document get a key of their own."""
+    key = entry["key"] if entry and entry.get("key") else f"manual-{uuid.uuid4().hex}"
+    get_certificate_index().upsert(
+        key, entry["file_name"] if entry else "Manually entered", "saved", form_values,
+        page_count=entry["page_count"] if entry else None
+    )
+
+@st.fragment
+def render_certificate_search():
+    """Look up earlier certificates by insured, holder, insurer or any word of their text."""
+    get_session_registry().touch()
+    st.subheader("Search Certificates")
+    query = st.text_input("Insured, certificate holder, insurer or certificate number", key="certificate_search")
+    if query.strip():
+        index = get_certificate_index()
+        results = index.search(query)
+        if results.empty:
+            st.info("No indexed certificate matches.")
+        else:
+            st.dataframe(results, hide_index=True)
+        st.caption(f"{index.stats['last_search_ms']} ms")
+
+# --------------------- Ledger Import ---------------------
+
+LEDGER_CSV_BLOCK_BYTES = 1 << 20
+LEDGER_PLACEHOLDERS = ("", "missing", "[unclear]", "nan", "none")
+# Hash-indexed ledger columns; an incoming certificate matches on its number, else on insured and holder together
+LEDGER_KEY_COLUMNS = {"number": "Certificate Number", "insured": "Insured Name", "holder": "Certificate Holder"}
+# Where a certificate came from rather than what it says; updated without being reported as conflicts
+LEDGER_PROVENANCE_COLUMNS = ("Name of file", "Page Count")
+
+def ledger_cell_text(value):
+    """Excel cell → the string the certificates table would hold."""
+    if value is None:
+        return ""
+    if isinstance(value, date):
+        return value.strftime("%Y/%m/%d")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def read_ledger_csv(data):
+    """All columns as strings, parsed block by block by Arrow's streaming CSV reader."""
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    header = next(csv.reader(io.StringIO(data.split(b"\n", 1)[0].decode("utf-8-sig"))))
+    reader = pa_csv.open_csv(
+        io.BytesIO(data),
+        read_options=pa_csv.ReadOptions(block_size=LEDGER_CSV_BLOCK_BYTES, encoding="utf-8"),
+        convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in header},
+                                              strings_can_be_null=False, quoted_strings_can_be_null=False),
+    )
+    table = pa.Table.from_batches(list(reader), schema=reader.schema)
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+
+def read_ledger_excel(data):
+    """First sheet, read row by row in openpyxl's read-only mode."""
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [ledger_cell_text(name) for name in next(rows, ())]
+        columns = [[] for _ in header]
+        for row in rows:
+            for values, value in zip(columns, row):
+                values.append(ledger_cell_text(value))
+    finally:
+        workbook.close()
+    return pd.DataFrame({name: pd.array(values, dtype="string[pyarrow]") for name, values in zip(header, columns)})
+
+def ledger_keys(column):
+    """Normalized lookup keys of a column; placeholders become NA so they never match."""
+    keys = column.astype("string[pyarrow]").fillna("").str.casefold().str.replace(r"\s+", " ", regex=True).str.strip()
+    return keys.where(~keys.isin(LEDGER_PLACEHOLDERS))
+
+def ledger_value_key(value):
+    """ledger_keys for a single value ("" for placeholders)."""
+    key = " ".join(("" if pd.isna(value) else str(value)).split()).casefold()
+    return "" if key in LEDGER_PLACEHOLDERS else key
+
+class CertificateLedger:
+    """
+    An imported certificates ledger with hash indexes on certificate number, insured and holder.
+    ``frame`` keeps the ledger's own columns (Arrow-backed strings) plus any certificate column it
+    lacked; ``merge`` upserts certificates into it and reports the values it had to choose between.
+    """
+
+    def __init__(self, frame, name=""):
+        self.name = name
+        for column in CERTIFICATE_COLUMNS:
+            if column not in frame.columns:
+                frame[column] = pd.array([""] * len(frame), dtype="string[pyarrow]")
+        self.frame = frame.reset_index(drop=True)
+        self.build_indexes()
+
+    @classmethod
+    def load(cls, data, name):
+        frame = read_ledger_csv(data) if name.lower().endswith(".csv") else read_ledger_excel(data)
+        return cls(frame, name)
+
+    def build_indexes(self):
+        """{key name: {normalized value: row positions}}, built with one groupby per column."""
+        self.indexes = {}
+        for key, column in LEDGER_KEY_COLUMNS.items():
+            keys = ledger_keys(self.frame[column]).dropna()
+            # groupby positions are within the non-NA keys; map them back to ledger rows
+            positions = keys.index.to_numpy()
+            self.indexes[key] = {value: positions[rows].tolist()
+                                 for value, rows in keys.groupby(keys, sort=False).indices.items()}
+
+    def index_rows(self, rows, add=True):
+        """Add ledger rows to (or drop them from) the hash indexes without rebuilding them."""
+        for key, column in LEDGER_KEY_COLUMNS.items():
+            index = self.indexes[key]
+            for row in rows:
+                value = ledger_value_key(self.frame.at[row, column])
+                if not value:
+                    continue
+                if add:
+                    index.setdefault(value, []).append(row)
+                elif row in index.get(value, ()):
+                    index[value].remove(row)
+                    if not index[value]:
+                        del index[value]
+
+    def match(self, number, insured, holder):
+        """(rows the certificate matches, key used)."""
+        if isinstance(number, str) and number in self.indexes["number"]:
+            return self.indexes["number"][number], "Certificate Number"
+        if isinstance(insured, str) and isinstance(holder, str):
+            rows = set(self.indexes["insured"].get(insured, ())) & set(self.indexes["holder"].get(holder, ()))
+            if rows:
+                return sorted(rows), "Insured Name + Certificate Holder"
+        return [], None
+
+    def merge(self, certificates, keep="incoming"):
+        """
+        Upsert rows of a certificates table. A certificate matching one ledger row updates it (blank
+        and placeholder values never overwrite), one matching nothing is appended, one matching several
+        rows is left out and reported. ``keep`` decides conflicts: "incoming" or "ledger".
+        Returns {"inserted", "updated", "unchanged", "ambiguous", "conflicts" (DataFrame)}.
+        """
+        certificates = certificates.reset_index(drop=True)
+        incoming = {key: ledger_keys(certificates[column]) if column in certificates.columns
+                    else pd.Series(pd.NA, index=certificates.index, dtype="string[pyarrow]")
+                    for key, column in LEDGER_KEY_COLUMNS.items()}
+        columns = [column for column in certificates.columns if column in self.frame.columns]
+        updates = {column: {} for column in columns}
+        inserts, conflicts, ambiguous = [], [], []
+        updated = unchanged = 0
+        for position, row in enumerate(certificates[columns].itertuples(index=False, name=None)):
+            rows, matched_on = self.match(*(incoming[key].iloc[position] for key in LEDGER_KEY_COLUMNS))
+            if not rows:
+                inserts.append(position)
+                continue
+            # Ledger rows are reported as spreadsheet rows: 1-based, after the header
+            if len(rows) > 1:
+                ambiguous.append({"Name of file": certificates.at[position, "Name of file"] if "Name of file" in columns else "",
+                                  "Matched on": matched_on, "Ledger rows": ", ".join(str(row + 2) for row in rows)})
+                continue
+            target, changed = rows[0], False
+            for column, value in zip(columns, row):
+                value = "" if pd.isna(value) else str(value)
+                incoming_key, current_key = ledger_value_key(value), ledger_value_key(self.frame.at[target, column])
+                # Placeholders never overwrite, and case or spacing alone is no change
+                if not incoming_key or incoming_key == current_key:
+                    continue
+                if column in LEDGER_PROVENANCE_COLUMNS:
+                    updates[column][target] = value
+                    continue
+                if current_key:
+                    current = self.frame.at[target, column]
+                    conflicts.append({"Ledger row": target + 2, "Matched on": matched_on, "Column": column,
+                                      "Ledger value": current, "Incoming value": value,
+                                      "Kept": keep})
+                    if keep != "incoming":
+                        continue
+                updates[column][target] = value
+                changed = True
+            updated += changed
+            unchanged += not changed
+
+        rekeyed = sorted({row for column in LEDGER_KEY_COLUMNS.values() for row in updates.get(column, ())})
+        self.index_rows(rekeyed, add=False)
+        for column, values in updates.items():
+            if values:
+                self.frame.loc[list(values), column] = list(values.values())
+        self.index_rows(rekeyed)
+        if inserts:
+            added = certificates.iloc[inserts][columns].astype("string[pyarrow]")
+            for column in self.frame.columns.difference(columns):
+                added[column] = pd.array([""] * len(added), dtype="string[pyarrow]")
+            first = len(self.frame)
+            self.frame = pd.concat([self.frame, added[self.frame.columns]], ignore_index=True)
+            self.index_rows(range(first, len(self.frame)))
+        return {
+            "inserted": len(inserts),
+            "updated": updated,
+            "unchanged": unchanged,
+            "ambiguous": pd.DataFrame(ambiguous, columns=["Name of file", "Matched on", "Ledger rows"]),
+            "conflicts": pd.DataFrame(conflicts, columns=["Ledger row", "Matched on", "Column", "Ledger value",
+                                                          "Incoming value", "Kept"]),
+        }
+
+@st.fragment
+def render_ledger_import():
+    """Load an existing ledger and merge the saved certificates into it."""
+    get_session_registry().touch()
+    st.subheader("Ledger Import")
+    ledger_file = st.file_uploader("Certificates ledger (.xlsx or .csv)", type=["xlsx", "csv"], key="ledger_upload")
+    if ledger_file is None:
+        return
+    data = ledger_file.getvalue()
+    digest = hashlib.sha1(data).hexdigest()
+    loaded = st.session_state.get("ledger")
+    if loaded is None or loaded[0] != digest:
+        start = time.perf_counter()
+        with st.spinner("Loading ledger..."):
+            try:
+                ledger = CertificateLedger.load(data, ledger_file.name)
+            except Exception as e:
+                st.error(f"Could not read the ledger: {e}")
+                return
+        st.session_state.ledger = (digest, ledger)
+        st.session_state.ledger_load_ms = round((time.perf_counter() - start) * 1000)
+        st.session_state.ledger_merge = None
+    ledger = st.session_state.ledger[1]
+    st.caption(f"{len(ledger.frame)} rows from {ledger.name}, loaded and indexed in {st.session_state.ledger_load_ms} ms")
+
+    keep = st.radio("On conflict keep", ["incoming", "ledger"], horizontal=True, key="ledger_keep",
+                    format_func={"incoming": "Extracted value", "ledger": "Ledger value"}.get)
+    if st.button("Merge saved certificates", disabled=st.session_state.certificates.empty):
+        start = time.perf_counter()
+        result = ledger.merge(st.session_state.certificates, keep)
+        result["ms"] = round((time.perf_counter() - start) * 1000)
+        st.session_state.ledger_merge = result
+
+    result = st.session_state.get("ledger_merge")
+    if result:
+        st.success(f"{result['inserted']} inserted, {result['updated']} updated, {result['unchanged']} unchanged, "
+                   f"{len(result['ambiguous'])} ambiguous, {len(result['conflicts'])} conflicting values "
+                   f"in {result['ms']} ms")
+        if not result["conflicts"].empty:
+            st.dataframe(result["conflicts"], hide_index=True)
+        if not result["ambiguous"].empty:
+            st.caption("Matched several ledger rows; not merged")
+            st.dataframe(result["ambiguous"], hide_index=True)
+        st.download_button("Download merged ledger", export_to_excel(ledger.frame),
+                           file_name="certificates_ledger.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+# --------------------- Admission Control ---------------------
+
+# Documents extracted at once across every session of the process
+ADMISSION_MAX_CONCURRENT = int(os.getenv("CERT_MAX_CONCURRENT_EXTRACTIONS", "4"))
+# Single documents (camera scans, one upload) go ahead of bulk uploads...
+ADMISSION_LANES = ("interactive", "bulk")
+# ...but after this many interactive grants in a row a waiting bulk document goes next
+ADMISSION_INTERACTIVE_BURST = 4
+ADMISSION_HISTORY_SIZE = 200
+ADMISSION_POLL_SECONDS = 1.0
+
+class AdmissionTicket:
+    """One document waiting for (or holding) an extraction slot."""
+
+    def __init__(self, session_id, lane, weight, file_name, tag):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.lane = lane
+        self.weight = weight
+        self.file_name = file_name
+        self.tag = tag
+        self.enqueued = time.monotonic()
+        self.granted = None
+        self.ready = False  # the session's script is blocked on this ticket
+
+class AdmissionScheduler:
+    """
+    Process-wide admission control in front of document extraction.
+    At most ``max_concurrent`` documents are extracted at once. Waiting documents are served
+    interactive lane first (with a burst limit so bulk uploads still progress), and within a lane
+    by weighted fair queueing across sessions: every ticket gets a virtual finish tag of
+    max(lane clock, the session's previous tag) + 1 / weight, and the smallest tag goes next.
+    A session's whole upload is queued at once, so its depth and position are visible.
+    """
+
+    def __init__(self, max_concurrent):
+        self.condition = threading.Condition()
+        self.max_concurrent = max_concurrent
+        self.waiting = {lane: [] for lane in ADMISSION_LANES}
+        self.running = {}
+        self.clock = {lane: 0.0 for lane in ADMISSION_LANES}
+        self.session_tags = {}
+        self.interactive_streak = 0
+        self.history = {lane: collections.deque(maxlen=ADMISSION_HISTORY_SIZE) for lane in ADMISSION_LANES}
+        self.run_seconds = collections.deque(maxlen=ADMISSION_HISTORY_SIZE)
+        self.stats = {"admitted": 0, "cancelled": 0}
+
+    def configure(self, max_concurrent):
+        with self.condition:
+            self.max_concurrent = max_concurrent
+            self.condition.notify_all()
+
+    def submit(self, session_id, lane, weight, file_names):
+        """Queue a session's documents in order; returns one ticket per file."""
+        weight = max(float(weight), 0.01)
+        tickets = []
+        with self.condition:
+            for file_name in file_names:
+                key = (lane, session_id)
+                tag = max(self.clock[lane], self.session_tags.get(key, 0.0)) + 1 / weight
+                self.session_tags[key] = tag
+                ticket = AdmissionTicket(session_id, lane, weight, file_name, tag)
+                self.waiting[lane].append(ticket)
+                tickets.append(ticket)
+        return tickets
+
+    def _order(self, lane):
+        return sorted(self.waiting[lane], key=lambda ticket: ticket.tag)
+
+    def _next(self):
+        """The ready ticket that goes next, or None."""
+        interactive = [ticket for ticket in self._order("interactive") if ticket.ready]
+        bulk = [ticket for ticket in self._order("bulk") if ticket.ready]
+        if interactive and (not bulk or self.interactive_streak < ADMISSION_INTERACTIVE_BURST):
+            return interactive[0]
+        return bulk[0] if bulk else None
+
+    def ahead_of(self, ticket):
+        """Documents that will be extracted before this one (running ones included)."""
+        with self.condition:
+            ahead = len(self.running)
+            if ticket.lane == "bulk":
+                ahead += len(self.waiting["interactive"])
+            ahead += sum(1 for other in self.waiting[ticket.lane] if other.tag < ticket.tag)
+            return ahead
+
+    def acquire(self, ticket, on_wait=None):
+        """Block until the ticket is granted a slot; ``on_wait`` is called with the number ahead while waiting."""
+        with self.condition:
+            ticket.ready = True
+            self.condition.notify_all()
+            while not (len(self.running) < self.max_concurrent and self._next() is ticket):
+                if on_wait is not None:
+                    self.condition.release()
+                    try:
+                        on_wait(self.ahead_of(ticket))
+                    finally:
+                        self.condition.acquire()
+                self.condition.wait(ADMISSION_POLL_SECONDS)
+            self.waiting[ticket.lane].remove(ticket)
+            self.running[ticket.id] = ticket
+            self.clock[ticket.lane] = max(self.clock[ticket.lane], ticket.tag - 1 / ticket.weight)
+            self.interactive_streak = self.interactive_streak + 1 if ticket.lane == "interactive" else 0
+            ticket.granted = time.monotonic()
+            self.history[ticket.lane].append(ticket.granted - ticket.enqueued)
+            self.stats["admitted"] += 1
+
+    def release(self, ticket):
+        with self.condition:
+            if self.running.pop(ticket.id, None) is not None:
+                self.run_seconds.append(time.monotonic() - ticket.granted)
+            self.condition.notify_all()
+
+    def cancel(self, tickets):
+        """Drop tickets that were never granted (the session's run was interrupted or failed)."""
+        with self.condition:
+            for ticket in tickets:
+                if ticket.granted is None and ticket in self.waiting[ticket.lane]:
+                    self.waiting[ticket.lane].remove(ticket)
+                    self.stats["cancelled"] += 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def admit(self, ticket, on_wait=None):
+        self.acquire(ticket, on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
 
-def update_form_values(flat_data):
-    """Update form values from processed data."""
-    for key, value in flat_data.items():
-        if key in st.session_state.form_values:
-            if isinstance(value, (int, float)):
-                st.session_state.form_values[key] = str(value)
-            else:
-                st.session_state.form_values[key] = value
+    def estimated_wait(self, ahead):
+        """Seconds until a document with ``ahead`` documents before it starts, from recent run times."""
+        with self.condition:
+            typical = float(np.median(self.run_seconds)) if self.run_seconds else None
+            return None if typical is None else ahead * typical / self.max_concurrent
+
+    def active_sessions(self):
+        """Sessions with documents waiting for or holding a slot; their scripts are still running."""
+        with self.condition:
+            return ({ticket.session_id for lane in ADMISSION_LANES for ticket in self.waiting[lane]}
+                    | {ticket.session_id for ticket in self.running.values()})
+
+    def session_view(self, session_id):
+        with self.condition:
+            waiting = [ticket for lane in ADMISSION_LANES for ticket in self.waiting[lane]
+                       if ticket.session_id == session_id]
+            running = [ticket for ticket in self.running.values() if ticket.session_id == session_id]
+        return {"waiting": len(waiting), "running": len(running),
+                "ahead": min((self.ahead_of(ticket) for ticket in waiting), default=0)}
+
+    def snapshot(self):
+        with self.condition:
+            return dict(
+                self.stats,
+                max_concurrent=self.max_concurrent,
+                running=len(self.running),
+                sessions_waiting=len({ticket.session_id for lane in ADMISSION_LANES for ticket in self.waiting[lane]}),
+                **{f"{lane}_waiting": len(self.waiting[lane]) for lane in ADMISSION_LANES},
+                **{f"{lane}_wait_p50_s": round(float(np.percentile(self.history[lane], 50)), 2)
+                   for lane in ADMISSION_LANES if self.history[lane]},
+                **{f"{lane}_wait_p95_s": round(float(np.percentile(self.history[lane], 95)), 2)
+                   for lane in ADMISSION_LANES if self.history[lane]},
+            )
+
+@st.cache_resource
+def get_admission_scheduler():
+    """One scheduler per process, shared by every session."""
+    return AdmissionScheduler(ADMISSION_MAX_CONCURRENT)
+
+def admission_lane(document_count):
+    return "interactive" if document_count == 1 else "bulk"
+
+def process_documents(documents):
+    """
+    Extract a session's documents (pairs of upload and file name) one at a time, each after the
+    admission scheduler grants it a slot; the reviewer sees how many documents are ahead.
+    """
+    scheduler = get_admission_scheduler()
+    tickets = scheduler.submit(current_session_id(), admission_lane(len(documents)),
+                               st.session_state.get("admission_weight", 1.0), [name for _, name in documents])
+    status = st.empty()
+
+    def show_position(ahead):
+        estimate = scheduler.estimated_wait(ahead)
+        status.info(f"Waiting for an extraction slot: {ahead} document(s) ahead"
+                    + (f", about {estimate:.0f}s" if estimate is not None else ""))
 
-def extract_text_from_pdf(pdf_content):
-    """Extract text from a PDF file using PyPDF2."""
-    # This is a placeholder - implement with your preferred PDF extraction library
     try:
-        from io import BytesIO
-        import PyPDF2
-        
-        pdf_file = BytesIO(pdf_content)
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page_num in range(len(pdf_reader.pages)):
-            text += pdf_reader.pages[page_num].extract_text() + "\n"
-        return text
-    except Exception as e:
-        st.error(f"Error extracting text from PDF: {str(e)}")
-        return ""
+        for ticket, (upload, file_name) in zip(tickets, documents):
+            with scheduler.admit(ticket, on_wait=show_position):
+                status.empty()
+                with st.spinner(f"Processing {file_name}..."):
+                    if process_document(upload, file_name):
+                        st.success(f"{file_name} processed!")
+    finally:
+        scheduler.cancel(tickets)
 
-def extract_text_from_image(image_content):
-    """Extract text from an image using OCR."""
-    # This is a placeholder - implement with your preferred OCR library
+def render_admission_status():
+    """Where this session stands in the process-wide extraction queue."""
+    snapshot = get_admission_scheduler().snapshot()
+    view = get_admission_scheduler().session_view(current_session_id())
+    caption = (f"Extraction slots: {snapshot['running']}/{snapshot['max_concurrent']} busy, "
+               f"{snapshot['interactive_waiting']} single and {snapshot['bulk_waiting']} bulk document(s) waiting")
+    if view["waiting"]:
+        caption += f" · yours: {view['waiting']} waiting, {view['ahead']} ahead"
+    st.caption(caption)
+
+# --------------------- Work Queue ---------------------
+
+# "" keeps extraction inline in the web process; "sqlite" or "memory" hands it to workers (worker.py)
+WORK_QUEUE_BACKEND = os.getenv("CERT_WORK_QUEUE", "")
+WORK_QUEUE_DIR = os.getenv("CERT_WORK_QUEUE_DIR", "work_queue")
+WORK_LEASE_SECONDS = int(os.getenv("CERT_WORK_LEASE_SECONDS", "120"))
+WORK_MAX_ATTEMPTS = int(os.getenv("CERT_WORK_MAX_ATTEMPTS", "3"))
+WORK_POLL_SECONDS = 2
+WORK_RETENTION_SECONDS = 24 * 3600
+
+class WorkQueueBackend(abc.ABC):
+    """
+    Contract every work-queue backend satisfies:
+      - enqueue(payload) stores a job and returns its id.
+      - lease(worker_id) hands the oldest runnable job to one worker for WORK_LEASE_SECONDS,
+        with a fresh lease token. Jobs whose lease expired (crashed worker) are runnable again
+        until they have been attempted WORK_MAX_ATTEMPTS times.
+      - renew/complete/fail only succeed for the current lease token, so a worker whose lease
+        was taken over can never overwrite the new owner's work; complete records a result once.
+      - status(job_ids) reports status, attempts, result and error per job.
+    """
+
+    @abc.abstractmethod
+    def enqueue(self, payload):
+        pass
+
+    @abc.abstractmethod
+    def lease(self, worker_id):
+        pass
+
+    @abc.abstractmethod
+    def renew(self, job_id, token):
+        pass
+
+    @abc.abstractmethod
+    def complete(self, job_id, token, result):
+        pass
+
+    @abc.abstractmethod
+    def fail(self, job_id, token, error):
+        pass
+
+    @abc.abstractmethod
+    def status(self, job_ids):
+        pass
+
+    @abc.abstractmethod
+    def snapshot(self):
+        pass
+
+class SQLiteWorkQueue(WorkQueueBackend):
+    """Work queue in an SQLite file shared by every replica and worker process on the host."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_token TEXT,
+            lease_expires REAL,
+            result TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, created);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self):
+        # One connection per thread; BEGIN IMMEDIATE serializes writers across processes
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, payload, status, created, updated) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, json.dumps(payload), now, now)
+            )
+        return job_id
+
+    def lease(self, worker_id):
+        now = time.time()
+        with self.transaction() as connection:
+            ended = connection.execute(
+                "SELECT payload FROM jobs WHERE (status IN ('done', 'failed') AND updated < ?) "
+                "OR (status = 'leased' AND lease_expires < ? AND attempts >= ?)",
+                (now - WORK_RETENTION_SECONDS, now, WORK_MAX_ATTEMPTS)
+            ).fetchall()
+            connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                               (now - WORK_RETENTION_SECONDS,))
+            # Leases of crashed workers that used up their attempts end the job
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'worker lease expired too often', updated = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, WORK_MAX_ATTEMPTS)
+            )
+            # Interactive documents first, then the session with the fewest leased jobs per unit of weight
+            row = connection.execute(
+                "SELECT id, payload, attempts FROM jobs AS j WHERE status = 'queued' "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY json_extract(payload, '$.lane') IS 'bulk', "
+                "(SELECT COUNT(*) FROM jobs AS l WHERE l.status = 'leased' AND l.lease_expires >= ? "
+                " AND json_extract(l.payload, '$.session') IS json_extract(j.payload, '$.session')) "
+                "/ COALESCE(json_extract(payload, '$.weight'), 1.0), created LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is not None:
+                token = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE jobs SET status = 'leased', attempts = attempts + 1, lease_owner = ?, lease_token = ?, "
+                    "lease_expires = ?, updated = ? WHERE id = ?",
+                    (worker_id, token, now + WORK_LEASE_SECONDS, now, row["id"])
+                )
+        # Jobs ended or dropped here never reach process_queue_job's cleanup
+        remove_staged_documents(json.loads(ended_row["payload"]) for ended_row in ended)
+        if row is None:
+            return None
+        return {"id": row["id"], "token": token, "payload": json.loads(row["payload"]), "attempt": row["attempts"] + 1}
+
+    def renew(self, job_id, token):
+        now = time.time()
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (now + WORK_LEASE_SECONDS, now, job_id, token)
+            ).rowcount == 1
+
+    def complete(self, job_id, token, result):
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'done', result = ?, lease_token = NULL, updated = ? "
+                "WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (json.dumps(result), time.time(), job_id, token)
+            ).rowcount == 1
+
+    def fail(self, job_id, token, error):
+        with self.transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "error = ?, lease_token = NULL, updated = ? WHERE id = ? AND lease_token = ? AND status = 'leased'",
+                (WORK_MAX_ATTEMPTS, error, time.time(), job_id, token)
+            ).rowcount == 1
+
+    def status(self, job_ids):
+        if not job_ids:
+            return {}
+        placeholders = ", ".join("?" * len(job_ids))
+        rows = self.connection().execute(
+            f"SELECT id, status, attempts, result, error FROM jobs WHERE id IN ({placeholders})", list(job_ids)
+        )
+        return {row["id"]: {"status": row["status"], "attempts": row["attempts"],
+                            "result": json.loads(row["result"]) if row["result"] else None, "error": row["error"]}
+                for row in rows}
+
+    def snapshot(self):
+        rows = self.connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict({"backend": "sqlite", "path": os.path.abspath(self.path)}, **{status: count for status, count in rows})
+
+class MemoryWorkQueue(WorkQueueBackend):
+    """In-process stand-in with the same lease semantics, for a single replica and for tests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+
+    def enqueue(self, payload):
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"payload": payload, "status": "queued", "attempts": 0, "token": None,
+                                 "expires": 0.0, "result": None, "error": None, "updated": time.time()}
+        return job_id
+
+    def lease(self, worker_id):
+        now = time.time()
+        ended, leased_job = [], None
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job["status"] in ("done", "failed") and job["updated"] < now - WORK_RETENTION_SECONDS]:
+                ended.append(self.jobs.pop(job_id)["payload"])
+            runnable = []
+            for job_id, job in self.jobs.items():
+                expired = job["status"] == "leased" and job["expires"] < now
+                if expired and job["attempts"] >= WORK_MAX_ATTEMPTS:
+                    job.update(status="failed", error="worker lease expired too often", updated=now)
+                    ended.append(job["payload"])
+                elif job["status"] == "queued" or expired:
+                    runnable.append(job_id)
+            if runnable:
+                # Same order as the SQLite queue: interactive first, then the least-served session, then age
+                leased = collections.Counter(job["payload"].get("session") for job in self.jobs.values()
+                                             if job["status"] == "leased" and job["expires"] >= now)
+                position = {job_id: number for number, job_id in enumerate(self.jobs)}
+                job_id = min(runnable, key=lambda job_id: (
+                    self.jobs[job_id]["payload"].get("lane") == "bulk",
+                    leased[self.jobs[job_id]["payload"].get("session")] / self.jobs[job_id]["payload"].get("weight", 1.0),
+                    position[job_id],
+                ))
+                job = self.jobs[job_id]
+                job.update(status="leased", attempts=job["attempts"] + 1, token=uuid.uuid4().hex,
+                           expires=now + WORK_LEASE_SECONDS, owner=worker_id)
+                leased_job = {"id": job_id, "token": job["token"], "payload": job["payload"], "attempt": job["attempts"]}
+        # Jobs ended or dropped here never reach process_queue_job's cleanup
+        remove_staged_documents(ended)
+        return leased_job
+
+    def leased_job(self, job_id, token):
+        job = self.jobs.get(job_id)
+        return job if job and job["status"] == "leased" and job["token"] == token else None
+
+    def renew(self, job_id, token):
+        with self.lock:
+            job = self.leased_job(job_id, token)
+            if job:
+                job["expires"] = time.time() + WORK_LEASE_SECONDS
+            return job is not None
+
+    def complete(self, job_id, token, result):
+        with self.lock:
+            job = self.leased_job(job_id, token)
+            if job:
+                job.update(status="done", result=result, token=None, updated=time.time())
+            return job is not None
+
+    def fail(self, job_id, token, error):
+        with self.lock:
+            job = self.leased_job(job_id, token)
+            if job:
+                job.update(status="failed" if job["attempts"] >= WORK_MAX_ATTEMPTS else "queued", error=error,
+                           token=None, updated=time.time())
+            return job is not None
+
+    def status(self, job_ids):
+        with self.lock:
+            return {job_id: {key: self.jobs[job_id][key] for key in ("status", "attempts", "result", "error")}
+                    for job_id in job_ids if job_id in self.jobs}
+
+    def snapshot(self):
+        with self.lock:
+            return dict({"backend": "memory"}, **collections.Counter(job["status"] for job in self.jobs.values()))
+
+@st.cache_resource
+def get_work_queue():
+    """Configured work queue, or None when documents are extracted inline."""
+    if WORK_QUEUE_BACKEND == "sqlite":
+        os.makedirs(WORK_QUEUE_DIR, exist_ok=True)
+        return SQLiteWorkQueue(os.path.join(WORK_QUEUE_DIR, "jobs.db"))
+    if WORK_QUEUE_BACKEND == "memory":
+        return MemoryWorkQueue()
+    return None
+
+def submit_document(queue, upload, file_name, lane="interactive"):
+    """Stage an upload where every worker can read it and queue its extraction; returns the job to poll."""
+    folder = os.path.join(WORK_QUEUE_DIR, "documents", uuid.uuid4().hex)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, os.path.basename(file_name))
+    view = upload_buffer(upload)
     try:
-        import pytesseract
-        from PIL import Image
-        from io import BytesIO
-        
-        image = Image.open(BytesIO(image_content))
-        text = pytesseract.image_to_string(image)
-        return text
+        size, sha1 = view.nbytes, write_buffer(view, path)
+    finally:
+        view.release()
+    job_id = queue.enqueue({"path": path, "file_name": os.path.basename(file_name), "size": size,
+                            "sha1": sha1, "reuse": st.session_state.get("reuse_extractions", True),
+                            "session": current_session_id(), "lane": lane,
+                            "weight": st.session_state.get("admission_weight", 1.0)})
+    return {"id": job_id, "file_name": os.path.basename(file_name), "sha1": sha1}
+
+def remove_staged_documents(payloads):
+    """Delete the folders submit_document staged these jobs' uploads in."""
+    for payload in payloads:
+        if payload.get("path"):
+            shutil.rmtree(os.path.dirname(payload["path"]), ignore_errors=True)
+
+def process_queue_job(queue, job, worker_id):
+    """
+    Run one leased job in a worker: extract the staged document, index it and record the result.
+    The lease is renewed in the background while the extraction runs.
+    """
+    payload = job["payload"]
+    stop_renewing = threading.Event()
+
+    def keep_lease():
+        while not stop_renewing.wait(WORK_LEASE_SECONDS / 3):
+            if not queue.renew(job["id"], job["token"]):
+                return
+
+    renewer = threading.Thread(target=keep_lease, daemon=True)
+    renewer.start()
+    try:
+        cached = get_certificate_index().cached_extraction(payload["sha1"]) if payload.get("reuse") else None
+        if cached:
+            result = {"structured_data": cached["structured_data"], "form_values": cached["form_values"],
+                      "tier": "index", "anomalies": [], "page_count": cached["page_count"]}
+        else:
+            with get_spool().job(worker_id) as spool_job:
+                document = IngestedDocument(spool_job, payload["path"], payload["file_name"], payload["size"], payload["sha1"])
+                extraction = run_extraction(document)
+                if not extraction["structured_data"]:
+                    raise ValueError("Failed to extract structured data from the document.")
+                form_values = index_extraction(document, extraction)
+            result = {"structured_data": extraction["structured_data"], "form_values": form_values,
+                      "tier": extraction["tier"], "anomalies": extraction["anomalies"],
+                      "page_count": extraction["page_count"]}
+        recorded = queue.complete(job["id"], job["token"], result)
     except Exception as e:
-        st.error(f"Error extracting text from image: {str(e)}")
-        return ""
+        recorded = False
+        queue.fail(job["id"], job["token"], f"{e}\n{traceback.format_exc()}")
+    finally:
+        stop_renewing.set()
+    final = queue.status([job["id"]]).get(job["id"], {})
+    if final.get("status") in ("done", "failed"):
+        remove_staged_documents([payload])
+    return recorded
 
-def initialize_ocr():
-    """Initialize OCR engine."""
-    # Placeholder for OCR initialization
-    return "OCR initialized"
+@st.fragment(run_every=WORK_POLL_SECONDS)
+def render_queued_jobs():
+    """Move finished queued documents into the review queue; polls while any are outstanding."""
+    for failure in st.session_state.get("queued_failures", []):
+        st.error(failure)
+    pending = st.session_state.get("queued_jobs")
+    queue = get_work_queue()
+    if not pending or queue is None:
+        return
+    # Outstanding jobs keep the session active; finished ones are written into the review queue
+    get_session_registry().touch()
+    statuses = queue.status([job["id"] for job in pending])
+    finished = False
+    for job in list(pending):
+        status = statuses.get(job["id"], {"status": "failed", "error": "job is no longer in the queue"})
+        if status["status"] == "done":
+            result = status["result"]
+            enqueue_result(job["file_name"], result["page_count"], result["structured_data"], result["tier"],
+                           result["anomalies"], key=job["sha1"], form_values=result["form_values"])
+        elif status["status"] == "failed":
+            st.session_state.setdefault("queued_failures", []).append(
+                f"{job['file_name']} could not be extracted: {status['error'].splitlines()[0]}"
+            )
+        else:
+            continue
+        pending.remove(job)
+        finished = True
+    if finished:
+        st.rerun()
+    st.info(f"Waiting for workers: {len(pending)} document(s) in the queue")
 
-def initialize_session_state():
-    """Initialize session state variables if they don't exist."""
-    if 'api_configured' not in st.session_state:
-        st.session_state.api_configured = False
+# --------------------- Batch Mode ---------------------
+
+BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT", "")
+BATCH_API_VERSION = os.getenv("AZURE_OPENAI_BATCH_API_VERSION", "2024-10-21")
+# Azure batch input files are limited to 100k requests and 200 MB
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def batch_custom_id(sha1, stage, index):
+    """
+    Stable id: the same manifest entry and stage always map to the same request. The manifest
+    index keeps ids unique when two inputs have identical bytes, which the Batch API rejects.
+    """
+    return f"{sha1}-{index}-{stage}"
+
+def batch_request_line(custom_id, payload):
+    body = dict(payload, model=BATCH_DEPLOYMENT) if BATCH_DEPLOYMENT else payload
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body})
+
+def write_batch_files(lines, directory, stem):
+    """Write request lines into as many JSONL files as the batch size limits require."""
+    paths = []
+    f = None
+    count = size = 0
+    for line in lines:
+        encoded = (line + "\n").encode("utf-8")
+        if f is None or count >= BATCH_MAX_REQUESTS or size + len(encoded) > BATCH_MAX_BYTES:
+            if f:
+                f.close()
+            paths.append(os.path.join(directory, f"{stem}_{len(paths) + 1:03d}.jsonl"))
+            f = open(paths[-1], "wb")
+            count = size = 0
+        f.write(encoded)
+        count += 1
+        size += len(encoded)
+    if f:
+        f.close()
+    return paths
+
+def compile_batch_document(path, stage, earlier=None):
+    """
+    Prepare one document for a batch round. Returns (request line or None, manifest entry).
+    The text stage answers from the local rules when they pass and goes straight to the vision
+    stage for documents without a text layer; ``earlier`` is the manifest entry of the previous round
+    and carries the entry's ``index`` in the manifest.
+    """
+    with open(path, "rb") as f, get_spool().job("batch") as job:
+        upload = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        try:
+            document = ingest_document(job, upload, path)
+        finally:
+            if isinstance(upload, mmap.mmap):
+                upload.close()
+        raw_text, page_texts, _ = document_text(document)
+        entry = dict(earlier or {}, path=path, file_name=document.name, sha1=document.sha1, raw_text=raw_text,
+                     page_count=len(page_texts) if page_texts is not None else 1)
+        if stage == "text":
+            structured = extract_with_rules(raw_text) if raw_text else None
+            score, _ = score_structured_data(structured)
+            if score >= CASCADE_CONFIDENCE_THRESHOLD:
+                entry.update(structured_data=structured, tier="rules")
+                return None, entry
+            if raw_text:
+                entry["custom_id"] = batch_custom_id(document.sha1, "text", entry["index"])
+                return batch_request_line(entry["custom_id"], text_payload(raw_text, FAST_TIER_MAX_TOKENS)), entry
+        pages = render_document_pages(document, page_texts)
+        if not pages:
+            return None, entry
+        entry["custom_id"] = batch_custom_id(document.sha1, "vision", entry["index"])
+        return batch_request_line(entry["custom_id"], vision_payload([convert_bytes_to_base64(page) for page in pages])), entry
+
+def apply_batch_result(entry, result_line):
+    """
+    Merge one output line into its manifest entry, exactly as the interactive cascade would.
+    Returns True when the document still has failing fields after a text-stage answer.
+    """
+    response = result_line.get("response") or {}
+    if response.get("status_code") != 200:
+        entry["error"] = json.dumps(result_line.get("error") or response.get("body"))
+        return entry.get("custom_id", "").endswith("-text")
+    content = response["body"]["choices"][0]["message"]["content"]
+    if entry["custom_id"].endswith("-text"):
+        structured, anomalies = normalize_structured_data(parse_structured_response(content))
+        entry.update(structured_data=structured, anomalies=anomalies, tier="fast")
+    else:
+        row = parse_structured_response(content)
+        if row:
+            vision_data, anomalies = normalize_structured_data(structured_from_export_row(row))
+            _, failing = score_structured_data(entry.get("structured_data"))
+            entry.update(structured_data=merge_escalated_answer(entry.get("structured_data"), vision_data, failing),
+                         anomalies=entry.get("anomalies", []) + anomalies, tier="vision")
+    _, failing = score_structured_data(entry.get("structured_data"))
+    return bool(failing) and entry["custom_id"].endswith("-text")
+
+def store_batch_entry(entry):
+    """Record a finished document in the certificate index; returns its CertificateRecord."""
+    form_values = flat_form_values(entry["structured_data"])
+    get_certificate_index().upsert(entry["sha1"], entry["file_name"], "extracted", form_values,
+                                   page_count=entry["page_count"], structured=entry["structured_data"],
+                                   raw_text=entry["raw_text"])
+    return record_from_form(form_values, entry["file_name"], entry["page_count"])
+
+class LocalBatchClient:
+    """
+    Stand-in for the batch endpoint that answers every request on this machine (tests, dry runs).
+    ``responder(custom_id, body)`` returns the assistant message; by default text requests are
+    answered by the local rules extractor and vision requests with an empty row.
+    """
+
+    def __init__(self, directory, responder=None):
+        self.directory = directory
+        self.responder = responder or self.rules_responder
+        self.batches = {}
+
+    @staticmethod
+    def rules_responder(custom_id, body):
+        if custom_id.endswith("-text"):
+            structured = extract_with_rules(body["messages"][1]["content"][1]["text"])
+            return f"<initial_attempt>```json\n{json.dumps(structured)}\n```</initial_attempt>"
+        return "<initial_attempt>```json\n{}\n```</initial_attempt>"
+
+    def submit(self, path):
+        batch_id = f"local-{uuid.uuid4().hex}"
+        output_path = os.path.join(self.directory, f"{batch_id}_output.jsonl")
+        with open(path, encoding="utf-8") as requests_file, open(output_path, "w", encoding="utf-8") as output:
+            for line in requests_file:
+                request = json.loads(line)
+                content = self.responder(request["custom_id"], request["body"])
+                output.write(json.dumps({"custom_id": request["custom_id"], "response": {
+                    "status_code": 200, "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}
+                }, "error": None}) + "\n")
+        self.batches[batch_id] = output_path
+        return batch_id
+
+    def status(self, batch_id):
+        return {"id": batch_id, "status": "completed"}
+
+    def results(self, batch_id):
+        with open(self.batches[batch_id], encoding="utf-8") as output:
+            for line in output:
+                yield json.loads(line)
+
+class AzureBatchClient:
+    """Azure OpenAI Batch API: upload the JSONL file, create a 24h batch, download output and error files."""
+
+    def __init__(self, endpoint, api_key):
+        parts = urllib.parse.urlsplit(endpoint)
+        self.base = f"{parts.scheme}://{parts.netloc}/openai"
+        self.headers = {"api-key": api_key}
+        self.params = {"api-version": BATCH_API_VERSION}
+
+    def request(self, method, path, **kwargs):
+        response = resources().get("http_session").request(
+            method, f"{self.base}/{path}", headers=self.headers, params=self.params, timeout=300, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def submit(self, path):
+        with open(path, "rb") as f:
+            input_file = self.request("POST", "files", data={"purpose": "batch"},
+                                      files={"file": (os.path.basename(path), f, "application/jsonl")}).json()
+        return self.request("POST", "batches", json={
+            "input_file_id": input_file["id"], "endpoint": "/chat/completions", "completion_window": "24h"
+        }).json()["id"]
+
+    def status(self, batch_id):
+        return self.request("GET", f"batches/{batch_id}").json()
+
+    def results(self, batch_id):
+        batch = self.status(batch_id)
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if file_id:
+                response = self.request("GET", f"files/{file_id}/content", stream=True)
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+
+def wait_for_batch(client, batch_id, poll_seconds):
+    while True:
+        batch = client.status(batch_id)
+        if batch["status"] in BATCH_TERMINAL_STATUSES:
+            return batch
+        time.sleep(poll_seconds)
+
+# --------------------- Compliance Engine ---------------------
+
+# Certificates table columns for each coverage checked by the compliance rules
+COMPLIANCE_COVERAGES = {
+    "Automobile Liability": {
+        "amount": "Automobile Liability Amount",
+        "currency": "Automobile Liability Currency",
+        "deductible_currency": "Automobile Liability DED. Currency",
+        "expiry": "Automobile Liability Expiry Date (yyyy/mm/dd)",
+    },
+    "Commercial General Liability": {
+        "amount": "Each occ Commercial General Liability Amount",
+        "currency": "Each occ Commercial General Liability Currency",
+        "deductible_currency": "Each occ Commercial General Liability DED. Currency",
+        "expiry": "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)",
+    },
+    "Non-owned Trailer": {
+        "amount": "Non-owned Trailer Amount",
+        "currency": "Non-owned Trailer Currency",
+        "deductible_currency": "Non-owned Trailer DED. Currency",
+        "expiry": "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)",
+    },
+}
+
+DEFAULT_COMPLIANCE_RULES = {
+    "expiring_within_days": 30,
+    "required_limits": {
+        "Automobile Liability": 2000000,
+        "Commercial General Liability": 2000000,
+        "Non-owned Trailer": 0,
+    },
+    "required_coverages": ["Automobile Liability", "Commercial General Liability", "Non-owned Trailer"],
+    "expected_currency": "",
+}
+
+COMPLIANCE_DISPLAY_ROWS = 1000
+COMPLIANCE_RULE_NAMES = ["expired", "expiring soon", "below required limit", "missing coverage", "currency mismatch"]
+
+def parse_certificate_columns(certificates):
+    """
+    Typed view of the certificates table: expiry dates as datetime64, amounts as float64
+    and currency codes as Arrow strings. Unreadable values become NaT/NaN/NA.
+    """
+    typed = pd.DataFrame(index=certificates.index)
+    for coverage, columns in COMPLIANCE_COVERAGES.items():
+        raw = certificates.reindex(columns=list(columns.values()))
+        typed[f"{coverage} expiry"] = pd.to_datetime(raw[columns["expiry"]], format="%Y/%m/%d", errors="coerce")
+        amounts = raw[columns["amount"]].astype("string[pyarrow]").str.replace(r"[,$\s]", "", regex=True)
+        # Null out non-numeric text first so the cast stays inside Arrow
+        numeric = amounts.where(amounts.str.fullmatch(r"\d+(?:\.\d+)?"))
+        typed[f"{coverage} amount"] = numeric.astype("float64[pyarrow]").astype("float64")
+        for key in ("currency", "deductible_currency"):
+            codes = raw[columns[key]].astype("string[pyarrow]").str.strip().str.upper()
+            typed[f"{coverage} {key.replace('_', ' ')}"] = codes.where(codes.str.fullmatch(r"[A-Z]{3}"))
+    return typed
+
+def evaluate_compliance_rules(typed, rules, today):
+    """Evaluate every rule as column operations over the typed table; returns one boolean column per coverage and rule."""
+    results = pd.DataFrame(index=typed.index)
+    horizon = today + pd.Timedelta(days=rules["expiring_within_days"])
+    expected_currency = (rules.get("expected_currency") or "").upper()
+    for coverage in COMPLIANCE_COVERAGES:
+        expiry = typed[f"{coverage} expiry"]
+        amount = typed[f"{coverage} amount"]
+        currency = typed[f"{coverage} currency"]
+        deductible_currency = typed[f"{coverage} deductible currency"]
+
+        results[f"{coverage}: expired"] = expiry < today
+        results[f"{coverage}: expiring soon"] = (expiry >= today) & (expiry <= horizon)
+        results[f"{coverage}: below required limit"] = amount < rules["required_limits"].get(coverage, 0)
+        results[f"{coverage}: missing coverage"] = amount.isna() & (coverage in rules["required_coverages"])
+        mismatch = (currency.notna() & deductible_currency.notna() & (currency != deductible_currency)).fillna(False)
+        if expected_currency:
+            mismatch |= (currency.notna() & (currency != expected_currency)).fillna(False)
+        results[f"{coverage}: currency mismatch"] = mismatch
+    results = results.astype(bool)
+    results["Issues"] = results.sum(axis=1)
+    return results
+
+def certificate_compliance(certificates, rules):
+    """
+    Compliance results for the whole certificates table, cached in the session.
+    Only rows appended since the last call are parsed and evaluated; a change of
+    rules, day or a shrinking table triggers a full recompute.
+    """
+    today = pd.Timestamp(datetime.now().date())
+    rules_key = (json.dumps(rules, sort_keys=True), today)
+    cache = st.session_state.get("compliance_cache")
+    if cache is None or cache["rules_key"] != rules_key or cache["rows"] > len(certificates):
+        cache = {"rules_key": rules_key, "rows": 0, "results": None}
+
+    if cache["rows"] < len(certificates):
+        new_rows = certificates.iloc[cache["rows"]:]
+        new_results = evaluate_compliance_rules(parse_certificate_columns(new_rows), rules, today)
+        cache["results"] = new_results if cache["results"] is None else pd.concat([cache["results"], new_results])
+        cache["rows"] = len(certificates)
+        st.session_state.compliance_cache = cache
+    return cache["results"]
+
+def compliance_summary(results):
+    """Number of certificates failing each rule (any coverage) and overall."""
+    summary = {}
+    for rule in COMPLIANCE_RULE_NAMES:
+        rule_columns = [f"{coverage}: {rule}" for coverage in COMPLIANCE_COVERAGES]
+        summary[rule] = int(results[rule_columns].any(axis=1).sum())
+    summary["certificates with issues"] = int((results["Issues"] > 0).sum())
+    return summary
+
+def render_compliance_settings():
+    """Editable compliance rules, stored in the session."""
+    rules = st.session_state.compliance_rules
+    with st.expander("Compliance Rules"):
+        days = st.number_input("Flag policies expiring within (days)", min_value=0,
+                               value=rules["expiring_within_days"])
+        limits = {}
+        for coverage in COMPLIANCE_COVERAGES:
+            limits[coverage] = st.number_input(f"Required {coverage} limit", min_value=0, step=100000,
+                                               value=rules["required_limits"].get(coverage, 0))
+        required = st.multiselect("Required coverages", list(COMPLIANCE_COVERAGES), default=rules["required_coverages"])
+        expected_currency = st.text_input("Expected currency (blank to skip)", value=rules["expected_currency"])
+        updated = {
+            "expiring_within_days": int(days),
+            "required_limits": {coverage: int(limit) for coverage, limit in limits.items()},
+            "required_coverages": required,
+            "expected_currency": expected_currency.strip().upper(),
+        }
+        if updated != rules:
+            st.session_state.compliance_rules = updated
+
+# --------------------- Results Queue ---------------------
+
+def start_results_batch():
+    """Begin a new batch; results of the previous batch are discarded."""
+    st.session_state.batch_results = []
+    st.session_state.results_index = 0
+
+def flat_form_values(structured_data):
+    """Form values of an extraction, as the strings the form widgets expect."""
+    return {field: str(value) if isinstance(value, (int, float)) else (value or "")
+            for field, value in flatten_structured_data(structured_data).items()}
+
+def enqueue_result(file_name, page_count, structured_data, tier, anomalies=(), key=None, form_values=None):
+    """
+    Keep a document's extraction in the batch queue; the first one is loaded into the review form.
+    ``key`` is the document's index key; ``form_values`` overrides the values flattened from the extraction.
+    """
+    flat_data = form_values or flat_form_values(structured_data)
+    entry = {
+        "key": key,
+        "file_name": file_name,
+        "page_count": page_count,
+        "structured_data": structured_data,
+        "form_values": flat_data,
+        "tier": tier,
+        "anomalies": list(anomalies),
+        "status": "pending",
+    }
+    st.session_state.batch_results.append(entry)
+    if len(st.session_state.batch_results) == 1:
+        select_result(0)
+    return entry
+
+def current_result():
+    results = st.session_state.batch_results
+    if results and st.session_state.results_index < len(results):
+        return results[st.session_state.results_index]
+    return None
+
+def select_result(index):
+    """Load a queued document into the review form without re-running any extraction."""
+    st.session_state.results_index = index
+    entry = st.session_state.batch_results[index]
+    st.session_state.last_structured_data = entry["structured_data"]
+    # Fields the document doesn't have must not keep the previous document's values
+    st.session_state.form_values = {key: "" for key in st.session_state.form_values}
+    st.session_state.form_values.update(entry["form_values"])
+
+def step_result(offset):
+    results = st.session_state.batch_results
+    if results:
+        select_result((st.session_state.results_index + offset) % len(results))
+
+def accept_current_result(form_values):
+    """Record the reviewer's edits for the current document and mark it accepted."""
+    entry = current_result()
+    if entry is None:
+        return
+    entry["form_values"] = dict(form_values)
+    if entry["status"] != "saved":
+        entry["status"] = "accepted"
+
+def certificate_row(form_values, file_name, page_count):
+    """One row of the certificates table from form values."""
+    row = {column: form_values.get(key, "") for key, column in FORM_VALUE_TO_EXPORT_COLUMN.items()}
+    row["Page Count"] = str(page_count)
+    row["Name of file"] = file_name
+    return row
+
+def save_accepted_results():
+    """Append every accepted document to the certificates table in a single concat."""
+    accepted = [entry for entry in st.session_state.batch_results if entry["status"] == "accepted"]
+    if not accepted:
+        return 0
+    rows = records_frame([record_from_form(entry["form_values"], entry["file_name"], entry["page_count"])
+                          for entry in accepted])
+    st.session_state.certificates = pd.concat([st.session_state.certificates, rows], ignore_index=True)
+    st.session_state.certificates_version += 1
+    for entry in accepted:
+        entry["status"] = "saved"
+        index_saved_result(entry, entry["form_values"])
+    return len(accepted)
+
+def render_results_queue():
+    """Navigator over the documents of the last batch."""
+    results = st.session_state.batch_results
+    if not results:
+        return
+    st.markdown("##### Batch Results")
+    # Keep the selector in step with Previous/Next and "Accept & Next"
+    st.session_state.results_selector = st.session_state.results_index
+    st.selectbox(
+        "Document",
+        options=range(len(results)),
+        format_func=lambda i: f"{i + 1}. {results[i]['file_name']} ({results[i]['page_count']} pages, {results[i]['status']})",
+        key="results_selector",
+        on_change=lambda: select_result(st.session_state.results_selector)
+    )
+    prev_col, next_col, save_col = st.columns(3)
+    with prev_col:
+        st.button("◀ Previous", on_click=step_result, args=(-1,))
+    with next_col:
+        st.button("Next ▶", on_click=step_result, args=(1,))
+    accepted_count = sum(entry["status"] == "accepted" for entry in results)
+    with save_col:
+        if st.button(f"Save {accepted_count} Accepted", disabled=not accepted_count):
+            saved = save_accepted_results()
+            st.success(f"{saved} certificates saved!")
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def coverage_status(structured_json):
+    """Verified-coverage and compliance counters for a structured result (cached by its JSON)."""
+    data = json.loads(structured_json)
+    verified_coverages = 0
+    total_coverages = 0
+    compliance_issues = 0
     
-    if 'endpoint' not in st.session_state:
-        st.session_state.endpoint = ""
+    # Count verified coverages
+    for category in ['automobileLiability', 'commercialGeneralLiability', 'nonOwnedTrailer']:
+        if category in data and any(data[category].values()):
+            verified_coverages += 1
+            total_coverages += 1
+        elif category in data:
+            total_coverages += 1
     
-    if 'api_key' not in st.session_state:
-        st.session_state.api_key = ""
+    # Check for compliance issues (expiry dates in the past)
+    today = datetime.now().strftime('%Y/%m/%d')
+    for category in ['automobileLiability', 'commercialGeneralLiability', 'nonOwnedTrailer']:
+        if category in data and 'expiryDate' in data[category]:
+            expiry = data[category]['expiryDate']
+            if expiry and expiry < today:
+                compliance_issues += 1
     
-    if 'certificates' not in st.session_state:
-        st.session_state.certificates = pd.DataFrame()
+    return verified_coverages, total_coverages, compliance_issues
+
+@st.fragment
+def render_status_cards():
+    """Extraction and compliance status cards."""
+    get_session_registry().touch()
+    col1, col2 = st.columns(2)
     
-    if 'form_values' not in st.session_state:
-        st.session_state.form_values = {
-            # Certificate Info
-            "cert_number_value": "",
-            "template_form_value": "",
-            "effective_date_value": "",
-            "expiration_date_value": "",
-            "insured_name_value": "",
-            "address_value": "",
-            "description_value": "",
-            
-            # Automobile Liability
-            "auto_liability_insurance_company_value": "",
-            "auto_liability_currency_value": "",
-            "auto_liability_amount_value": "",
-            "auto_liability_ded_currency_value": "",
-            "auto_liability_ded_amount_value": "",
-            "auto_liability_expiry_date_value": "",
-            
-            # Commercial General Liability
-            "cgl_company_value": "",
-            "cgl_currency_value": "",
-            "cgl_amount_value": "",
-            "cgl_ded_currency_value": "",
-            "cgl_ded_amount_value": "",
-            "cgl_expiry_value": "",
-            
-            # Non-owned Trailer
-            "trailer_company_value": "",
-            "trailer_currency_value": "",
-            "trailer_amount_value": "",
-            "trailer_ded_currency_value": "",
-            "trailer_ded_amount_value": "",
-            "trailer_expiry_value": "",
-            
-            # Others
-            "additional_insured_value": "",
-            "certificate_holder_value": "",
-            "cancellation_period_value": ""
-        }
+    verified_coverages, total_coverages, compliance_issues = 0, 0, 0
+    if st.session_state.last_structured_data:
+        verified_coverages, total_coverages, compliance_issues = coverage_status(
+            json.dumps(st.session_state.last_structured_data, sort_keys=True, default=str)
+        )
     
-    if 'last_structured_data' not in st.session_state:
-        st.session_state.last_structured_data = None
+    flagged_certificates = 0
+    if not st.session_state.certificates.empty:
+        results = certificate_compliance(st.session_state.certificates, st.session_state.compliance_rules)
+        flagged_certificates = int((results["Issues"] > 0).sum())
+    
+    with col1:
+        st.markdown(f"""
+        <div style="background-color:#E8F0FE; border-radius:10px; padding:10px; margin-bottom:20px;">
+            <div style="display:flex; align-items:center;">
+                <div style="color:#4285F4; margin-right:20px;"><i class="fas fa-check-circle"></i>✓</div>
+                <div>
+                    <div style="color:#4285F4; font-weight:bold;">AI Extraction Status:</div>
+                    <div style="color:#4285F4;">{verified_coverages}/{total_coverages} verified coverages</div>
+                </div>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
 
-def export_to_excel(df):
-    """Export dataframe to Excel format."""
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='Certificates', index=False)
-    output.seek(0)
-    return output.getvalue()
+    with col2:
+        st.markdown(f"""
+        <div style="background-color:#FEEAE6; border-radius:10px; padding:10px; margin-bottom:20px;">
+            <div style="display:flex; align-items:center;">
+                <div style="color:#EA4335; margin-right:20px;"><i class="fas fa-exclamation-triangle"></i>⚠</div>
+                <div>
+                    <div style="color:#EA4335; font-weight:bold;">Compliance Status:</div>
+                    <div style="color:#EA4335;">{compliance_issues} compliance issues</div>
+                    <div style="color:#EA4335;">{flagged_certificates}/{len(st.session_state.certificates)} saved certificates flagged</div>
+                </div>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
+
+@st.fragment
+def render_certificate_form():
+    """Review form; submitting it reruns only this fragment until a certificate is saved."""
+    get_session_registry().touch()
+    if "flash_message" in st.session_state:
+        st.success(st.session_state.pop("flash_message"))
+    
+    # Create a container with scrollable height for the form
+    cert_form_container = st.container()
+
+    with cert_form_container:
+        with st.form(key="certificate_form"):
+            # Add single scrollable container
+            st.markdown("""
+            <style>
+            .scrollable-form {
+                max-height: 500px;
+                overflow-y: auto;
+                padding-right: 10px;
+            }
+            </style>
+            """, unsafe_allow_html=True)
+
+            entry = current_result()
+            reextract_buttons = {}
+
+            # Create tabs
+            tabs = st.tabs([
+                "Certificate Info",
+                "Automobile Liability",
+                "Commercial General Liability",
+                "Non-owned Trailer", 
+                "Others"
+            ])
+
+            # Tab 1: Certificate & Insured Info
+            with tabs[0]:
+                st.markdown("##### Certificate Details")
+                cert_number = st.text_input("Certificate Number", key="cert_number", 
+                                           value=st.session_state.form_values["cert_number_value"])
+                form_type = st.text_input("Template Form", key="template_form", 
+                                         value=st.session_state.form_values["template_form_value"])
+
+                col_eff, col_exp = st.columns(2)
+                with col_eff:
+                    effective_date = st.text_input("Effective Date (yyyy/mm/dd)", key="effective_date", 
+                                                 value=st.session_state.form_values["effective_date_value"])
+                with col_exp:
+                    expiration_date = st.text_input("Expiration Date (yyyy/mm/dd)", key="expiration_date", 
+                                                  value=st.session_state.form_values["expiration_date_value"])
+
+                st.markdown("##### Insured Information")
+                insured_name = st.text_input("Insured Name", key="insured_name", 
+                                           value=st.session_state.form_values["insured_name_value"])
+                address = st.text_input("Address", key="address", 
+                                      value=st.session_state.form_values["address_value"])
+                description = st.text_area("Description", key="description", 
+                                         value=st.session_state.form_values["description_value"])
+                reextract_buttons["certificateInfo"] = st.form_submit_button(
+                    "Re-extract Certificate Info", disabled=entry is None or not entry.get("key"))
+
+            # Tab 2: Automobile Liability
+            with tabs[1]:
+                auto_liability_company = st.text_input("Automobile Liability Insurance Company", key="auto_liability_company",
+                                                    value=st.session_state.form_values["auto_liability_insurance_company_value"])
+                auto_liability_currency = st.text_input("Automobile Liability Currency", key="auto_liability_currency",
+                                                     value=st.session_state.form_values["auto_liability_currency_value"])
+                auto_liability_amount = st.text_input("Automobile Liability Amount", key="auto_liability_amount",
+                                                   value=st.session_state.form_values["auto_liability_amount_value"])
+                auto_liability_ded_currency = st.text_input("Automobile Liability DED. Currency", key="auto_liability_ded_currency",
+                                                        value=st.session_state.form_values["auto_liability_ded_currency_value"])
+                auto_liability_ded_amount = st.text_input("Automobile Liability DED. Amount", key="auto_liability_ded_amount",
+                                                      value=st.session_state.form_values["auto_liability_ded_amount_value"])
+                auto_liability_expiry = st.text_input("Automobile Liability Expiry Date (yyyy/mm/dd)", key="auto_liability_expiry",
+                                                   value=st.session_state.form_values["auto_liability_expiry_date_value"])
+                reextract_buttons["automobileLiability"] = st.form_submit_button(
+                    "Re-extract Automobile Liability", disabled=entry is None or not entry.get("key"))
+
+            # Tab 3: Commercial General Liability
+            with tabs[2]:
+                cgl_company = st.text_input("Each occ Commercial General Liability Insurance Company", key="cgl_company",
+                                         value=st.session_state.form_values["cgl_company_value"])
+                cgl_currency = st.text_input("Each occ Commercial General Liability Currency", key="cgl_currency",
+                                          value=st.session_state.form_values["cgl_currency_value"])
+                cgl_amount = st.text_input("Each occ Commercial General Liability Amount", key="cgl_amount",
+                                        value=st.session_state.form_values["cgl_amount_value"])
+                cgl_ded_currency = st.text_input("Each occ Commercial General Liability DED. Currency", key="cgl_ded_currency",
+                                              value=st.session_state.form_values["cgl_ded_currency_value"])
+                cgl_ded_amount = st.text_input("Each occ Commercial General Liability DED. Amount", key="cgl_ded_amount",
+                                            value=st.session_state.form_values["cgl_ded_amount_value"])
+                cgl_expiry = st.text_input("Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)", key="cgl_expiry",
+                                        value=st.session_state.form_values["cgl_expiry_value"])
+                reextract_buttons["commercialGeneralLiability"] = st.form_submit_button(
+                    "Re-extract Commercial General Liability", disabled=entry is None or not entry.get("key"))
+
+            # Tab 4: Non-owned Trailer
+            with tabs[3]:
+                trailer_company = st.text_input("Non-owned Trailer Insurance Company", key="trailer_company",
+                                             value=st.session_state.form_values["trailer_company_value"])
+                trailer_currency = st.text_input("Non-owned Trailer Currency", key="trailer_currency",
+                                              value=st.session_state.form_values["trailer_currency_value"])
+                trailer_amount = st.text_input("Non-owned Trailer Amount", key="trailer_amount",
+                                            value=st.session_state.form_values["trailer_amount_value"])
+                trailer_ded_currency = st.text_input("Non-owned Trailer DED. Currency", key="trailer_ded_currency",
+                                                 value=st.session_state.form_values["trailer_ded_currency_value"])
+                trailer_ded_amount = st.text_input("Non-owned Trailer DED. Amount", key="trailer_ded_amount",
+                                               value=st.session_state.form_values["trailer_ded_amount_value"])
+                trailer_expiry = st.text_input("Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)", key="trailer_expiry",
+                                            value=st.session_state.form_values["trailer_expiry_value"])
+                reextract_buttons["nonOwnedTrailer"] = st.form_submit_button(
+                    "Re-extract Non-owned Trailer", disabled=entry is None or not entry.get("key"))
+
+            # Tab 5: Others
+            with tabs[4]:
+                st.markdown("##### Additional insured")
+                additional_insured = st.text_area("Additional Insured", key="additional_insured",
+                                              value=st.session_state.form_values["additional_insured_value"])
+
+                st.markdown("##### Certificate Holder")
+                certificate_holder = st.text_area("Certificate Holder", key="certificate_holder",
+                                               value=st.session_state.form_values["certificate_holder_value"])
+
+                st.markdown("##### Cancellation Notice Period (days)")
+                cancellation_period = st.text_input("Cancellation Notice Period (days)", key="cancellation_period",
+                                                 value=st.session_state.form_values["cancellation_period_value"])
+                reextract_buttons["other"] = st.form_submit_button(
+                    "Re-extract Others", disabled=entry is None or not entry.get("key"))
+
+            # Process button
+            process_button = st.form_submit_button("Save Certificate")
+            accept_button = st.form_submit_button("Accept & Next", disabled=entry is None)
+
+            if accept_button and entry is not None:
+                accept_current_result({key: st.session_state[widget_key]
+                                       for key, widget_key in FORM_WIDGET_KEYS.items()})
+                step_result(1)
+                st.rerun()
+
+            for section, clicked in reextract_buttons.items():
+                if clicked and entry is not None:
+                    # Keep the reviewer's unsaved edits in the other tabs
+                    entry["form_values"] = {key: st.session_state[widget_key]
+                                            for key, widget_key in FORM_WIDGET_KEYS.items()}
+                    try:
+                        with st.spinner("Re-extracting section..."):
+                            changed, source = reextract_section(entry, section)
+                    except (ValueError, requests.exceptions.RequestException) as e:
+                        st.error(f"Re-extraction failed: {e}")
+                        break
+                    st.session_state.form_values = {key: "" for key in st.session_state.form_values}
+                    st.session_state.form_values.update(entry["form_values"])
+                    st.session_state.flash_message = (
+                        f"Re-extracted from the cached {source}: updated {', '.join(changed)}" if changed
+                        else f"Re-extracted from the cached {source}: no field changed"
+                    )
+                    # The status cards live outside this fragment
+                    st.rerun()
+
+            if process_button:
+                form_values = {key: st.session_state[widget_key] for key, widget_key in FORM_WIDGET_KEYS.items()}
+                record = record_from_form(form_values, entry["file_name"] if entry else "Manually entered",
+                                          entry["page_count"] if entry else 1)
+                st.session_state.certificates = pd.concat([st.session_state.certificates, records_frame([record])],
+                                                          ignore_index=True)
+
+                st.session_state.certificates_version += 1
+                if entry:
+                    entry["status"] = "saved"
+                index_saved_result(entry, form_values)
+                st.session_state.flash_message = "Certificate saved successfully!"
+                # The certificates table lives outside this fragment
+                st.rerun()
+
+def certificates_excel_bytes(version):
+    """Excel export of the certificates table, rebuilt only when ``version`` changes."""
+    cached = st.session_state.get("excel_cache")
+    if cached is None or cached[0] != version:
+        cached = (version, export_to_excel(st.session_state.certificates))
+        st.session_state.excel_cache = cached
+    return cached[1]
+
+@st.fragment
+def render_certificates_table():
+    """Saved certificates and their Excel export."""
+    get_session_registry().touch()
+    if not st.session_state.certificates.empty:
+        st.subheader("Processed Certificates")
+        st.dataframe(st.session_state.certificates)
+        if st.button("Resolve insurer names", help="Map insurer spellings in the saved certificates to canonical carrier names"):
+            st.session_state.certificates = resolve_certificate_insurers(st.session_state.certificates)
+            st.session_state.certificates_version += 1
+            st.rerun(scope="fragment")
+        
+        render_compliance_settings()
+        results = certificate_compliance(st.session_state.certificates, st.session_state.compliance_rules)
+        summary = compliance_summary(results)
+        st.markdown("##### Compliance")
+        summary_cols = st.columns(len(summary))
+        for col, (rule, count) in zip(summary_cols, summary.items()):
+            col.metric(rule.capitalize(), count)
+        flagged = results[results["Issues"] > 0]
+        if not flagged.empty:
+            # Large tables only show the first rows; the counts above cover all of them
+            flagged_rows = flagged.head(COMPLIANCE_DISPLAY_ROWS)
+            issue_columns = [column for column in flagged.columns if column != "Issues" and flagged_rows[column].any()]
+            st.dataframe(pd.concat([
+                st.session_state.certificates.loc[flagged_rows.index, ["Name of file"]],
+                flagged_rows[["Issues"] + issue_columns]
+            ], axis=1))
+
+        # Add export functionality
+        excel_data = certificates_excel_bytes(st.session_state.certificates_version)
+        st.download_button(
+            label="Download Certificates as Excel",
+            data=excel_data,
+            file_name="insurance_certificates.xlsx",
+            mime="application/vnd.ms-excel"
+        )
+
+def render_diagnostics():
+    """Process telemetry for operators, collapsed at the bottom of the API Settings tab."""
+    with st.expander("Diagnostics"):
+        if "last_rerun_ms" in st.session_state:
+            st.caption(f"Last full rerun: {st.session_state.last_rerun_ms:.0f} ms")
+
+        if st.session_state.endpoint:
+            st.subheader("Rate Limits")
+            st.json(get_rate_limiter(st.session_state.endpoint).snapshot())
+
+            st.subheader("Deployments")
+            pool = get_deployment_pool().snapshot()
+            st.caption(f"{pool['calls']} calls, {pool['failovers']} failovers, {pool['hedged']} hedged")
+            if pool["deployments"]:
+                st.dataframe(pd.DataFrame(pool["deployments"]), hide_index=True)
+
+        st.subheader("Admission Control")
+        st.json(get_admission_scheduler().snapshot())
+
+        render_profiling_settings()
+
+        st.subheader("Resources")
+        st.json(resources().snapshot())
+
+        st.subheader("Pipeline Profile")
+        st.caption(f"Loaded from {PIPELINE_PROFILE_PATH}" if os.path.exists(PIPELINE_PROFILE_PATH) else "Built-in defaults")
+        st.json(pipeline_profile())
+
+        st.subheader("Stage Pipeline")
+        st.caption(f"Queue capacity {PAGE_QUEUE_CAPACITY} pages; pre-rendering during the fast tier "
+                   + ("on" if PRERENDER_PAGES else "off"))
+        st.dataframe(stage_stats_frame(), hide_index=True)
+
+        st.subheader("Scratch Spool")
+        st.json(get_spool().snapshot())
+
+        st.subheader("Sessions")
+        registry = get_session_registry()
+        st.caption(f"Idle sessions are offloaded to disk after {registry.idle_seconds // 60} min, "
+                   f"or after {registry.min_idle_seconds}s while sessions hold more than {registry.budget_bytes // 2**20} MB")
+        st.dataframe(registry.frame(), hide_index=True)
+        st.json(registry.snapshot())
+
+        st.subheader("Model Cascade")
+        st.dataframe(cascade_stats_frame(), hide_index=True)
+
+        if get_work_queue() is not None:
+            st.subheader("Work Queue")
+            st.json(get_work_queue().snapshot())
+
+        st.subheader("Certificate Index")
+        st.json(get_certificate_index().snapshot())
+
+        st.subheader("Ingestion")
+        st.caption(f"Peak process RSS: {get_ingest_stats()['peak_rss_mb']} MB")
+        st.dataframe(ingest_stats_frame(), hide_index=True)
+
+        st.subheader("Skipped Pages")
+        st.dataframe(page_audit_frame(), hide_index=True)
+
+        st.subheader("Camera Captures")
+        capture_stats = get_capture_stats()
+        st.json({key: value for key, value in capture_stats.items() if key != "lock"})
 
 # Main function for the Streamlit app
 def main():
+    rerun_start = time.perf_counter()
+    # Before anything reads the session: brings back entries offloaded while the tab was idle.
+    # Fragments rerun without main(), so each of them touches the registry as well.
+    get_session_registry().touch()
     st.title("📜 Insurance Certificate Classifier")
     
     # Initialize session state
@@ -957,14 +5484,59 @@ def main():
         endpoint = st.text_input("API Endpoint URL", value=st.session_state.endpoint)
         api_key = st.text_input("API Key", value=st.session_state.api_key, type="password")
         
+        st.markdown("Optional cheaper deployment used before escalating to the vision model:")
+        fast_endpoint = st.text_input("Fast Deployment Endpoint URL", value=st.session_state.fast_endpoint)
+        fast_api_key = st.text_input("Fast Deployment API Key", value=st.session_state.fast_api_key, type="password")
+        
+        st.markdown("Optional additional deployments of the main model, one per line as `endpoint, api key[, weight]`:")
+        extra_deployments = st.text_area(
+            "Additional Deployments",
+            value="\n".join(f"{d['endpoint']}, {d['api_key']}, {d['weight']:g}" for d in st.session_state.extra_deployments)
+        )
+        hedge_requests = st.checkbox(
+            "Hedge slow calls",
+            value=st.session_state.hedge_requests,
+            help="When a call outlives its deployment's p95 latency, send a duplicate to another deployment and keep the first valid answer."
+        )
+        
+        weight_col, slots_col = st.columns(2)
+        with weight_col:
+            admission_weight = st.number_input(
+                "Extraction share weight", min_value=0.1, value=float(st.session_state.admission_weight), step=0.5,
+                help="This session's share of extraction slots relative to other sessions waiting in the same lane."
+            )
+        with slots_col:
+            max_extractions = st.number_input("Concurrent extractions (all sessions)", min_value=1,
+                                              value=get_admission_scheduler().max_concurrent)
+        
+        rpm_col, tpm_col = st.columns(2)
+        with rpm_col:
+            rpm_limit = st.number_input("Requests per minute quota", min_value=1, value=st.session_state.rpm_limit)
+        with tpm_col:
+            tpm_limit = st.number_input("Tokens per minute quota", min_value=1000, value=st.session_state.tpm_limit, step=1000)
+        
         if st.button("Save API Settings"):
             st.session_state.endpoint = endpoint
             st.session_state.api_key = api_key
+            st.session_state.fast_endpoint = fast_endpoint
+            st.session_state.fast_api_key = fast_api_key
+            st.session_state.rpm_limit = int(rpm_limit)
+            st.session_state.tpm_limit = int(tpm_limit)
+            st.session_state.extra_deployments = parse_deployments(extra_deployments)
+            st.session_state.hedge_requests = hedge_requests
+            st.session_state.admission_weight = float(admission_weight)
+            get_admission_scheduler().configure(int(max_extractions))
+            if endpoint:
+                get_rate_limiter(endpoint).configure(int(rpm_limit), int(tpm_limit))
+            for deployment in st.session_state.extra_deployments:
+                get_rate_limiter(deployment["endpoint"]).configure(int(rpm_limit), int(tpm_limit))
             st.session_state.api_configured = True if endpoint and api_key else False
             if st.session_state.api_configured:
                 st.success("API settings saved successfully!")
             else:
                 st.error("Please provide both API endpoint and key.")
+        
+        render_diagnostics()
     
     with tab1:
         # Create a two-column layout with both input options on the left
@@ -1003,6 +5575,7 @@ def main():
                     key="uploader"
                 )
                 st.caption("Limit 200MB per file • PDF, JPG, JPEG, PNG")
+                st.checkbox("Reuse earlier extractions of the same file", value=True, key="reuse_extractions")
                 
                 # Add the submit button at the end of the form
                 submit_button = st.form_submit_button(
@@ -1014,243 +5587,58 @@ def main():
                 
                 # Handle the form submission
                 if submit_button:
-                    if uploaded_files or camera_image:
+                    work_queue = get_work_queue()
+                    if (uploaded_files or camera_image) and work_queue is not None:
+                        # Extraction runs in the worker processes; results are polled below
+                        start_results_batch()
+                        documents = []
+                        if camera_image:
+                            capture, problems = gate_camera_capture(camera_image.getvalue())
+                            if capture is None:
+                                st.error("Please retake the photo: " + "; ".join(problems) + ".")
+                            else:
+                                documents.append((capture, "camera_image.jpg"))
+                        documents.extend((uploaded_file, uploaded_file.name) for uploaded_file in uploaded_files or [])
+                        st.session_state.queued_failures = []
+                        lane = admission_lane(len(documents))
+                        st.session_state.queued_jobs = [submit_document(work_queue, upload, name, lane)
+                                                        for upload, name in documents]
+                        st.success(f"Queued {len(documents)} document(s) for extraction")
+                    elif uploaded_files or camera_image:
                         st.success("Analyzing...")
+                        start_results_batch()
+                        documents = []
                         
                         # Process camera image if available
                         if camera_image:
-                            with st.spinner("Processing camera image..."):
-                                processed_data = process_document(camera_image.getvalue(), "camera_image.jpg")
-                                if processed_data:
-                                    st.success("Camera image processed!")
+                            capture, problems = gate_camera_capture(camera_image.getvalue())
+                            if capture is None:
+                                st.error("Please retake the photo: " + "; ".join(problems) + ".")
+                            else:
+                                documents.append((capture, "camera_image.jpg"))
                         
                         # Process uploaded files if available
-                        if uploaded_files:
-                            for uploaded_file in uploaded_files:
-                                with st.spinner(f"Processing {uploaded_file.name}..."):
-                                    processed_data = process_document(uploaded_file.getvalue(), uploaded_file.name)
-                                    if processed_data:
-                                        st.success(f"{uploaded_file.name} processed!")
+                        documents.extend((uploaded_file, uploaded_file.name) for uploaded_file in uploaded_files or [])
+                        if documents:
+                            process_documents(documents)
                     else:
                         st.error("Oops! Please upload a document or scan first.")
+            
+            if get_work_queue() is None:
+                render_admission_status()
         
         with right_col:
-            # Display status cards at the top
-            col1, col2 = st.columns(2)
-            
-            # Calculate verification metrics if structured data exists
-            verified_coverages = 0
-            total_coverages = 0
-            compliance_issues = 0
-            
-            if st.session_state.last_structured_data:
-                data = st.session_state.last_structured_data
-                
-                # Count verified coverages
-                for category in ['automobileLiability', 'commercialGeneralLiability', 'nonOwnedTrailer']:
-                    if category in data and any(data[category].values()):
-                        verified_coverages += 1
-                        total_coverages += 1
-                    elif category in data:
-                        total_coverages += 1
-                
-                # Check for compliance issues (expiry dates in the past)
-                from datetime import datetime
-                today = datetime.now().strftime('%Y/%m/%d')
-                
-                for category in ['automobileLiability', 'commercialGeneralLiability', 'nonOwnedTrailer']:
-                    if category in data and 'expiryDate' in data[category]:
-                        expiry = data[category]['expiryDate']
-                        if expiry and expiry < today:
-                            compliance_issues += 1
-            
-            with col1:
-                st.markdown(f"""
-                <div style="background-color:#E8F0FE; border-radius:10px; padding:10px; margin-bottom:20px;">
-                    <div style="display:flex; align-items:center;">
-                        <div style="color:#4285F4; margin-right:20px;"><i class="fas fa-check-circle"></i>✓</div>
-                        <div>
-                            <div style="color:#4285F4; font-weight:bold;">AI Extraction Status:</div>
-                            <div style="color:#4285F4;">{verified_coverages}/{total_coverages} verified coverages</div>
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            with col2:
-                st.markdown(f"""
-                <div style="background-color:#FEEAE6; border-radius:10px; padding:10px; margin-bottom:20px;">
-                    <div style="display:flex; align-items:center;">
-                        <div style="color:#EA4335; margin-right:20px;"><i class="fas fa-exclamation-triangle"></i>⚠</div>
-                        <div>
-                            <div style="color:#EA4335; font-weight:bold;">Compliance Status:</div>
-                            <div style="color:#EA4335;">{compliance_issues} compliance issues</div>
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-            
-            # Create a container with scrollable height for the form
-            cert_form_container = st.container()
-
-            with cert_form_container:
-                with st.form(key="certificate_form"):
-                    # Add single scrollable container
-                    st.markdown("""
-                    <style>
-                    .scrollable-form {
-                        max-height: 500px;
-                        overflow-y: auto;
-                        padding-right: 10px;
-                    }
-                    </style>
-                    """, unsafe_allow_html=True)
-                    
-                    # Create tabs
-                    tabs = st.tabs([
-                        "Certificate Info",
-                        "Automobile Liability",
-                        "Commercial General Liability",
-                        "Non-owned Trailer", 
-                        "Others"
-                    ])
-
-                    # Tab 1: Certificate & Insured Info
-                    with tabs[0]:
-                        st.markdown("##### Certificate Details")
-                        cert_number = st.text_input("Certificate Number", key="cert_number", 
-                                                   value=st.session_state.form_values["cert_number_value"])
-                        form_type = st.text_input("Template Form", key="template_form", 
-                                                 value=st.session_state.form_values["template_form_value"])
-                        
-                        col_eff, col_exp = st.columns(2)
-                        with col_eff:
-                            effective_date = st.text_input("Effective Date (yyyy/mm/dd)", key="effective_date", 
-                                                         value=st.session_state.form_values["effective_date_value"])
-                        with col_exp:
-                            expiration_date = st.text_input("Expiration Date (yyyy/mm/dd)", key="expiration_date", 
-                                                          value=st.session_state.form_values["expiration_date_value"])
-                    
-                        st.markdown("##### Insured Information")
-                        insured_name = st.text_input("Insured Name", key="insured_name", 
-                                                   value=st.session_state.form_values["insured_name_value"])
-                        address = st.text_input("Address", key="address", 
-                                              value=st.session_state.form_values["address_value"])
-                        description = st.text_area("Description", key="description", 
-                                                 value=st.session_state.form_values["description_value"])
-
-                    # Tab 2: Automobile Liability
-                    with tabs[1]:
-                        auto_liability_company = st.text_input("Automobile Liability Insurance Company", key="auto_liability_company",
-                                                            value=st.session_state.form_values["auto_liability_insurance_company_value"])
-                        auto_liability_currency = st.text_input("Automobile Liability Currency", key="auto_liability_currency",
-                                                             value=st.session_state.form_values["auto_liability_currency_value"])
-                        auto_liability_amount = st.text_input("Automobile Liability Amount", key="auto_liability_amount",
-                                                           value=st.session_state.form_values["auto_liability_amount_value"])
-                        auto_liability_ded_currency = st.text_input("Automobile Liability DED. Currency", key="auto_liability_ded_currency",
-                                                                value=st.session_state.form_values["auto_liability_ded_currency_value"])
-                        auto_liability_ded_amount = st.text_input("Automobile Liability DED. Amount", key="auto_liability_ded_amount",
-                                                              value=st.session_state.form_values["auto_liability_ded_amount_value"])
-                        auto_liability_expiry = st.text_input("Automobile Liability Expiry Date (yyyy/mm/dd)", key="auto_liability_expiry",
-                                                           value=st.session_state.form_values["auto_liability_expiry_date_value"])
-                    
-                    # Tab 3: Commercial General Liability
-                    with tabs[2]:
-                        cgl_company = st.text_input("Each occ Commercial General Liability Insurance Company", key="cgl_company",
-                                                 value=st.session_state.form_values["cgl_company_value"])
-                        cgl_currency = st.text_input("Each occ Commercial General Liability Currency", key="cgl_currency",
-                                                  value=st.session_state.form_values["cgl_currency_value"])
-                        cgl_amount = st.text_input("Each occ Commercial General Liability Amount", key="cgl_amount",
-                                                value=st.session_state.form_values["cgl_amount_value"])
-                        cgl_ded_currency = st.text_input("Each occ Commercial General Liability DED. Currency", key="cgl_ded_currency",
-                                                      value=st.session_state.form_values["cgl_ded_currency_value"])
-                        cgl_ded_amount = st.text_input("Each occ Commercial General Liability DED. Amount", key="cgl_ded_amount",
-                                                    value=st.session_state.form_values["cgl_ded_amount_value"])
-                        cgl_expiry = st.text_input("Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)", key="cgl_expiry",
-                                                value=st.session_state.form_values["cgl_expiry_value"])
-                    
-                    # Tab 4: Non-owned Trailer
-                    with tabs[3]:
-                        trailer_company = st.text_input("Non-owned Trailer Insurance Company", key="trailer_company",
-                                                     value=st.session_state.form_values["trailer_company_value"])
-                        trailer_currency = st.text_input("Non-owned Trailer Currency", key="trailer_currency",
-                                                      value=st.session_state.form_values["trailer_currency_value"])
-                        trailer_amount = st.text_input("Non-owned Trailer Amount", key="trailer_amount",
-                                                    value=st.session_state.form_values["trailer_amount_value"])
-                        trailer_ded_currency = st.text_input("Non-owned Trailer DED. Currency", key="trailer_ded_currency",
-                                                         value=st.session_state.form_values["trailer_ded_currency_value"])
-                        trailer_ded_amount = st.text_input("Non-owned Trailer DED. Amount", key="trailer_ded_amount",
-                                                       value=st.session_state.form_values["trailer_ded_amount_value"])
-                        trailer_expiry = st.text_input("Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)", key="trailer_expiry",
-                                                    value=st.session_state.form_values["trailer_expiry_value"])
-                    
-                    # Tab 5: Others
-                    with tabs[4]:
-                        st.markdown("##### Additional insured")
-                        additional_insured = st.text_area("Additional Insured", key="additional_insured",
-                                                      value=st.session_state.form_values["additional_insured_value"])
-                    
-                        st.markdown("##### Certificate Holder")
-                        certificate_holder = st.text_area("Certificate Holder", key="certificate_holder",
-                                                       value=st.session_state.form_values["certificate_holder_value"])
-                    
-                        st.markdown("##### Cancellation Notice Period (days)")
-                        cancellation_period = st.text_input("Cancellation Notice Period (days)", key="cancellation_period",
-                                                         value=st.session_state.form_values["cancellation_period_value"])
-                    
-                    # Process button
-                    process_button = st.form_submit_button("Save Certificate")
-                    
-                    if process_button:
-                        # Process the data
-                        certificate_data = {
-                            "Template Form": form_type,
-                            "Page Count": "1",  # This would be determined by the actual processing
-                            "Name of file": "Manually entered",
-                            "Automobile Liability Insurance Company": auto_liability_company,
-                            "Automobile Liability Currency": auto_liability_currency,
-                            "Automobile Liability Amount": auto_liability_amount,
-                            "Automobile Liability DED. Currency": auto_liability_ded_currency,
-                            "Automobile Liability DED. Amount": auto_liability_ded_amount,
-                            "Automobile Liability Expiry Date (yyyy/mm/dd)": auto_liability_expiry,
-                            "Each occ Commercial General Liability Insurance Company": cgl_company,
-                            "Each occ Commercial General Liability Currency": cgl_currency,
-                            "Each occ Commercial General Liability Amount": cgl_amount,
-                            "Each occ Commercial General Liability DED. Currency": cgl_ded_currency,
-                            "Each occ Commercial General Liability DED. Amount": cgl_ded_amount,
-                            "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": cgl_expiry,
-                            "Non-owned Trailer Insurance Company": trailer_company,
-                            "Non-owned Trailer Currency": trailer_currency,
-                            "Non-owned Trailer Amount": trailer_amount,
-                            "Non-owned Trailer DED. Currency": trailer_ded_currency,
-                            "Non-owned Trailer DED. Amount": trailer_ded_amount,
-                            "Non-owned Trailer Amount Expiry Date (yyyy/mm/dd)": trailer_expiry,
-                            "Additional insured": additional_insured,
-                            "Certificate Holder": certificate_holder,
-                            "Cancellation Notice Period (days)": cancellation_period
-                        }
-                        
-                        # Add to dataframe
-                        st.session_state.certificates = pd.concat([
-                            st.session_state.certificates, 
-                            pd.DataFrame([certificate_data])
-                        ], ignore_index=True)
-                        
-                        st.success("Certificate saved successfully!")
+            if get_work_queue() is not None:
+                render_queued_jobs()
+            render_results_queue()
+            render_status_cards()
+            render_certificate_form()
         
-        # Display all processed certificates
-        if not st.session_state.certificates.empty:
-            st.subheader("Processed Certificates")
-            st.dataframe(st.session_state.certificates)
-            
-            # Add export functionality
-            excel_data = export_to_excel(st.session_state.certificates)
-            st.download_button(
-                label="Download Certificates as Excel",
-                data=excel_data,
-                file_name="insurance_certificates.xlsx",
-                mime="application/vnd.ms-excel"
-            )
+        render_certificates_table()
+        render_certificate_search()
+        render_ledger_import()
+    
+    st.session_state.last_rerun_ms = (time.perf_counter() - rerun_start) * 1000
 
 # Add custom CSS to style the app
 st.markdown("""
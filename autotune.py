@@ -0,0 +1,174 @@
+"""
+Parameter sweep for the page rendering pipeline.
+
+Every combination of DPI, preprocessing variant, image format and page size is run over a
+labeled sample set through the vision tier. Per-field accuracy is reported against request
+bytes, tokens and latency, and the Pareto-optimal profile that stays within --max-accuracy-loss
+of the best accuracy at the lowest token cost is written as the pipeline profile the app loads.
+
+    python autotune.py samples/ --labels reviewed.xlsx --out pipeline_profile.json
+
+Labels are either the app's certificates export (.xlsx/.csv, matched on "Name of file") or a
+JSON object mapping file names to {export column: expected value}.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import pandas as pd
+
+DOCUMENT_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+
+def load_labels(path):
+    """{file name: {export column: expected value}}, leaving out blank labels."""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            labels = json.load(f)
+    else:
+        frame = pd.read_csv(path, dtype=str) if path.lower().endswith(".csv") else pd.read_excel(path, dtype=str)
+        labels = {row.pop("Name of file"): row for row in frame.fillna("").to_dict("records")}
+    return {name: {column: str(value) for column, value in expected.items()
+                   if column not in ("Name of file", "Page Count") and str(value).strip()}
+            for name, expected in labels.items()}
+
+def comparable(value):
+    return " ".join(str(value).split()).casefold()
+
+def profile_grid(args, base):
+    for dpi, preprocess, image_format, max_side in itertools.product(args.dpi, args.preprocess, args.format, args.max_side):
+        yield dict(base, dpi=dpi, preprocess=preprocess, format=image_format, max_side=max_side)
+
+def profile_name(profile):
+    size = f"max{profile['max_side']}" if profile["max_side"] else "full"
+    return f"{profile['dpi']}dpi-{profile['preprocess']}-{profile['format'].lower()}-{size}"
+
+def run_profile(UI, profile, samples, labels, answers):
+    """Extract every sample with one profile; returns the report row."""
+    correct, totals = {}, {}
+    request_bytes = tokens = render_seconds = call_seconds = 0.0
+    failures = 0
+    for name, content in samples.items():
+        with UI.get_spool().job(UI.current_session_id()) as job:
+            document = UI.ingest_document(job, content, name)
+            page_texts = UI.extract_pdf_page_texts(document.path) if document.is_pdf else None
+            start = time.perf_counter()
+            pages = UI.render_page_images(document, page_texts, profile)
+            render_seconds += time.perf_counter() - start
+        payload = UI.vision_payload([UI.convert_bytes_to_base64(page) for page in pages])
+        body = json.dumps(payload).encode()
+        request_bytes += len(body)
+
+        # Profiles that yield identical pages (e.g. a size limit above the rendered size) share one call
+        digest = hashlib.sha1(body).hexdigest()
+        if digest not in answers:
+            start = time.perf_counter()
+            response = UI.post_chat_completion(payload)
+            elapsed = time.perf_counter() - start
+            answer = response.json() if response.status_code == 200 else None
+            answers[digest] = (answer, elapsed)
+        answer, elapsed = answers[digest]
+        call_seconds += elapsed
+        if answer is None:
+            failures += 1
+            continue
+        tokens += answer.get("usage", {}).get("total_tokens") or UI.estimate_request_tokens(payload)
+
+        row = UI.parse_structured_response(answer["choices"][0]["message"]["content"]) or {}
+        structured, _ = UI.normalize_structured_data(UI.structured_from_export_row(row))
+        extracted = UI.certificate_row(UI.flat_form_values(structured or {}), name, len(pages))
+        for column, expected in labels.get(name, {}).items():
+            totals[column] = totals.get(column, 0) + 1
+            correct[column] = correct.get(column, 0) + (comparable(extracted.get(column, "")) == comparable(expected))
+
+    documents = len(samples)
+    report = {
+        "profile": profile_name(profile),
+        "accuracy": sum(correct.values()) / sum(totals.values()) if totals else 0.0,
+        "tokens_per_doc": tokens / documents,
+        "kb_per_doc": request_bytes / documents / 1024,
+        "render_s_per_doc": render_seconds / documents,
+        "call_s_per_doc": call_seconds / documents,
+        "failed_calls": failures,
+        "settings": profile,
+    }
+    report.update({f"acc: {column}": correct[column] / totals[column] for column in sorted(totals)})
+    return report
+
+def pareto_front(reports):
+    """Reports no other report beats on accuracy, tokens and latency at once."""
+    def dominates(a, b):
+        better_or_equal = (a["accuracy"] >= b["accuracy"] and a["tokens_per_doc"] <= b["tokens_per_doc"]
+                           and a["latency_s_per_doc"] <= b["latency_s_per_doc"])
+        strictly = (a["accuracy"] > b["accuracy"] or a["tokens_per_doc"] < b["tokens_per_doc"]
+                    or a["latency_s_per_doc"] < b["latency_s_per_doc"])
+        return better_or_equal and strictly
+    return [report for report in reports if not any(dominates(other, report) for other in reports)]
+
+def choose_profile(front, max_accuracy_loss):
+    """Cheapest (tokens, then latency) front profile within the allowed accuracy loss of the best one."""
+    best = max(report["accuracy"] for report in front)
+    eligible = [report for report in front if report["accuracy"] >= best - max_accuracy_loss]
+    return min(eligible, key=lambda report: (report["tokens_per_doc"], report["latency_s_per_doc"]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("samples", help="directory of sample certificates")
+    parser.add_argument("--labels", required=True, help="reviewed values (.xlsx/.csv export or .json)")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[150, 200, 300])
+    parser.add_argument("--preprocess", nargs="+", default=["threshold", "gray"])
+    parser.add_argument("--format", nargs="+", default=["PNG", "JPEG"], type=str.upper)
+    parser.add_argument("--max-side", type=int, nargs="+", default=[0, 2048])
+    parser.add_argument("--max-accuracy-loss", type=float, default=0.01,
+                        help="accuracy the chosen profile may give up for lower cost")
+    parser.add_argument("--out", default="pipeline_profile.json", help="profile file to write")
+    parser.add_argument("--report", default="autotune_report.csv", help="per-profile results")
+    args = parser.parse_args()
+
+    # Imported here so --help works without loading the app
+    import UI
+
+    UI.initialize_session_state()
+    UI.resources().warm()
+    if not (UI.st.session_state.endpoint and UI.st.session_state.api_key):
+        raise SystemExit("Set AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY.")
+    for value in args.preprocess:
+        if value not in UI.PREPROCESS_VARIANTS:
+            raise SystemExit(f"Unknown preprocessing variant {value}; choose from {', '.join(UI.PREPROCESS_VARIANTS)}")
+    for value in args.format:
+        if value not in UI.PAGE_FORMATS:
+            raise SystemExit(f"Unknown format {value}; choose from {', '.join(UI.PAGE_FORMATS)}")
+
+    labels = load_labels(args.labels)
+    samples = {}
+    for name in sorted(os.listdir(args.samples)):
+        if name.lower().endswith(DOCUMENT_EXTENSIONS) and name in labels:
+            with open(os.path.join(args.samples, name), "rb") as f:
+                samples[name] = f.read()
+    if not samples:
+        raise SystemExit("No sample in the directory has labels.")
+
+    base = UI.load_pipeline_profile()
+    reports, answers = [], {}
+    for profile in profile_grid(args, base):
+        report = run_profile(UI, profile, samples, labels, answers)
+        report["latency_s_per_doc"] = report["render_s_per_doc"] + report["call_s_per_doc"]
+        reports.append(report)
+        print(f"{report['profile']:<32} accuracy {report['accuracy']:.3f}  {report['tokens_per_doc']:7.0f} tokens  "
+              f"{report['kb_per_doc']:7.0f} KB  {report['latency_s_per_doc']:6.2f} s/doc", flush=True)
+
+    front = pareto_front(reports)
+    chosen = choose_profile(front, args.max_accuracy_loss)
+    for report in reports:
+        report["pareto"] = report in front
+    pd.DataFrame([{key: value for key, value in report.items() if key != "settings"} for report in reports]) \
+        .sort_values(["accuracy", "tokens_per_doc"], ascending=[False, True]).to_csv(args.report, index=False)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(chosen["settings"], f, indent=2)
+    print(f"{len(front)} of {len(reports)} profiles on the Pareto front; wrote {chosen['profile']} "
+          f"(accuracy {chosen['accuracy']:.3f}, {chosen['tokens_per_doc']:.0f} tokens/doc) to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Offline batch extraction for the nightly backlog.
+
+Documents are compiled into JSONL batch request files with stable custom ids (document hash,
+manifest index and stage), submitted to the Azure OpenAI Batch API (or a local stand-in with --local), and the
+results are parsed, normalized and stored in the certificate index exactly like interactive
+extractions. Text-stage answers that still have failing fields go to a second, vision round.
+
+    python batch.py run invoices/*.pdf --out batch_runs/nightly --excel nightly.xlsx
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+
+DEFAULT_POLL_SECONDS = 60
+DOCUMENT_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+
+def expand_inputs(inputs):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(sorted(path for path in glob.glob(os.path.join(item, "**", "*"), recursive=True)
+                                if path.lower().endswith(DOCUMENT_EXTENSIONS)))
+        else:
+            paths.append(item)
+    return paths
+
+def run_round(UI, client, stage, entries, out_dir, poll_seconds, round_number):
+    """Compile, submit and collect one stage; returns the entries that need the next stage."""
+    lines = []
+    compiled = {}
+    for key, entry in entries.items():
+        line, compiled_entry = UI.compile_batch_document(entry["path"], stage, entry)
+        entries[key] = compiled_entry
+        if line:
+            lines.append(line)
+            compiled[compiled_entry["custom_id"]] = key
+    escalate = {}
+    for path in UI.write_batch_files(lines, out_dir, f"requests_round{round_number}"):
+        batch_id = client.submit(path)
+        print(f"{stage}: submitted {os.path.basename(path)} as {batch_id}", flush=True)
+        batch = UI.wait_for_batch(client, batch_id, poll_seconds)
+        print(f"{stage}: {batch_id} {batch['status']}", flush=True)
+        for result in client.results(batch_id):
+            key = compiled.get(result["custom_id"])
+            if key is not None and UI.apply_batch_result(entries[key], result):
+                escalate[key] = entries[key]
+    return escalate
+
+def run(args):
+    # Imported here so --help works without loading the app
+    import UI
+
+    UI.initialize_session_state()
+    UI.resources().warm()
+    os.makedirs(args.out, exist_ok=True)
+    if args.local:
+        client = UI.LocalBatchClient(args.out)
+    else:
+        endpoint, api_key = os.getenv("AZURE_OPENAI_ENDPOINT"), os.getenv("AZURE_OPENAI_API_KEY")
+        if not endpoint or not api_key or not UI.BATCH_DEPLOYMENT:
+            raise SystemExit("Set AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY and AZURE_OPENAI_BATCH_DEPLOYMENT, or use --local.")
+        client = UI.AzureBatchClient(endpoint, api_key)
+
+    index = UI.get_certificate_index()
+    entries = {}
+    for path in expand_inputs(args.inputs):
+        entries.setdefault(path, {"path": path, "index": len(entries)})
+    start = time.perf_counter()
+    escalate = run_round(UI, client, "text", entries, args.out, args.poll_seconds, 1)
+    if escalate:
+        run_round(UI, client, "vision", escalate, args.out, args.poll_seconds, 2)
+        entries.update(escalate)
+
+    records, failed = [], []
+    for entry in entries.values():
+        if entry.get("structured_data"):
+            records.append(UI.store_batch_entry(entry))
+        else:
+            failed.append({"file": entry["path"], "error": entry.get("error", "no structured data")})
+    with open(os.path.join(args.out, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({path: {key: value for key, value in entry.items() if key != "raw_text"}
+                   for path, entry in entries.items()}, f, indent=1, default=str)
+    if args.excel and records:
+        with open(args.excel, "wb") as f:
+            f.write(UI.export_to_excel(UI.records_frame(records)))
+    print(f"{len(records)} stored, {len(failed)} failed in {time.perf_counter() - start:.1f}s; index {index.snapshot()['documents']} documents")
+    for failure in failed:
+        print(f"failed: {failure['file']}: {failure['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="extract documents through the batch endpoint")
+    run_parser.add_argument("inputs", nargs="+", help="documents or directories of documents")
+    run_parser.add_argument("--out", default=os.path.join("batch_runs", time.strftime("%Y%m%d-%H%M%S")),
+                            help="directory for request files, outputs and the manifest")
+    run_parser.add_argument("--excel", help="also write the certificates table to this Excel file")
+    run_parser.add_argument("--local", action="store_true", help="answer requests with the local stand-in")
+    run_parser.add_argument("--poll-seconds", type=float, default=DEFAULT_POLL_SECONDS)
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+
+if __name__ == "__main__":
+    main()
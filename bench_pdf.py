@@ -0,0 +1,95 @@
+"""
+Benchmark of the PDF backends: text extraction and rasterization + preprocessing per page.
+
+Each backend reads the text layer of every input and renders every page at the given DPI
+through preprocess_image, reporting milliseconds per page and peak RSS growth. Without inputs
+a synthetic certificate-like PDF is generated with PyMuPDF.
+
+    python bench_pdf.py samples/*.pdf --dpi 200 --repeat 3
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+def synthetic_pdf(path, pages):
+    import fitz
+
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page()
+        y = 60
+        for line in range(45):
+            page.insert_text((50, y), f"INSURER {'ABCDEF'[line % 6]}: Carrier {number}-{line}   POLICY NUMBER AB{line:04d}   "
+                                      f"EACH OCCURRENCE 2,000,000   EXP DATE 2025/01/01", fontsize=8)
+            y += 16
+        for x in range(50, 560, 85):
+            page.draw_line((x, 50), (x, 790))
+    document.save(path)
+    document.close()
+
+def bench_backend(UI, backend, paths, dpi, repeat, scratch):
+    profile = UI.load_pipeline_profile()
+    text_seconds = render_seconds = 0.0
+    pages = 0
+    with UI.RssMonitor() as monitor:
+        for _ in range(repeat):
+            for path in paths:
+                start = time.perf_counter()
+                texts = backend.page_texts(path)
+                text_seconds += time.perf_counter() - start
+
+                start = time.perf_counter()
+                images = backend.render(path, scratch, dpi, grayscale=True)
+                for index in range(len(images)):
+                    UI.preprocess_image(images[index], profile)
+                render_seconds += time.perf_counter() - start
+                for file in images.files:
+                    os.remove(file)
+                pages += len(texts)
+    return {
+        "backend": backend.name,
+        "pages": pages,
+        "text ms/page": round(text_seconds * 1000 / max(pages, 1), 2),
+        "render+preprocess ms/page": round(render_seconds * 1000 / max(pages, 1), 2),
+        "peak RSS growth MB": round(monitor.peak_delta / 1e6, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("inputs", nargs="*", help="PDFs to benchmark (a synthetic one when empty)")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--synthetic-pages", type=int, default=10)
+    args = parser.parse_args()
+
+    # Imported here so --help works without loading the app
+    import UI
+
+    scratch = tempfile.mkdtemp(prefix="bench_pdf_")
+    try:
+        paths = args.inputs
+        if not paths:
+            paths = [os.path.join(scratch, "synthetic.pdf")]
+            synthetic_pdf(paths[0], args.synthetic_pages)
+        backends = [UI.PyMuPDFBackend()]
+        if shutil.which("pdftoppm"):
+            backends.append(UI.PopplerBackend())
+        else:
+            print("poppler (pdftoppm) is not installed; only its PyPDF2 text path is measured")
+        rows = [bench_backend(UI, backend, paths, args.dpi, args.repeat, scratch) for backend in backends]
+        if not shutil.which("pdftoppm"):
+            backend = UI.PopplerBackend()
+            start = time.perf_counter()
+            pages = sum(len(backend.page_texts(path)) for path in paths for _ in range(args.repeat))
+            rows.append({"backend": "poppler", "pages": pages,
+                         "text ms/page": round((time.perf_counter() - start) * 1000 / max(pages, 1), 2),
+                         "render+preprocess ms/page": None, "peak RSS growth MB": None})
+        for row in rows:
+            print("  ".join(f"{key}: {value}" for key, value in row.items()))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
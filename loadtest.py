@@ -0,0 +1,254 @@
+"""
+Concurrent-session load test for the app, with no network and no browser.
+
+Each simulated reviewer is a Streamlit AppTest session running the real script: it loads the
+app, submits a few certificates (generated PDFs, half of them sparse enough to need the model),
+edits the review form and saves. AppTest runs one script at a time per process, so every session
+is a process forked after the warm-up; they share the index, spool and model endpoint, while the
+in-process admission and rate limits apply per session. Model calls go to a local mock of the
+chat-completions endpoint with a configurable latency. The load is ramped through increasing session counts and each
+level reports rerun latency percentiles, RSS per session and document throughput; the ramp
+stops at the first level whose throughput no longer grows (saturation).
+
+    python loadtest.py --sessions 1 2 4 8 16 --iterations 3 --model-latency 0.5
+"""
+import argparse
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import runpy
+import shutil
+import tempfile
+import threading
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "UI.py")
+
+# AppTest runs a script file; this one loads the app without running main(), extracts the
+# documents a simulated upload handed over in session state, then renders the page as usual.
+SESSION_SCRIPT = """
+import runpy
+import streamlit as st
+
+app = runpy.run_path({app_path!r}, run_name="loadtest")
+documents = st.session_state.pop("loadtest_documents", None)
+if documents:
+    app["initialize_session_state"]()
+    app["start_results_batch"]()
+    app["process_documents"](documents)
+app["main"]()
+"""
+
+MOCK_ROW = {
+    "Template Form": "ACORD",
+    "Automobile Liability Insurance Company": "Intact Insurance",
+    "Automobile Liability Amount": "2,000,000",
+    "Automobile Liability Expiry Date (yyyy/mm/dd)": "2026/01/01",
+    "Each occ Commercial General Liability Insurance Company": "Aviva",
+    "Each occ Commercial General Liability Amount": "5,000,000",
+    "Each occ Commercial General Liability Expiry Date (yyyy/mm/dd)": "2026/01/01",
+    "Certificate Holder": "Load Test Holder",
+    "Cancellation Notice Period (days)": "30",
+}
+MOCK_STRUCTURED = {
+    "certificateInfo": {"templateForm": "ACORD", "insuredName": "Load Test Insured", "address": "1 Main St, Toronto ON"},
+    "automobileLiability": {"insuranceCompany": "Intact Insurance", "amount": "2,000,000", "expiryDate": "2026/01/01"},
+    "commercialGeneralLiability": {"insuranceCompany": "Aviva", "amount": "5,000,000", "expiryDate": "2026/01/01"},
+    "nonOwnedTrailer": {"insuranceCompany": "Intact Insurance", "amount": "50,000", "expiryDate": "2026/01/01"},
+    "other": {"certificateHolder": "Load Test Holder", "cancellationNoticePeriod": "30"},
+}
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+class MockModelHandler(http.server.BaseHTTPRequestHandler):
+    """Chat-completions stand-in: page images get the vision export row, text gets the nested schema."""
+
+    latency = 0.0
+    calls = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with MockModelHandler.lock:
+            MockModelHandler.calls += 1
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        content = body["messages"][-1]["content"]
+        vision = isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+        answer = MOCK_ROW if vision else MOCK_STRUCTURED
+        reply = json.dumps({
+            "choices": [{"message": {"content": f"<initial_attempt>```json\n{json.dumps(answer)}\n```</initial_attempt>"}}],
+            "usage": {"total_tokens": 1500 if vision else 800},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+def start_mock_endpoint(latency):
+    MockModelHandler.latency = latency
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MockModelHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/openai/deployments/mock/chat/completions"
+
+def certificate_pdf(number, complete):
+    """A one-page certificate; sparse ones have no coverage rows, so the rules tier escalates to the model."""
+    import fitz
+
+    lines = ["CERTIFICATE OF LIABILITY INSURANCE", f"CERTIFICATE NUMBER: LT-{number:05d}",
+             "INSURED: Load Test Insured 1 Main St, Toronto ON M5V 1A1", "INSURER A: Intact Insurance"]
+    if complete:
+        lines += ["INSR LTR TYPE POLICY NUMBER EFF DATE EXP DATE LIMITS",
+                  "A AUTOMOBILE LIABILITY AB120 2025/01/01 2026/01/01 COMBINED SINGLE LIMIT 2,000,000",
+                  "A COMMERCIAL GENERAL LIABILITY CG77 2025/01/01 2026/01/01 EACH OCCURRENCE 5,000,000 DED 1,000",
+                  "A NON-OWNED TRAILER SEF 27 2025/01/01 2026/01/01 50,000 DED 1,000",
+                  "CERTIFICATE HOLDER: Load Test Holder", "30 DAYS WRITTEN NOTICE OF CANCELLATION"]
+    document = fitz.open()
+    page = document.new_page()
+    page.insert_text((50, 60), "\n".join(lines), fontsize=9)
+    data = document.tobytes()
+    document.close()
+    return data
+
+def run_session(number, args, endpoint):
+    """One reviewer's rounds; returns its rerun latencies, document count, errors and RSS growth."""
+    import psutil
+    from streamlit.testing.v1 import AppTest
+
+    baseline = psutil.Process().memory_info().rss
+    latencies, documents, errors = [], 0, []
+
+    def timed(step):
+        start = time.perf_counter()
+        step()
+        latencies.append(time.perf_counter() - start)
+        if at.exception:
+            errors.append(str(at.exception[0].value)[:200])
+
+    at = AppTest.from_file(args.session_script, default_timeout=args.timeout)
+    at.session_state["api_configured"] = True
+    at.session_state["endpoint"] = endpoint
+    at.session_state["api_key"] = "loadtest"
+    at.session_state["reuse_extractions"] = False
+    timed(at.run)
+    for iteration in range(args.iterations):
+        uploads = [(certificate_pdf(number * 1000 + iteration * 10 + index, random.random() >= args.model_share),
+                    f"session{number}-{iteration}-{index}.pdf") for index in range(args.documents)]
+        at.session_state["loadtest_documents"] = uploads
+        timed(at.run)
+        documents += len(uploads)
+        for _ in range(len(uploads)):
+            at.text_input(key="insured_name").set_value(f"Reviewed {number}-{iteration}")
+            at.text_input(key="trailer_company").set_value("Intact Insurance")
+            save = next(button for button in at.button if button.label == "Save Certificate")
+            timed(save.click().run)
+        timed(at.run)
+    return {"latencies": latencies, "documents": documents, "errors": errors,
+            "saved": len(at.session_state["certificates"]),
+            "rss_growth": psutil.Process().memory_info().rss - baseline}
+
+def session_process(number, args, endpoint, results):
+    try:
+        results.put(run_session(number, args, endpoint))
+    except Exception as error:
+        results.put({"latencies": [], "documents": 0, "errors": [f"{type(error).__name__}: {error}"[:200]],
+                     "saved": 0, "rss_growth": 0})
+
+def run_level(sessions, args, endpoint):
+    # Forked after the warm-up, so every session starts from the same loaded models and caches
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    workers = [context.Process(target=session_process, args=(number, args, endpoint, queue)) for number in range(sessions)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    results = {}
+    for number in range(sessions):
+        results[number] = queue.get()
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+    latencies = [latency for result in results.values() for latency in result["latencies"]]
+    documents = sum(result["documents"] for result in results.values())
+    errors = [error for result in results.values() for error in result["errors"]]
+    return {
+        "sessions": sessions,
+        "reruns": len(latencies),
+        "rerun_p50_ms": round(percentile(latencies, 50) * 1000) if latencies else None,
+        "rerun_p95_ms": round(percentile(latencies, 95) * 1000) if latencies else None,
+        "rerun_p99_ms": round(percentile(latencies, 99) * 1000) if latencies else None,
+        "docs_per_s": round(documents / elapsed, 2),
+        "rss_mb_per_session": round(sum(max(0, result["rss_growth"]) for result in results.values()) / 1e6 / sessions, 1),
+        "saved": sum(result["saved"] for result in results.values()),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else "",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8], help="session counts to ramp through")
+    parser.add_argument("--iterations", type=int, default=2, help="upload/review rounds per session")
+    parser.add_argument("--documents", type=int, default=2, help="documents per upload")
+    parser.add_argument("--model-share", type=float, default=0.5, help="share of documents that need the model")
+    parser.add_argument("--model-latency", type=float, default=0.3, help="mean mock model latency in seconds")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds one rerun may take")
+    parser.add_argument("--saturation-gain", type=float, default=0.1,
+                        help="stop when throughput grows by less than this share from one level to the next")
+    parser.add_argument("--report", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="loadtest_")
+    # Keep the run away from the real index, spool and queue; the app reads these at import
+    os.environ.update({
+        "CERT_INDEX_PATH": os.path.join(scratch, "certificate_index.db"),
+        "CERT_SPOOL_DIR": os.path.join(scratch, "spool"),
+        "CERT_WORK_QUEUE": "",
+        "AZURE_OPENAI_RPM_LIMIT": "100000",
+        "AZURE_OPENAI_TPM_LIMIT": "100000000",
+    })
+    server, endpoint = start_mock_endpoint(args.model_latency)
+    os.environ["AZURE_OPENAI_ENDPOINT"] = endpoint
+    args.session_script = os.path.join(scratch, "session_app.py")
+    with open(args.session_script, "w", encoding="utf-8") as f:
+        f.write(SESSION_SCRIPT.format(app_path=APP_PATH))
+
+    # Warm the process-wide resources once, as a running replica would have
+    runpy.run_path(APP_PATH, run_name="loadtest")["resources"]().warm()
+
+    levels = []
+    try:
+        for sessions in args.sessions:
+            level = run_level(sessions, args, endpoint)
+            levels.append(level)
+            print("  ".join(f"{key}: {value}" for key, value in level.items() if key != "first_error"), flush=True)
+            if level["first_error"]:
+                print(f"  first error: {level['first_error']}")
+            if len(levels) > 1 and level["docs_per_s"] < levels[-2]["docs_per_s"] * (1 + args.saturation_gain):
+                print(f"saturated at {levels[-2]['sessions']} sessions "
+                      f"({levels[-2]['docs_per_s']} docs/s, p95 rerun {levels[-2]['rerun_p95_ms']} ms)")
+                break
+        else:
+            print(f"not saturated at {levels[-1]['sessions']} sessions; ramp further with --sessions")
+        print(f"mock model calls: {MockModelHandler.calls}")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(levels, f, indent=1)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
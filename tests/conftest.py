@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Scratch, index and offload files of the app go to a throwaway directory, not the working tree
+SCRATCH = tempfile.mkdtemp(prefix="certificate_tests_")
+os.environ.setdefault("CERT_SPOOL_DIR", os.path.join(SCRATCH, "spool"))
+os.environ.setdefault("CERT_INDEX_PATH", os.path.join(SCRATCH, "certificate_index.db"))
+os.environ.setdefault("CERT_SESSION_OFFLOAD_DIR", os.path.join(SCRATCH, "sessions"))
+os.environ.setdefault("CERT_WORK_QUEUE_DIR", os.path.join(SCRATCH, "work_queue"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import threading
+
+import UI
+
+def drain(scheduler):
+    """Grant waiting tickets one at a time as a single slot would; returns (session, file) in grant order."""
+    order = []
+    while any(scheduler.waiting.values()):
+        for lane in UI.ADMISSION_LANES:
+            for ticket in scheduler.waiting[lane]:
+                ticket.ready = True
+        ticket = scheduler._next()
+        scheduler.acquire(ticket)
+        scheduler.release(ticket)
+        order.append((ticket.session_id, ticket.file_name))
+    return order
+
+def test_sessions_share_slots_in_proportion_to_weight():
+    scheduler = UI.AdmissionScheduler(1)
+    scheduler.submit("a", "bulk", 2.0, ["a1", "a2", "a3", "a4"])
+    scheduler.submit("b", "bulk", 1.0, ["b1", "b2"])
+    assert [name for _, name in drain(scheduler)] == ["a1", "a2", "b1", "a3", "a4", "b2"]
+
+def test_late_session_does_not_wait_behind_a_backlog():
+    scheduler = UI.AdmissionScheduler(1)
+    backlog = scheduler.submit("a", "bulk", 1.0, [f"a{n}" for n in range(1, 9)])
+    for ticket in backlog[:3]:
+        ticket.ready = True
+        scheduler.acquire(ticket)
+        scheduler.release(ticket)
+    scheduler.submit("b", "bulk", 1.0, ["b1"])
+    # b1 is tagged from the lane's virtual clock, not from the end of a's backlog
+    assert [name for _, name in drain(scheduler)][:2] == ["b1", "a4"]
+
+def test_interactive_lane_goes_first_with_a_burst_limit():
+    scheduler = UI.AdmissionScheduler(1)
+    scheduler.submit("batch", "bulk", 1.0, ["bulk1", "bulk2"])
+    for n in range(1, 7):
+        scheduler.submit(f"reviewer{n}", "interactive", 1.0, [f"scan{n}"])
+    order = [name for _, name in drain(scheduler)]
+    burst = UI.ADMISSION_INTERACTIVE_BURST
+    assert order[:burst] == [f"scan{n}" for n in range(1, burst + 1)]
+    assert order[burst] == "bulk1"
+    assert order[burst + 1:] == [f"scan{n}" for n in range(burst + 1, 7)] + ["bulk2"]
+
+def test_acquire_blocks_until_a_slot_is_released():
+    scheduler = UI.AdmissionScheduler(1)
+    first, second = scheduler.submit("a", "interactive", 1.0, ["one", "two"])
+    scheduler.acquire(first)
+    positions = []
+    granted = threading.Event()
+
+    def wait_for_slot():
+        scheduler.acquire(second, on_wait=positions.append)
+        granted.set()
+
+    thread = threading.Thread(target=wait_for_slot)
+    thread.start()
+    assert not granted.wait(0.2)
+    assert positions and positions[0] == 1
+    assert scheduler.session_view("a") == {"waiting": 1, "running": 1, "ahead": 1}
+    scheduler.release(first)
+    assert granted.wait(5)
+    thread.join(5)
+    scheduler.release(second)
+    assert scheduler.snapshot()["admitted"] == 2
+    assert scheduler.estimated_wait(2) is not None
+
+def test_cancel_drops_only_waiting_tickets():
+    scheduler = UI.AdmissionScheduler(1)
+    tickets = scheduler.submit("a", "bulk", 1.0, ["one", "two", "three"])
+    tickets[0].ready = True
+    scheduler.acquire(tickets[0])
+    scheduler.cancel(tickets)
+    snapshot = scheduler.snapshot()
+    assert snapshot["cancelled"] == 2
+    assert snapshot["bulk_waiting"] == 0
+    assert snapshot["running"] == 1
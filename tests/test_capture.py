@@ -0,0 +1,28 @@
+import numpy as np
+
+import UI
+
+def quality(skew, quad=None):
+    return {"quad": quad, "skew": skew}
+
+def frame(height=400, width=300):
+    image = np.full((height, width, 3), 255, np.uint8)
+    image[100:110, 50:250] = 0
+    return image
+
+def test_rotation_only_deskew_counts_as_a_correction():
+    image = frame()
+    corrected, changed = UI.correct_capture(image, quality(3.0))
+    assert changed
+    assert corrected.shape == image.shape
+
+def test_straight_frames_are_left_alone():
+    image = frame()
+    corrected, changed = UI.correct_capture(image, quality(0.2))
+    assert not changed
+    assert corrected is image
+
+def test_oversized_frames_are_downscaled():
+    corrected, changed = UI.correct_capture(frame(UI.CAPTURE_MAX_SIDE * 2, 300), quality(0.0))
+    assert changed
+    assert max(corrected.shape[:2]) == UI.CAPTURE_MAX_SIDE
@@ -0,0 +1,98 @@
+import json
+
+import UI
+
+CERTIFICATE_TEXT = """ACORD 25 CERTIFICATE OF LIABILITY INSURANCE
+CERTIFICATE NUMBER: CA-20417
+INSURED
+Ridgeline Haulage Ltd.
+1 Main St, Toronto ON M5V 1A1
+INSURER A : Intact Insurance Company
+INSR LTR TYPE OF INSURANCE POLICY NUMBER EFF DATE EXP DATE LIMITS
+A AUTOMOBILE LIABILITY AB120 2025/01/01 2026/01/01 COMBINED SINGLE LIMIT 2,000,000
+A COMMERCIAL GENERAL LIABILITY CG77 2025/01/01 2026/01/01 EACH OCCURRENCE 5,000,000 DED 1,000
+A NON-OWNED TRAILER SEF 27 2025/01/01 2026/01/01 50,000 DED 1,000
+CERTIFICATE HOLDER: Keay Investments LTD o/a Ocean Trailer
+30 DAYS WRITTEN NOTICE OF CANCELLATION
+"""
+
+VISION_ROW = {
+    "Template Form": "ACORD",
+    "Insured Address": "500 Commerce St, Austin TX 78701",
+    "Automobile Liability Insurance Company": "Travelers",
+    "Automobile Liability Currency": "",
+    "Automobile Liability Amount": "1,000,000",
+    "Automobile Liability DED. Currency": "",
+    "Automobile Liability DED. Amount": "",
+    "Automobile Liability Expiry Date (yyyy/mm/dd)": "2026/03/01",
+    "Certificate Holder": "To Whom it May Concern",
+    "Additional insured": "Certificate Holder",
+    "Cancellation Notice Period (days)": "30",
+    "Insurers": {"A": "Travelers"},
+}
+
+class Document:
+    name = "scan.pdf"
+
+def stub_vision(monkeypatch, row):
+    monkeypatch.setattr(UI, "render_document_pages", lambda document, page_texts=None: [b"page"])
+    monkeypatch.setattr(UI, "convert_bytes_to_base64", lambda page: "data:image/png;base64,")
+    monkeypatch.setattr(UI, "get_raw_text", lambda image_urls: (
+        "<initial_attempt>```json\n" + json.dumps(row) + "\n```</initial_attempt>"
+    ))
+
+def test_rules_tier_accepts_complete_text_layer():
+    structured = UI.extract_with_rules(CERTIFICATE_TEXT)
+    score, failing = UI.score_structured_data(structured)
+    assert failing == []
+    assert score >= UI.CASCADE_CONFIDENCE_THRESHOLD
+    assert structured["automobileLiability"]["amount"] == "2000000"
+    assert structured["automobileLiability"]["currency"] == "CAD"
+    assert structured["commercialGeneralLiability"]["deductibleAmount"] == "1000"
+    assert structured["other"]["cancellationNoticePeriod"] == "30"
+
+def test_rules_currency_comes_from_insured_address_only():
+    text = CERTIFICATE_TEXT.replace("1 Main St, Toronto ON M5V 1A1", "500 Commerce St, Austin TX 78701")
+    text += "COVERAGE AS SHOWN ON THE SCHEDULE BASED ON THE POLICY ON FILE\n"
+    structured = UI.extract_with_rules(text)
+    assert structured["automobileLiability"]["currency"] == "USD"
+    assert UI.score_structured_data(structured)[1] == []
+
+def test_currency_from_address_needs_postal_code_next_to_province():
+    assert UI.currency_from_address("AS SHOWN ON THE SCHEDULE BASED ON") is None
+    assert UI.currency_from_address("Rocky View, AB, T1X 0K2") == "CAD"
+    assert UI.currency_from_address("Austin TX 78701") == "USD"
+
+def test_score_flags_bad_dates_amounts_and_currency():
+    structured = UI.extract_with_rules(CERTIFICATE_TEXT)
+    structured["certificateInfo"]["address"] = "1 Main St, Toronto ON M5V 1A1"
+    structured["automobileLiability"].update(expiryDate="01/02/2026", amount="two million", currency="USD")
+    _, failing = UI.score_structured_data(structured)
+    assert {("automobileLiability", "expiryDate"), ("automobileLiability", "amount"),
+            ("automobileLiability", "currency")} <= set(failing)
+
+def test_vision_answer_kept_whole_without_earlier_result(monkeypatch):
+    stub_vision(monkeypatch, VISION_ROW)
+    structured, tier = UI.structure_with_cascade(None, Document())
+    assert tier == "vision"
+    assert structured["certificateInfo"]["templateForm"] == "ACORD"
+    assert structured["other"]["certificateHolder"] == "To Whom it May Concern"
+    assert structured["other"]["additionalInsured"] == "Certificate Holder"
+    assert structured["insurers"] == {"A": "Travelers"}
+    assert structured["automobileLiability"]["amount"] == "1000000"
+    assert structured["automobileLiability"]["currency"] == "USD"
+
+def test_vision_answer_repairs_only_failing_fields(monkeypatch):
+    # Without policy dates three expiry fields fail, which is below the rules threshold
+    text = CERTIFICATE_TEXT.replace(" 2025/01/01 2026/01/01", "")
+    monkeypatch.setattr(UI, "get_structured_data_from_text", lambda *args, **kwargs: None)
+    monkeypatch.setattr(UI, "PRERENDER_PAGES", False)
+    stub_vision(monkeypatch, dict(VISION_ROW, **{"Insured Address": "1 Main St, Toronto ON M5V 1A1",
+                                                 "Certificate Holder": "Someone Else"}))
+    rules = UI.extract_with_rules(text)
+    structured, tier = UI.structure_with_cascade(text, Document())
+    assert tier == "vision"
+    assert structured["automobileLiability"]["expiryDate"] == "2026/03/01"
+    # Fields the rules tier got right are not overwritten by the escalated answer
+    assert structured["automobileLiability"]["amount"] == "2000000"
+    assert structured["other"] == rules["other"]
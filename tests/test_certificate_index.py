@@ -0,0 +1,59 @@
+import pytest
+
+import UI
+
+def form(insured, holder="To Whom it May Concern", insurer="Intact Insurance Company", number="", expiry="2026/01/01"):
+    return {"insured_name_value": insured, "certificate_holder_value": holder, "cert_number_value": number,
+            "auto_liability_insurance_company_value": insurer, "cgl_company_value": insurer,
+            "auto_liability_expiry_date_value": expiry}
+
+@pytest.fixture
+def index(tmp_path):
+    index = UI.CertificateIndex(str(tmp_path / "index.db"))
+    index.upsert("sha-1", "ridgeline.pdf", "extracted", form("Ridgeline Haulage Ltd."),
+                 page_count=2, structured={"certificateInfo": {}}, raw_text="ACORD 25 policy AB120 Combined single limit")
+    index.upsert("sha-2", "northern.pdf", "extracted", form("Northern Freightways Inc.", insurer="Aviva", number="NF-77"),
+                 page_count=1, structured={}, raw_text="Monarch certificate")
+    yield index
+    index.connection.close()
+
+def test_word_and_prefix_search(index):
+    assert index.search("ridgeline")["File"].tolist() == ["ridgeline.pdf"]
+    assert index.search("Freight")["File"].tolist() == ["northern.pdf"]
+    assert index.search("AB120")["File"].tolist() == ["ridgeline.pdf"]
+    assert index.search("aviva")["Match"].tolist() == ["words"]
+
+def test_fuzzy_search_tolerates_misspelled_names(index):
+    results = index.search("Ridgline Haulge")
+    assert results["File"].tolist() == ["ridgeline.pdf"]
+    assert results["Match"].tolist() == ["fuzzy"]
+
+def test_search_without_matches_is_empty(index):
+    assert index.search("zzzqqq").empty
+    assert index.search("  ").empty
+
+def test_saving_reindexes_and_keeps_extraction(index):
+    index.upsert("sha-1", "ridgeline.pdf", "saved", form("Ridgeline Transport Ltd."))
+    assert index.search("haulage").empty
+    assert index.search("transport")["Status"].tolist() == ["saved"]
+    cached = index.cached_extraction("sha-1")
+    # The text layer and extraction survive an update that doesn't carry them
+    assert cached["structured_data"] == {"certificateInfo": {}}
+    assert cached["raw_text"].startswith("ACORD 25")
+    assert cached["page_count"] == 2
+    assert cached["form_values"]["insured_name_value"] == "Ridgeline Transport Ltd."
+    assert index.snapshot()["documents"] == 2
+
+def test_cached_extraction_of_unsaved_documents(index):
+    cached = index.cached_extraction("sha-2")
+    assert cached["form_values"] is None
+    assert index.cached_extraction("unknown") is None
+    index.upsert("manual-1", "Manually entered", "saved", form("Manual Entry Co."))
+    assert index.cached_extraction("manual-1") is None
+    assert index.snapshot()["lookups"] == 3
+
+def test_index_persists_across_connections(index):
+    index.connection.close()
+    reopened = UI.CertificateIndex(index.path)
+    assert reopened.search("northern")["File"].tolist() == ["northern.pdf"]
+    index.connection = reopened.connection
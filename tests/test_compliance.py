@@ -0,0 +1,87 @@
+import json
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+import streamlit as st
+
+import UI
+
+AUTO = UI.COMPLIANCE_COVERAGES["Automobile Liability"]
+CGL = UI.COMPLIANCE_COVERAGES["Commercial General Liability"]
+TRAILER = UI.COMPLIANCE_COVERAGES["Non-owned Trailer"]
+
+def day(offset):
+    return (datetime.now().date() + timedelta(days=offset)).strftime("%Y/%m/%d")
+
+def certificate(**values):
+    row = {
+        AUTO["amount"]: "2000000", AUTO["currency"]: "CAD", AUTO["deductible_currency"]: "CAD", AUTO["expiry"]: day(365),
+        CGL["amount"]: "5,000,000", CGL["currency"]: "CAD", CGL["deductible_currency"]: "missing", CGL["expiry"]: day(365),
+        TRAILER["amount"]: "50000", TRAILER["currency"]: "CAD", TRAILER["deductible_currency"]: "CAD", TRAILER["expiry"]: day(365),
+    }
+    row.update(values)
+    return row
+
+def table(*rows):
+    return pd.DataFrame(list(rows), columns=UI.CERTIFICATE_COLUMNS)
+
+@pytest.fixture
+def rules():
+    st.session_state.pop("compliance_cache", None)
+    yield json.loads(json.dumps(UI.DEFAULT_COMPLIANCE_RULES))
+    st.session_state.pop("compliance_cache", None)
+
+def test_compliant_certificate_has_no_issues(rules):
+    results = UI.certificate_compliance(table(certificate()), rules)
+    assert results["Issues"].tolist() == [0]
+
+def test_each_rule_flags_its_coverage(rules):
+    rules["expected_currency"] = "CAD"
+    certificates = table(
+        certificate(**{AUTO["expiry"]: day(-1)}),
+        certificate(**{CGL["expiry"]: day(10)}),
+        certificate(**{AUTO["amount"]: "1,000,000"}),
+        certificate(**{TRAILER["amount"]: "missing"}),
+        certificate(**{AUTO["deductible_currency"]: "USD"}),
+        certificate(**{CGL["currency"]: "USD", CGL["deductible_currency"]: "USD"}),
+    )
+    results = UI.certificate_compliance(certificates, rules)
+    assert results["Automobile Liability: expired"].tolist() == [True, False, False, False, False, False]
+    assert results["Commercial General Liability: expiring soon"].tolist() == [False, True, False, False, False, False]
+    assert results["Automobile Liability: below required limit"].tolist() == [False, False, True, False, False, False]
+    assert results["Non-owned Trailer: missing coverage"].tolist() == [False, False, False, True, False, False]
+    assert results["Automobile Liability: currency mismatch"].tolist() == [False, False, False, False, True, False]
+    assert results["Commercial General Liability: currency mismatch"].tolist() == [False] * 5 + [True]
+    assert UI.compliance_summary(results) == {
+        "expired": 1, "expiring soon": 1, "below required limit": 1, "missing coverage": 1,
+        "currency mismatch": 2, "certificates with issues": 6,
+    }
+
+def test_unreadable_values_do_not_raise(rules):
+    certificates = table(certificate(**{AUTO["expiry"]: "[unclear]", AUTO["amount"]: "two million", AUTO["currency"]: "$"}))
+    results = UI.certificate_compliance(certificates, rules)
+    assert results["Automobile Liability: missing coverage"].tolist() == [True]
+    assert not results["Automobile Liability: expired"].any()
+
+def test_only_appended_rows_are_evaluated(rules, monkeypatch):
+    parsed = []
+    parse = UI.parse_certificate_columns
+    monkeypatch.setattr(UI, "parse_certificate_columns", lambda rows: parsed.append(len(rows)) or parse(rows))
+    certificates = table(certificate(), certificate())
+    UI.certificate_compliance(certificates, rules)
+    certificates = pd.concat([certificates, table(certificate(**{AUTO["expiry"]: day(-1)}))], ignore_index=True)
+    results = UI.certificate_compliance(certificates, rules)
+    assert parsed == [2, 1]
+    assert results["Issues"].tolist() == [0, 0, 1]
+
+def test_rules_change_or_shrinking_table_recomputes(rules, monkeypatch):
+    parsed = []
+    parse = UI.parse_certificate_columns
+    monkeypatch.setattr(UI, "parse_certificate_columns", lambda rows: parsed.append(len(rows)) or parse(rows))
+    certificates = table(certificate(), certificate(**{AUTO["amount"]: "1500000"}))
+    assert UI.certificate_compliance(certificates, rules)["Issues"].tolist() == [0, 1]
+    rules["required_limits"]["Automobile Liability"] = 1000000
+    assert UI.certificate_compliance(certificates, rules)["Issues"].tolist() == [0, 0]
+    assert UI.certificate_compliance(certificates.iloc[:1], rules)["Issues"].tolist() == [0]
+    assert parsed == [2, 2, 1]
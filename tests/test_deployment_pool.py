@@ -0,0 +1,122 @@
+import time
+import uuid
+
+import pytest
+import requests
+
+import UI
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.body = body if body is not None else {}
+
+    def json(self):
+        return self.body
+
+def completion(text):
+    return Response(200, {"choices": [{"message": {"content": text}}]})
+
+class Transport:
+    """Stand-in for the HTTP session: ``behaviour[endpoint]()`` returns a response or raises."""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.calls = []
+
+    def post(self, endpoint, headers=None, json=None):
+        self.calls.append(endpoint)
+        return self.behaviour[endpoint]()
+
+def deployment():
+    # Fresh endpoints keep the process-wide rate limiters of different tests apart
+    return {"endpoint": f"https://{uuid.uuid4().hex}.example/chat", "api_key": "key", "weight": 1.0}
+
+def slow(seconds, response):
+    def answer():
+        time.sleep(seconds)
+        return response
+    return answer
+
+def refused():
+    raise requests.exceptions.ConnectionError("refused")
+
+def test_fails_over_to_the_next_deployment():
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    transport = Transport({primary["endpoint"]: lambda: Response(500), secondary["endpoint"]: lambda: completion("ok")})
+    response = pool.dispatch({"messages": []}, [primary, secondary], "s1", transport)
+    assert response.json()["choices"][0]["message"]["content"] == "ok"
+    assert transport.calls == [primary["endpoint"], secondary["endpoint"]]
+    assert pool.snapshot()["failovers"] == 1
+    assert pool.health[primary["endpoint"]].stats["failures"] == 1
+
+def test_connection_errors_fail_over_and_are_raised_when_nothing_answers():
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    transport = Transport({primary["endpoint"]: refused, secondary["endpoint"]: lambda: completion("ok")})
+    assert pool.dispatch({"messages": []}, [primary, secondary], "s1", transport).status_code == 200
+    transport.behaviour[secondary["endpoint"]] = refused
+    with pytest.raises(requests.exceptions.ConnectionError):
+        pool.dispatch({"messages": []}, [primary, secondary], "s1", transport)
+
+def test_last_invalid_response_is_returned_when_every_deployment_fails():
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    transport = Transport({primary["endpoint"]: lambda: Response(500), secondary["endpoint"]: lambda: Response(200)})
+    assert pool.dispatch({"messages": []}, [primary, secondary], "s1", transport).status_code == 200
+    assert pool.snapshot()["failovers"] == 1
+
+def test_failing_deployment_cools_down_and_ranks_last():
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    transport = Transport({primary["endpoint"]: lambda: Response(503), secondary["endpoint"]: lambda: completion("ok")})
+    for _ in range(UI.DEPLOYMENT_FAILURE_THRESHOLD):
+        pool.send(primary, {"messages": []}, "s1", transport)
+    assert not pool.health[primary["endpoint"]].healthy(time.monotonic())
+    assert pool.rank([primary, secondary]) == [secondary, primary]
+    pool.send(secondary, {"messages": []}, "s1", transport)
+    assert pool.snapshot()["deployments"][0]["healthy"] is False
+
+def test_slow_call_is_hedged_and_the_first_valid_answer_wins(monkeypatch):
+    monkeypatch.setattr(UI, "HEDGE_MIN_DELAY_SECONDS", 0.05)
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    # The primary is usually fast, so it ranks first and gets hedged after its p95
+    pool._health(primary["endpoint"]).latencies.extend([0.01] * UI.HEDGE_MIN_SAMPLES)
+    pool._health(secondary["endpoint"]).latencies.extend([0.2] * UI.HEDGE_MIN_SAMPLES)
+    transport = Transport({primary["endpoint"]: slow(1.0, completion("slow")),
+                           secondary["endpoint"]: lambda: completion("hedge")})
+    start = time.monotonic()
+    response = pool.dispatch({"messages": []}, [primary, secondary], "s1", transport, hedge=True)
+    assert time.monotonic() - start < 0.5
+    assert response.json()["choices"][0]["message"]["content"] == "hedge"
+    assert pool.snapshot()["hedged"] == 1
+    assert pool.health[secondary["endpoint"]].stats["hedges_won"] == 1
+
+def test_no_hedge_without_enough_latency_samples():
+    pool = UI.DeploymentPool()
+    primary, secondary = deployment(), deployment()
+    transport = Transport({primary["endpoint"]: slow(0.2, completion("slow")),
+                           secondary["endpoint"]: lambda: completion("hedge")})
+    response = pool.dispatch({"messages": []}, [primary, secondary], "s1", transport, hedge=True)
+    assert response.json()["choices"][0]["message"]["content"] == "slow"
+    assert transport.calls == [primary["endpoint"]]
+    assert pool.snapshot()["hedged"] == 0
+
+def test_parse_deployments():
+    assert UI.parse_deployments("https://a, key-a, 2\nbroken line; https://b, key-b, x") == [
+        {"endpoint": "https://a", "api_key": "key-a", "weight": 2.0},
+        {"endpoint": "https://b", "api_key": "key-b", "weight": 1.0},
+    ]
+
+def test_deployment_calls_are_profiled_into_the_document():
+    pool = UI.DeploymentPool()
+    primary = deployment()
+    transport = Transport({primary["endpoint"]: slow(0.02, completion("ok"))})
+    profile = UI.DocumentProfile()
+    with profile.attach():
+        assert pool.dispatch({"messages": []}, [primary], "s1", transport).status_code == 200
+    time.sleep(0.05)
+    assert any(function == "answer" for _, _, function in profile.stats().stats)
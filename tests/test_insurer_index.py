@@ -0,0 +1,57 @@
+import pandas as pd
+
+import UI
+
+INDEX = UI.InsurerIndex(UI.CANONICAL_INSURERS)
+
+def test_aliases_and_spellings_resolve_to_the_canonical_name():
+    assert INDEX.resolve("INTACT INSURANCE CO.") == "Intact Insurance Company"
+    assert INDEX.resolve("The Co-operators") == "Co-operators General Insurance Company"
+    assert INDEX.resolve("Royal & SunAlliance") == "Royal & Sun Alliance Insurance Company of Canada"
+
+def test_misspellings_resolve_by_trigram_similarity():
+    assert INDEX.resolve("Northbrige General Insurance Corp") == "Northbridge General Insurance Corporation"
+    assert INDEX.resolve("Wawanessa Mutual") == "Wawanesa Mutual Insurance Company"
+
+def test_unrelated_names_do_not_resolve():
+    assert INDEX.resolve("Acme Widgets Holdings") is None
+    assert INDEX.resolve("") is None
+
+def test_insurer_letters_use_the_insurer_table():
+    letters = {"A": "Aviva Canada", "B": "Zenith Mutual"}
+    assert INDEX.resolve_reference("A", letters) == ("Aviva Insurance Company of Canada", None)
+    assert INDEX.resolve_reference("Insurer B", letters) == ("Zenith Mutual", None)
+    value, anomaly = INDEX.resolve_reference("C", letters)
+    assert value == "[unclear]"
+    assert "insurer letter C" in anomaly
+    assert INDEX.resolve_reference("missing", letters) == ("missing", None)
+
+def test_structured_coverages_are_resolved_in_place():
+    structured = {
+        "insurers": {"A": "Intact", "B": "Definity"},
+        "automobileLiability": {"insuranceCompany": "A"},
+        "commercialGeneralLiability": {"insuranceCompany": "Economical Insurance"},
+        "nonOwnedTrailer": {"insuranceCompany": "D"},
+    }
+    anomalies = UI.resolve_structured_insurers(structured)
+    assert structured["automobileLiability"]["insuranceCompany"] == "Intact Insurance Company"
+    assert structured["commercialGeneralLiability"]["insuranceCompany"] == "Definity Insurance Company"
+    assert structured["nonOwnedTrailer"]["insuranceCompany"] == "[unclear]"
+    assert anomalies == ["nonOwnedTrailer.insuranceCompany: insurer letter D has no name in the insurer table"]
+
+def test_certificates_table_columns_are_resolved():
+    certificates = pd.DataFrame({
+        "Automobile Liability Insurance Company": ["aviva", None, "Unknown Carrier"],
+        "Insured Name": ["x", "y", "z"],
+    })
+    resolved = UI.resolve_certificate_insurers(certificates)
+    assert resolved["Automobile Liability Insurance Company"].tolist()[0] == "Aviva Insurance Company of Canada"
+    assert pd.isna(resolved["Automobile Liability Insurance Company"].iloc[1])
+    assert resolved["Automobile Liability Insurance Company"].iloc[2] == "Unknown Carrier"
+    assert certificates["Automobile Liability Insurance Company"].iloc[0] == "aviva"
+
+def test_extra_carriers_load_from_a_list_file(tmp_path):
+    path = tmp_path / "insurers.txt"
+    path.write_text("Zenith Mutual Insurance | Zenith | Zenith Mutual\n\n", encoding="utf-8")
+    index = UI.InsurerIndex(UI.load_insurer_list(str(path)))
+    assert index.resolve("ZENITH") == "Zenith Mutual Insurance"
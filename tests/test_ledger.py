@@ -0,0 +1,98 @@
+import io
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import UI
+
+LEDGER_CSV = (
+    "Certificate Number,Insured Name,Certificate Holder,Automobile Liability Amount,Name of file,Notes\n"
+    "CA-1,Ridgeline Haulage,Ocean Trailer,2000000,ridgeline.pdf,renewal due\n"
+    "missing,Northern Freight,Ocean Trailer,1000000,northern.pdf,\n"
+    ",Duplicate Co,Ocean Trailer,1000000,dup-a.pdf,\n"
+    ",Duplicate Co,Ocean Trailer,1000000,dup-b.pdf,\n"
+).encode("utf-8")
+
+def certificates(*rows):
+    return pd.DataFrame([dict({"Certificate Number": "", "Insured Name": "", "Certificate Holder": "Ocean Trailer",
+                               "Automobile Liability Amount": "", "Name of file": "new.pdf"}, **row) for row in rows])
+
+def test_csv_ledger_with_a_character_split_at_the_block_boundary():
+    header = b"Insured Name,Notes\n"
+    # A filler row sized so the first block ends between the two bytes of the "\u00e9"
+    filler = b"x" * (UI.LEDGER_CSV_BLOCK_BYTES - 1 - len(header) - len(b",\nQu")) + b",\n"
+    data = header + filler + "Qu\u00e9bec Inc,note\n".encode("utf-8")
+    assert data[UI.LEDGER_CSV_BLOCK_BYTES - 1:UI.LEDGER_CSV_BLOCK_BYTES + 1] == "\u00e9".encode("utf-8")
+    frame = UI.read_ledger_csv(data)
+    assert frame["Insured Name"].tolist()[-1] == "Qu\u00e9bec Inc"
+
+@pytest.fixture
+def ledger():
+    return UI.CertificateLedger.load(LEDGER_CSV, "ledger.csv")
+
+def test_csv_and_excel_ledgers_read_as_strings():
+    frame = UI.read_ledger_csv(LEDGER_CSV)
+    assert frame["Automobile Liability Amount"].tolist()[0] == "2000000"
+    assert str(frame.dtypes["Notes"]) == "string"
+
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Insured Name", "Automobile Liability Amount", "Automobile Liability Expiry Date (yyyy/mm/dd)"])
+    sheet.append(["Ridgeline Haulage", 2000000.0, None])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    frame = UI.read_ledger_excel(buffer.getvalue())
+    assert frame.iloc[0].tolist() == ["Ridgeline Haulage", "2000000", ""]
+
+def test_ledger_gets_every_certificate_column(ledger):
+    assert set(UI.CERTIFICATE_COLUMNS) <= set(ledger.frame.columns)
+    assert "Notes" in ledger.frame.columns
+
+def test_matches_on_number_then_insured_and_holder(ledger):
+    assert ledger.match("ca-1", None, None) == ([0], "Certificate Number")
+    assert ledger.match(None, "northern freight", "ocean trailer") == ([1], "Insured Name + Certificate Holder")
+    assert ledger.match(None, "northern freight", "someone else") == ([], None)
+    # Placeholders are never indexed, so "missing" numbers don't match each other
+    assert "missing" not in ledger.indexes["number"]
+
+def test_merge_updates_inserts_and_keeps_unmatched_columns(ledger):
+    result = ledger.merge(certificates(
+        {"Certificate Number": "CA-1", "Automobile Liability Amount": "missing", "Name of file": "ridgeline-2025.pdf"},
+        {"Insured Name": "NORTHERN  freight", "Certificate Number": "NF-9"},
+        {"Insured Name": "Brand New Ltd", "Automobile Liability Amount": "5000000"},
+    ))
+    assert (result["inserted"], result["updated"], result["unchanged"]) == (1, 1, 1)
+    assert result["conflicts"].empty
+    frame = ledger.frame
+    # Placeholders don't overwrite; provenance is updated silently; columns the upload lacks are kept
+    assert frame.at[0, "Automobile Liability Amount"] == "2000000"
+    assert frame.at[0, "Name of file"] == "ridgeline-2025.pdf"
+    assert frame.at[0, "Notes"] == "renewal due"
+    assert frame.at[1, "Certificate Number"] == "NF-9"
+    assert frame.iloc[-1]["Insured Name"] == "Brand New Ltd"
+    assert frame.iloc[-1]["Notes"] == ""
+    # The indexes follow the changes, so a second merge upserts instead of inserting again
+    assert ledger.match("nf-9", None, None) == ([1], "Certificate Number")
+    again = ledger.merge(certificates({"Insured Name": "Brand New Ltd", "Automobile Liability Amount": "6000000"}))
+    assert (again["inserted"], again["updated"]) == (0, 1)
+    assert len(ledger.frame) == 5
+
+@pytest.mark.parametrize("keep, expected", [("incoming", "3000000"), ("ledger", "2000000")])
+def test_conflicts_are_reported_and_resolved_by_keep(ledger, keep, expected):
+    result = ledger.merge(certificates({"Certificate Number": "CA-1", "Insured Name": "ridgeline  HAULAGE",
+                                        "Automobile Liability Amount": "3000000"}), keep=keep)
+    conflicts = result["conflicts"]
+    # Case and spacing differences are not conflicts
+    assert conflicts["Column"].tolist() == ["Automobile Liability Amount"]
+    assert conflicts.iloc[0]["Ledger row"] == 2
+    assert conflicts.iloc[0]["Kept"] == keep
+    assert ledger.frame.at[0, "Automobile Liability Amount"] == expected
+
+def test_ambiguous_matches_are_left_out(ledger):
+    result = ledger.merge(certificates({"Insured Name": "Duplicate Co", "Automobile Liability Amount": "9"}))
+    assert result["ambiguous"].to_dict("records") == [
+        {"Name of file": "new.pdf", "Matched on": "Insured Name + Certificate Holder", "Ledger rows": "4, 5"}
+    ]
+    assert (result["inserted"], result["updated"]) == (0, 0)
+    assert ledger.frame["Automobile Liability Amount"].tolist()[2:] == ["1000000", "1000000"]
@@ -0,0 +1,71 @@
+import streamlit as st
+
+import UI
+
+def structured(**auto):
+    values = {"insuranceCompany": "Intact Insurance Company", "currency": "", "amount": "$2,000,000",
+              "deductibleCurrency": "", "deductibleAmount": "", "expiryDate": "11/03/2026"}
+    values.update(auto)
+    return {
+        "certificateInfo": {"address": "1 Main St, Toronto ON M5V 1A1", "effectiveDate": "25/11/03",
+                            "expirationDate": "2026-11-03"},
+        "automobileLiability": values,
+        "other": {"cancellationNoticePeriod": "30 days"},
+    }
+
+def test_formatting_rules_are_applied_locally():
+    normalized, anomalies = UI.normalize_structured_data(structured())
+    auto = normalized["automobileLiability"]
+    assert auto["amount"] == "2000000"
+    assert auto["currency"] == "CAD"
+    assert auto["expiryDate"] == "2026/11/03"
+    assert auto["deductibleAmount"] == "missing"
+    assert auto["deductibleCurrency"] == "missing"
+    assert normalized["certificateInfo"]["effectiveDate"] == "2025/11/03"
+    assert normalized["certificateInfo"]["expirationDate"] == "2026/11/03"
+    assert normalized["other"]["cancellationNoticePeriod"] == "30"
+    assert anomalies == []
+
+def test_zero_deductible_is_kept():
+    normalized, _ = UI.normalize_structured_data(structured(deductibleAmount=0, deductibleCurrency="CAD"))
+    auto = normalized["automobileLiability"]
+    assert auto["deductibleAmount"] == "0"
+    assert auto["deductibleCurrency"] == "CAD"
+
+def test_input_is_not_modified():
+    original = structured()
+    UI.normalize_structured_data(original)
+    assert original["automobileLiability"]["amount"] == "$2,000,000"
+
+def test_printed_currency_used_without_address():
+    data = structured(amount="USD 1,000,000")
+    data["certificateInfo"]["address"] = ""
+    normalized, anomalies = UI.normalize_structured_data(data)
+    assert normalized["automobileLiability"]["amount"] == "1000000"
+    assert normalized["automobileLiability"]["currency"] == "USD"
+    assert anomalies == []
+
+def test_unreadable_values_become_unclear_with_an_anomaly():
+    data = structured(amount="2.000.000", expiryDate="March 2026", currency="USD", deductibleCurrency="CAD")
+    data["other"]["cancellationNoticePeriod"] = "thirty"
+    normalized, anomalies = UI.normalize_structured_data(data)
+    auto = normalized["automobileLiability"]
+    assert auto["amount"] == "[unclear]"
+    assert auto["expiryDate"] == "[unclear]"
+    assert auto["deductibleCurrency"] == "missing"
+    assert sorted(anomalies) == sorted([
+        "automobileLiability.expiryDate: unreadable date 'March 2026'",
+        "automobileLiability.amount: unusual amount format '2.000.000'",
+        "automobileLiability.currency: printed USD but the address indicates CAD",
+        "automobileLiability.deductibleCurrency: currency without an amount",
+        "other.cancellationNoticePeriod: unreadable period 'thirty'",
+    ])
+
+def test_non_dict_results_pass_through():
+    assert UI.normalize_structured_data(None) == (None, [])
+
+def test_anomalies_are_recorded_for_the_document():
+    st.session_state.pop("document_anomalies", None)
+    UI.record_anomalies(["a"])
+    UI.record_anomalies(["b", "c"])
+    assert st.session_state.pop("document_anomalies") == ["a", "b", "c"]
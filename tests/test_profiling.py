@@ -0,0 +1,34 @@
+import threading
+import time
+
+import UI
+
+def busy_stage(value):
+    time.sleep(0.05)
+    return value * 2
+
+def test_pipeline_workers_are_profiled_into_the_document():
+    profile = UI.DocumentProfile()
+    pipeline = UI.StagePipeline("test", [("double", busy_stage, 2)])
+    with profile.sampler, profile.attach():
+        assert pipeline.run([1, 2, 3]) == [2, 4, 6]
+    stats = profile.stats()
+    assert any(function == "busy_stage" for _, _, function in stats.stats)
+    # The calling thread plus both workers
+    assert len(profile.profilers) == 3
+    assert len(profile.sampler.samples) >= 2
+
+def test_background_work_is_profiled_into_the_document():
+    profile = UI.DocumentProfile()
+    with profile.attach():
+        future = UI.run_in_background(busy_stage, 4)
+        assert future.result() == 8
+    time.sleep(0.05)
+    assert any(function == "busy_stage" for _, _, function in profile.stats().stats)
+
+def test_profiled_is_a_no_op_outside_a_profile():
+    assert UI.profiled(busy_stage) is busy_stage
+    seen = []
+    thread = UI.start_thread(lambda: seen.append(getattr(UI.PROFILE_CONTEXT, "profile", None)))
+    thread.join()
+    assert seen == [None]
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import UI
+
+class Response:
+    def __init__(self, status_code, headers=None, usage=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.usage = usage
+
+    def json(self):
+        return {"usage": {"total_tokens": self.usage}} if self.usage is not None else {}
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def test_token_bucket_waits_for_refill():
+    limiter = UI.RateLimiter(rpm=6000, tpm=6000)
+    assert limiter.acquire(6000, "a") < 0.1
+    # 6000 TPM refills 100 tokens a second
+    waited = limiter.acquire(50, "a")
+    assert 0.3 < waited < 1.5
+
+def test_waiting_sessions_are_served_round_robin():
+    limiter = UI.RateLimiter(rpm=600, tpm=10 ** 6)
+    limiter.requests_available = 0
+    order = []
+
+    def call(session_id):
+        limiter.acquire(1, session_id)
+        order.append(session_id)
+
+    threads = [threading.Thread(target=call, args=("batch",)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: limiter.waiting.get("batch") == 3)
+    threads.append(threading.Thread(target=call, args=("reviewer",)))
+    threads[-1].start()
+    wait_until(lambda: "reviewer" in limiter.waiting)
+    for thread in threads:
+        thread.join(5)
+    # The reviewer's single call goes right after the batch's first one, not behind all three
+    assert order == ["batch", "reviewer", "batch", "batch"]
+
+def test_throttled_call_blocks_and_is_refunded():
+    limiter = UI.RateLimiter(rpm=60, tpm=1000)
+    limiter.acquire(400, "a")
+    limiter.reconcile(400, Response(429, {"retry-after-ms": "300"}))
+    snapshot = limiter.snapshot()
+    assert snapshot["throttled"] == 1
+    assert snapshot["tokens_available"] >= 999
+    assert limiter.acquire(10, "a") >= 0.2
+
+def test_usage_and_service_headers_correct_the_budget():
+    limiter = UI.RateLimiter(rpm=60, tpm=1000)
+    limiter.acquire(500, "a")
+    limiter.reconcile(500, Response(200, usage=100))
+    assert limiter.snapshot()["tokens_available"] >= 899
+    limiter.reconcile(0, Response(200, {"x-ratelimit-remaining-tokens": "50", "x-ratelimit-remaining-requests": "2"}))
+    snapshot = limiter.snapshot()
+    assert snapshot["tokens_available"] < 60
+    assert snapshot["requests_available"] < 3
+
+def test_request_estimate_counts_text_and_max_tokens():
+    data = {"messages": [{"role": "system", "content": "x" * 400},
+                         {"role": "user", "content": [{"type": "text", "text": "y" * 80}]}],
+            "max_tokens": 1000}
+    assert UI.estimate_request_tokens(data) == 100 + 20 + 1000
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import UI
+
+class Response:
+    def __init__(self, answer):
+        self.answer = answer
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        content = "<initial_attempt>```json\n" + json.dumps(self.answer) + "\n```</initial_attempt>"
+        return {"choices": [{"message": {"content": content}}]}
+
+def stored():
+    return {
+        "certificateInfo": {"insuredName": "Ridgeline Haulage", "address": ""},
+        "automobileLiability": {"insuranceCompany": "Intact Insurance Company", "currency": "[unclear]",
+                                "amount": "2000000", "deductibleCurrency": "missing", "deductibleAmount": "missing",
+                                "expiryDate": "2026/01/01"},
+        "insurers": {"A": "Intact Insurance Company"},
+    }
+
+@pytest.fixture
+def model(monkeypatch):
+    requests = []
+
+    def answer_with(answer):
+        def post(data):
+            requests.append(data)
+            return Response(answer)
+        monkeypatch.setattr(UI, "post_chat_completion", post)
+        return requests
+    return answer_with
+
+def test_currency_reasked_alone_keeps_the_stored_amount(model):
+    model({"currency": "CAD"})
+    normalized, anomalies = UI.request_section("automobileLiability", ["currency"], stored(), raw_text="text")
+    assert normalized["automobileLiability"]["currency"] == "CAD"
+    assert normalized["automobileLiability"]["amount"] == "2000000"
+    assert anomalies == []
+
+def test_reextracted_currency_is_merged_into_the_entry(model, monkeypatch, tmp_path):
+    index = UI.CertificateIndex(str(tmp_path / "index.db"))
+    monkeypatch.setattr(UI, "get_certificate_index", lambda: index)
+    index.upsert("sha-1", "ridgeline.pdf", "extracted", {}, page_count=1, structured=stored(), raw_text="text")
+    requests = model({"currency": "CAD"})
+    entry = {"key": "sha-1", "file_name": "ridgeline.pdf", "status": "extracted", "page_count": 1,
+             "structured_data": stored(), "form_values": {}, "anomalies": []}
+    changed, source = UI.reextract_section(entry, "automobileLiability", ["currency"])
+    assert (changed, source) == (["currency"], "text")
+    # Only the requested field is asked for and only it changes
+    assert json.loads(requests[0]["messages"][0]["content"].split("fields:")[1].split("Follow")[0]) == {
+        "currency": UI.TEXT_EXTRACTION_SCHEMA["automobileLiability"]["currency"]}
+    auto = entry["structured_data"]["automobileLiability"]
+    assert auto["currency"] == "CAD"
+    assert auto["amount"] == "2000000"
+    assert entry["anomalies"] == []
+    index.connection.close()
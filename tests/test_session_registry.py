@@ -0,0 +1,46 @@
+import time
+
+import pandas as pd
+import pytest
+from streamlit.runtime.state.session_state import SessionState
+
+import UI
+
+@pytest.fixture
+def registry(tmp_path):
+    return UI.SessionRegistry(str(tmp_path), idle_seconds=60, min_idle_seconds=10, budget_bytes=2 ** 30)
+
+def idle_session(registry, session_id, idle_seconds):
+    state = SessionState()
+    state["batch_results"] = [{"file_name": "a.pdf"}]
+    state["certificates"] = pd.DataFrame({"Insured Name": ["Ridgeline"]})
+    registry.sessions[session_id] = {"state": lambda: state, "safe_state": lambda: None, "offloaded": None,
+                                     "offloaded_bytes": 0, "sizes": {}, "last_active": time.time() - idle_seconds}
+    return state
+
+def test_idle_session_is_offloaded_and_restored(registry):
+    state = idle_session(registry, "idle", 120)
+    registry.sweep()
+    assert "batch_results" not in state
+    assert registry.snapshot()["offloaded_sessions"] == 1
+    registry.restore(registry.sessions["idle"])
+    assert state["batch_results"] == [{"file_name": "a.pdf"}]
+    assert state["certificates"]["Insured Name"].tolist() == ["Ridgeline"]
+
+def test_session_queued_for_extraction_is_not_offloaded(registry):
+    state = idle_session(registry, "uploading", 120)
+    scheduler = UI.get_admission_scheduler()
+    tickets = scheduler.submit("uploading", "bulk", 1.0, ["a.pdf", "b.pdf"])
+    try:
+        registry.sweep()
+        assert "batch_results" in state
+    finally:
+        scheduler.cancel(tickets)
+    registry.sweep()
+    assert "batch_results" not in state
+
+def test_recently_active_session_stays_under_budget(registry):
+    state = idle_session(registry, "active", 5)
+    registry.budget_bytes = 0
+    registry.sweep()
+    assert "batch_results" in state
@@ -0,0 +1,106 @@
+import pytest
+
+import UI
+
+@pytest.fixture(params=["sqlite", "memory"])
+def queue(request, tmp_path):
+    if request.param == "sqlite":
+        return UI.SQLiteWorkQueue(str(tmp_path / "jobs.db"))
+    return UI.MemoryWorkQueue()
+
+def expire_leases(monkeypatch):
+    # Leases taken from now on are already past their expiry
+    monkeypatch.setattr(UI, "WORK_LEASE_SECONDS", -1)
+
+def test_leased_job_completes_once(queue):
+    job_id = queue.enqueue({"path": "a.pdf", "session": "s1"})
+    job = queue.lease("worker-1")
+    assert job["id"] == job_id
+    assert job["payload"]["path"] == "a.pdf"
+    assert job["attempt"] == 1
+    assert queue.lease("worker-2") is None
+    assert queue.renew(job_id, job["token"])
+    assert queue.complete(job_id, job["token"], {"tier": "rules"})
+    assert not queue.complete(job_id, job["token"], {"tier": "vision"})
+    assert queue.status([job_id]) == {job_id: {"status": "done", "attempts": 1, "result": {"tier": "rules"}, "error": None}}
+
+def test_expired_lease_is_taken_over_and_old_token_is_rejected(queue, monkeypatch):
+    job_id = queue.enqueue({"path": "a.pdf"})
+    expire_leases(monkeypatch)
+    crashed = queue.lease("worker-1")
+    monkeypatch.setattr(UI, "WORK_LEASE_SECONDS", 60)
+    taken_over = queue.lease("worker-2")
+    assert taken_over["id"] == job_id
+    assert taken_over["attempt"] == 2
+    assert not queue.renew(job_id, crashed["token"])
+    assert not queue.complete(job_id, crashed["token"], {"from": "worker-1"})
+    assert not queue.fail(job_id, crashed["token"], "late failure")
+    assert queue.complete(job_id, taken_over["token"], {"from": "worker-2"})
+    assert queue.status([job_id])[job_id]["result"] == {"from": "worker-2"}
+
+def test_failures_are_retried_until_max_attempts(queue):
+    job_id = queue.enqueue({"path": "a.pdf"})
+    for attempt in range(1, UI.WORK_MAX_ATTEMPTS + 1):
+        job = queue.lease("worker-1")
+        assert job["attempt"] == attempt
+        assert queue.fail(job_id, job["token"], f"error {attempt}")
+    status = queue.status([job_id])[job_id]
+    assert status["status"] == "failed"
+    assert status["error"] == f"error {UI.WORK_MAX_ATTEMPTS}"
+    assert queue.lease("worker-1") is None
+
+def test_repeatedly_expired_leases_end_the_job(queue, monkeypatch):
+    job_id = queue.enqueue({"path": "a.pdf"})
+    expire_leases(monkeypatch)
+    for _ in range(UI.WORK_MAX_ATTEMPTS):
+        assert queue.lease("worker-1")["id"] == job_id
+    assert queue.lease("worker-1") is None
+    assert queue.status([job_id])[job_id]["status"] == "failed"
+    assert queue.status([job_id])[job_id]["error"] == "worker lease expired too often"
+
+def staged_document(tmp_path, name):
+    folder = tmp_path / "documents" / name
+    folder.mkdir(parents=True)
+    (folder / "a.pdf").write_bytes(b"%PDF")
+    return folder
+
+def test_jobs_ended_by_expired_leases_lose_their_staged_document(queue, monkeypatch, tmp_path):
+    folder = staged_document(tmp_path, "crashed")
+    queue.enqueue({"path": str(folder / "a.pdf")})
+    expire_leases(monkeypatch)
+    for _ in range(UI.WORK_MAX_ATTEMPTS):
+        assert queue.lease("worker-1") is not None
+    assert folder.exists()
+    assert queue.lease("worker-1") is None
+    assert not folder.exists()
+
+def test_jobs_dropped_after_retention_lose_their_staged_document(queue, monkeypatch, tmp_path):
+    folder = staged_document(tmp_path, "done")
+    job_id = queue.enqueue({"path": str(folder / "a.pdf")})
+    job = queue.lease("worker-1")
+    assert queue.complete(job_id, job["token"], {"tier": "rules"})
+    monkeypatch.setattr(UI, "WORK_RETENTION_SECONDS", -1)
+    assert queue.lease("worker-1") is None
+    assert queue.status([job_id]) == {}
+    assert not folder.exists()
+
+def test_interactive_and_least_served_sessions_go_first(queue):
+    bulk = queue.enqueue({"session": "nightly", "lane": "bulk"})
+    first = queue.enqueue({"session": "s1", "lane": "interactive"})
+    second = queue.enqueue({"session": "s1", "lane": "interactive"})
+    other = queue.enqueue({"session": "s2", "lane": "interactive"})
+    order = [queue.lease(f"worker-{n}")["id"] for n in range(4)]
+    # s1 already holds a lease when the second pick is made, so s2 is served before s1's second job
+    assert order == [first, other, second, bulk]
+
+def test_status_of_unknown_jobs_is_omitted(queue):
+    assert queue.status(["missing"]) == {}
+    assert queue.status([]) == {}
+
+def test_backends_are_abstract():
+    class Incomplete(UI.WorkQueueBackend):
+        def enqueue(self, payload):
+            return "id"
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,53 @@
+"""
+Extraction worker for horizontally scaled deployments.
+
+Every replica of the app submits uploads to the shared work queue (CERT_WORK_QUEUE=sqlite,
+stored under CERT_WORK_QUEUE_DIR); any number of these workers, on any replica, lease jobs
+from it, extract them with the same pipeline as the app and record each result exactly once.
+
+    CERT_WORK_QUEUE=sqlite python worker.py --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+IDLE_SLEEP_SECONDS = 1.0
+
+def run_worker(worker_number):
+    # Imported here so every worker process loads the app module (and its caches) itself
+    import UI
+
+    UI.initialize_session_state()
+    print(f"warm-up took {UI.resources().warm()} ms", flush=True)
+    queue = UI.get_work_queue()
+    if queue is None:
+        raise SystemExit("Set CERT_WORK_QUEUE to 'sqlite' to share a queue between replicas and workers.")
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{worker_number}"
+    print(f"{worker_id}: waiting for jobs ({queue.snapshot()})", flush=True)
+    while True:
+        job = queue.lease(worker_id)
+        if job is None:
+            time.sleep(IDLE_SLEEP_SECONDS)
+            continue
+        start = time.perf_counter()
+        recorded = UI.process_queue_job(queue, job, worker_id)
+        print(f"{worker_id}: {job['payload']['file_name']} attempt {job['attempt']} "
+              f"{'recorded' if recorded else 'not recorded'} in {time.perf_counter() - start:.1f}s", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to run on this host")
+    args = parser.parse_args()
+    if args.processes == 1:
+        run_worker(0)
+        return
+    workers = [multiprocessing.Process(target=run_worker, args=(number,)) for number in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    main()